@@ -1,11 +1,17 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple, Union
 from uuid import uuid4
+import asyncio
+import hashlib
+import inspect
+import json
 import time
+import httpx
 import logging
-import os
 
 from main import (
     triage_agent,
@@ -14,8 +20,7 @@ from main import (
     flight_status_agent,
     cancellation_agent,
     create_initial_context,
-    on_seat_booking_handoff,
-    on_cancellation_handoff,
+    AirlineAgentContext,
 )
 
 from deepseek_agent import (
@@ -28,13 +33,38 @@ from deepseek_agent import (
     InputGuardrailTripwireTriggered,
     Handoff,
     RunContextWrapper,
+    UpstreamError,
+    close_default_client,
+    get_default_client,
 )
+from guardrail_cache import guardrail_verdict_cache
+from guardrail_fusion import guardrail_fuser
+from conversation_store import create_conversation_store
+from history import history_manager
+from conversation_locks import ConversationLockTable, RequestCoalescer
+from faq import faq_answer_cache, lookup_faq
+from intent_router import intent_router
+from model_tiers import model_router
+import metrics
+from token_usage import TokenBudgetExceeded, bind_conversation, usage_ledger
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await conversation_store.start()
+    yield
+    # 取消仍在后台进行的对话摘要
+    await history_manager.close()
+    # 落盘尚未写入的会话状态
+    await conversation_store.close()
+    # 关闭所有代理共享的上游连接池
+    await close_default_client()
+    await _forward_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS配置（根据部署需要调整）
 app.add_middleware(
@@ -45,6 +75,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(UpstreamError)
+async def upstream_error_handler(request: Request, exc: UpstreamError):
+    """上游模型调用失败（重试用尽或熔断器打开）：返回503，上游拒绝请求本身时返回502。"""
+    headers = {"Retry-After": str(max(1, round(exc.retry_after)))} if exc.retry_after is not None else None
+    return JSONResponse(
+        status_code=502 if exc.kind == "bad_request" else 503,
+        content={"detail": str(exc), "error": exc.kind},
+        headers=headers,
+    )
+
 # =========================
 # 模型
 # =========================
@@ -52,6 +92,8 @@ app.add_middleware(
 class ChatRequest(BaseModel):
     conversation_id: Optional[str] = None
     message: str
+    # 为True时返回精简的ChatDeltaResponse
+    delta: bool = False
 
 class MessageResponse(BaseModel):
     content: str
@@ -81,29 +123,27 @@ class ChatResponse(BaseModel):
     context: Dict[str, Any]
     agents: List[Dict[str, Any]]
     guardrails: List[GuardrailCheck] = []
+    agents_version: Optional[str] = None
+
+class ChatDeltaResponse(BaseModel):
+    """
+    精简的增量响应：只含本轮新增的消息和事件、有变化的上下文字段（新会话为完整上下文）
+    以及未通过的守卫；代理目录改由GET /agents获取，agents_version变化时再重新拉取。
+    """
+    conversation_id: str
+    current_agent: str
+    messages: List[MessageResponse]
+    events: List[AgentEvent]
+    context_changes: Dict[str, Any]
+    agents_version: str
+    guardrails: List[GuardrailCheck] = []
 
 # =========================
-# 会话状态的内存存储
+# 会话状态存储
 # =========================
 
-class ConversationStore:
-    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
-        pass
-
-    def save(self, conversation_id: str, state: Dict[str, Any]):
-        pass
-
-class InMemoryConversationStore(ConversationStore):
-    _conversations: Dict[str, Dict[str, Any]] = {}
-
-    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
-        return self._conversations.get(conversation_id)
-
-    def save(self, conversation_id: str, state: Dict[str, Any]):
-        self._conversations[conversation_id] = state
-
-# TODO: 在大规模部署此应用程序时，切换到您自己的生产就绪实现
-conversation_store = InMemoryConversationStore()
+# 通过CONVERSATION_STORE选择有界内存（默认）、内存或SQLite持久化存储
+conversation_store = create_conversation_store(AirlineAgentContext)
 
 # =========================
 # 辅助函数
@@ -152,144 +192,190 @@ def _build_agents_list() -> List[Dict[str, Any]]:
     ]
 
 # =========================
-# 主聊天端点
+# 代理目录
 # =========================
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(req: ChatRequest):
-    """
-    代理编排的主聊天端点。
-    处理会话状态、代理路由和守卫检查。
-    """
-    # 初始化或检索会话状态
-    is_new = not req.conversation_id or conversation_store.get(req.conversation_id) is None
+# 代理、转接、工具和守卫在启动后不再变化，目录只在启动时构建一次
+AGENT_CATALOG: List[Dict[str, Any]] = _build_agents_list()
+AGENTS_VERSION = hashlib.sha1(
+    json.dumps(AGENT_CATALOG, ensure_ascii=False, sort_keys=True).encode("utf-8")
+).hexdigest()[:12]
+_AGENTS_ETAG = f'"{AGENTS_VERSION}"'
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match按弱比较：逗号分隔的ETag列表中任一项（去掉W/前缀）与etag相同，或为"*"。"""
+    for token in if_none_match.split(","):
+        token = token.strip()
+        if token == "*":
+            return True
+        if token.startswith("W/"):
+            token = token[2:]
+        if token == etag:
+            return True
+    return False
+
+@app.get("/agents")
+async def agents_endpoint(request: Request):
+    """代理目录及其版本；客户端带If-None-Match重新验证，目录未变时返回304。"""
+    headers = {"ETag": _AGENTS_ETAG, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match", ""), _AGENTS_ETAG):
+        return Response(status_code=304, headers=headers)
+    return Response(
+        json.dumps({"version": AGENTS_VERSION, "agents": AGENT_CATALOG}, ensure_ascii=False),
+        media_type="application/json",
+        headers=headers,
+    )
+
+# =========================
+# 运行统计
+# =========================
+
+@app.get("/stats")
+async def stats_endpoint():
+    """返回缓存命中率等运行统计。"""
+    return {
+        "guardrail_cache": guardrail_verdict_cache.stats(),
+        "guardrail_fusion": guardrail_fuser.stats(),
+        "conversation_store": conversation_store.stats(),
+        "history": history_manager.stats(),
+        "conversation_locks": conversation_locks.stats(),
+        "chat_coalescer": chat_coalescer.stats(),
+        "faq_cache": faq_answer_cache.stats(),
+        "intent_router": intent_router.stats(),
+        "token_usage": usage_ledger.stats(),
+        "upstream": get_default_client().stats(),
+        "model_routing": model_router.stats(),
+    }
+
+@app.get("/usage")
+async def usage_endpoint():
+    """上游调用的token用量与估算费用：总计、按代理和模型、按分钟以及用量最多的会话。"""
+    return usage_ledger.summary()
+
+@app.get("/usage/{conversation_id}")
+async def conversation_usage_endpoint(conversation_id: str):
+    """单个会话的累计用量及剩余预算。"""
+    usage = usage_ledger.conversation(conversation_id)
+    if usage is None:
+        raise HTTPException(status_code=404, detail="没有该会话的用量记录")
+    return {
+        "conversation_id": conversation_id,
+        **usage.as_dict(),
+        "remaining_budget": usage_ledger.remaining_budget(conversation_id),
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """以Prometheus文本格式导出各阶段的耗时直方图和计数器。"""
+    return Response(metrics.registry.render(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+# =========================
+# 会话轮次处理
+# =========================
+
+async def _load_or_create_state(req: ChatRequest) -> Tuple[str, Dict[str, Any], bool]:
+    """初始化或检索会话状态，返回(conversation_id, state, is_new)。"""
+    state = await conversation_store.get(req.conversation_id) if req.conversation_id else None
+    is_new = state is None
     if is_new:
         conversation_id: str = uuid4().hex
         ctx = create_initial_context()
-        current_agent_name = triage_agent.name
         state: Dict[str, Any] = {
             "input_items": [],
             "context": ctx,
-            "current_agent": current_agent_name,
+            "current_agent": triage_agent.name,
         }
-        if req.message.strip() == "":
-            conversation_store.save(conversation_id, state)
-            return ChatResponse(
-                conversation_id=conversation_id,
-                current_agent=current_agent_name,
-                messages=[],
-                events=[],
-                context=ctx.model_dump(),
-                agents=_build_agents_list(),
-                guardrails=[],
-            )
     else:
         conversation_id = req.conversation_id  # type: ignore
-        state = conversation_store.get(conversation_id)
+    return conversation_id, state, is_new
 
-    current_agent = _get_agent_by_name(state["current_agent"])
-    state["input_items"].append({"content": req.message, "role": "user"})
-    old_context = state["context"].model_dump().copy()
-    guardrail_checks: List[GuardrailCheck] = []
-
-    try:
-        result = await Runner.run(current_agent, state["input_items"], context=state["context"])
-    except InputGuardrailTripwireTriggered as e:
-        failed = e.guardrail_result.guardrail
-        gr_output = e.guardrail_result.output.output_info
-        gr_reasoning = getattr(gr_output, "reasoning", "")
-        gr_input = req.message
-        gr_timestamp = time.time() * 1000
-        for g in current_agent.input_guardrails:
-            guardrail_checks.append(GuardrailCheck(
-                id=uuid4().hex,
-                name=_get_guardrail_name(g),
-                input=gr_input,
-                reasoning=(gr_reasoning if g == failed else ""),
-                passed=(g != failed),
-                timestamp=gr_timestamp,
-            ))
-        refusal = "抱歉，我只能回答与航空旅行相关的问题。"
-        state["input_items"].append({"role": "assistant", "content": refusal})
-        return ChatResponse(
-            conversation_id=conversation_id,
-            current_agent=current_agent.name,
-            messages=[MessageResponse(content=refusal, agent=current_agent.name)],
-            events=[],
-            context=state["context"].model_dump(),
-            agents=_build_agents_list(),
-            guardrails=guardrail_checks,
-        )
+async def _empty_response(conversation_id: str, state: Dict[str, Any]) -> ChatResponse:
+    """新会话且消息为空时，只保存状态并返回初始上下文。"""
+    await conversation_store.save(conversation_id, state)
+    return ChatResponse(
+        conversation_id=conversation_id,
+        current_agent=state["current_agent"],
+        messages=[],
+        events=[],
+        context=state["context"].model_dump(),
+        agents=AGENT_CATALOG,
+        agents_version=AGENTS_VERSION,
+        guardrails=[],
+    )
 
-    messages: List[MessageResponse] = []
-    events: List[AgentEvent] = []
+async def _guardrail_refusal(
+    conversation_id: str,
+    state: Dict[str, Any],
+    current_agent,
+    message: str,
+    e: InputGuardrailTripwireTriggered,
+    old_context: Dict[str, Any],
+) -> ChatResponse:
+    """守卫触发时构建拒绝回复；本轮不生效，撤销意图路由的转接回调等对上下文的修改。"""
+    state["context"] = type(state["context"]).model_validate(old_context)
+    guardrail_checks: List[GuardrailCheck] = []
+    failed = e.guardrail_result.guardrail
+    gr_output = e.guardrail_result.output.output_info
+    gr_reasoning = getattr(gr_output, "reasoning", "")
+    gr_input = message
+    gr_timestamp = time.time() * 1000
+    for g in current_agent.input_guardrails:
+        guardrail_checks.append(GuardrailCheck(
+            id=uuid4().hex,
+            name=_get_guardrail_name(g),
+            input=gr_input,
+            reasoning=(gr_reasoning if g == failed else ""),
+            passed=(g != failed),
+            timestamp=gr_timestamp,
+        ))
+    refusal = "抱歉，我只能回答与航空旅行相关的问题。"
+    state["input_items"].append({"role": "assistant", "content": refusal})
+    await conversation_store.save(conversation_id, state)
+    return ChatResponse(
+        conversation_id=conversation_id,
+        current_agent=current_agent.name,
+        messages=[MessageResponse(content=refusal, agent=current_agent.name)],
+        events=[],
+        context=state["context"].model_dump(),
+        agents=AGENT_CATALOG,
+        agents_version=AGENTS_VERSION,
+        guardrails=guardrail_checks,
+    )
 
-    # 检查是否需要转接代理（开发模式下的模拟转接）
-    dev_mode = os.environ.get("DEEPSEEK_DEV_MODE", "").lower() in ("true", "1", "yes")
-    if dev_mode and len(result.new_items) > 0 and isinstance(result.new_items[0], MessageOutputItem):
-        content = result.new_items[0].content
-        # 检查消息中是否包含转接提示
-        if "转接到座位预订代理" in content:
-            # 模拟转接到座位预订代理
-            old_agent = current_agent
-            current_agent = seat_booking_agent
-            # 创建转接事件
-            events.append(
-                AgentEvent(
-                    id=uuid4().hex,
-                    type="handoff",
-                    agent=old_agent.name,
-                    content=f"{old_agent.name} -> {current_agent.name}",
-                    metadata={"source_agent": old_agent.name, "target_agent": current_agent.name},
-                )
-            )
-            # 执行转接回调
-            if old_agent.name == triage_agent.name:
-                await on_seat_booking_handoff(RunContextWrapper(state["context"]))
-        elif "转接到航班状态代理" in content:
-            # 模拟转接到航班状态代理
-            old_agent = current_agent
-            current_agent = flight_status_agent
-            events.append(
-                AgentEvent(
-                    id=uuid4().hex,
-                    type="handoff",
-                    agent=old_agent.name,
-                    content=f"{old_agent.name} -> {current_agent.name}",
-                    metadata={"source_agent": old_agent.name, "target_agent": current_agent.name},
-                )
-            )
-        elif "转接到FAQ代理" in content:
-            # 模拟转接到FAQ代理
-            old_agent = current_agent
-            current_agent = faq_agent
-            events.append(
-                AgentEvent(
-                    id=uuid4().hex,
-                    type="handoff",
-                    agent=old_agent.name,
-                    content=f"{old_agent.name} -> {current_agent.name}",
-                    metadata={"source_agent": old_agent.name, "target_agent": current_agent.name},
-                )
-            )
-        elif "转接到取消代理" in content:
-            # 模拟转接到取消代理
-            old_agent = current_agent
-            current_agent = cancellation_agent
-            events.append(
-                AgentEvent(
-                    id=uuid4().hex,
-                    type="handoff",
-                    agent=old_agent.name,
-                    content=f"{old_agent.name} -> {current_agent.name}",
-                    metadata={"source_agent": old_agent.name, "target_agent": current_agent.name},
-                )
-            )
-            # 执行转接回调
-            if old_agent.name == triage_agent.name:
-                await on_cancellation_handoff(RunContextWrapper(state["context"]))
+def _discard_turn(state: Dict[str, Any], old_context: Dict[str, Any]) -> None:
+    """上游调用失败时撤销本轮对会话状态的修改（用户消息和上下文），客户端可以原样重试。"""
+    state["input_items"].pop()
+    state["context"] = type(state["context"]).model_validate(old_context)
+
+async def _budget_refusal(
+    conversation_id: str, state: Dict[str, Any], current_agent, e: TokenBudgetExceeded, old_context: Dict[str, Any]
+) -> ChatResponse:
+    """会话的token用量达到预算时，不再调用模型，返回固定回复；与守卫触发时一样撤销本轮对上下文的修改。"""
+    state["context"] = type(state["context"]).model_validate(old_context)
+    refusal = "抱歉，本次对话的用量已达上限，请开始新的对话。"
+    state["input_items"].append({"role": "assistant", "content": refusal})
+    await conversation_store.save(conversation_id, state)
+    return ChatResponse(
+        conversation_id=conversation_id,
+        current_agent=current_agent.name,
+        messages=[MessageResponse(content=refusal, agent=current_agent.name)],
+        events=[AgentEvent(
+            id=uuid4().hex,
+            type="budget_exceeded",
+            agent=current_agent.name,
+            content=str(e),
+            metadata={"used_tokens": e.used, "budget": e.budget},
+            timestamp=time.time() * 1000,
+        )],
+        context=state["context"].model_dump(),
+        agents=AGENT_CATALOG,
+        agents_version=AGENTS_VERSION,
+        guardrails=[],
+    )
 
-    for item in result.new_items:
+def _process_items(items: List[Any], current_agent, messages: List[MessageResponse], events: List[AgentEvent]):
+    """将运行产生的条目转换为消息和事件，返回处理转接后的当前代理。"""
+    for item in items:
         if isinstance(item, MessageOutputItem):
             text = ItemHelpers.text_message_output(item)
             messages.append(MessageResponse(content=text, agent=current_agent.name))
@@ -315,23 +401,15 @@ async def chat_endpoint(req: ChatRequest):
                  if isinstance(h, Handoff) and getattr(h, "agent_name", None) == to_agent.name),
                 None,
             )
-            if ho:
-                fn = ho.on_invoke_handoff
-                fv = fn.__code__.co_freevars
-                cl = fn.__closure__ or []
-                if "on_handoff" in fv:
-                    idx = fv.index("on_handoff")
-                    if idx < len(cl) and cl[idx].cell_contents:
-                        cb = cl[idx].cell_contents
-                        cb_name = getattr(cb, "__name__", repr(cb))
-                        events.append(
-                            AgentEvent(
-                                id=uuid4().hex,
-                                type="tool_call",
-                                agent=to_agent.name,
-                                content=cb_name,
-                            )
-                        )
+            if ho and ho.on_handoff:
+                events.append(
+                    AgentEvent(
+                        id=uuid4().hex,
+                        type="tool_call",
+                        agent=to_agent.name,
+                        content=getattr(ho.on_handoff, "__name__", repr(ho.on_handoff)),
+                    )
+                )
             current_agent = item.target_agent
         elif isinstance(item, ToolCallItem):
             tool_name = getattr(item.raw_item, "name", None)
@@ -339,7 +417,6 @@ async def chat_endpoint(req: ChatRequest):
             tool_args: Any = raw_args
             if isinstance(raw_args, str):
                 try:
-                    import json
                     tool_args = json.loads(raw_args)
                 except Exception:
                     pass
@@ -370,6 +447,24 @@ async def chat_endpoint(req: ChatRequest):
                     metadata={"tool_result": item.output},
                 )
             )
+    return current_agent
+
+async def _finish_turn(
+    conversation_id: str,
+    state: Dict[str, Any],
+    current_agent,
+    result,
+    old_context: Dict[str, Any],
+    message: str,
+    routed_events: Optional[List[AgentEvent]] = None,
+) -> ChatResponse:
+    """处理运行结果、保存会话状态并构建响应；routed_events是意图路由在运行前产生的转接事件。"""
+    started = time.perf_counter()
+    messages: List[MessageResponse] = []
+    events: List[AgentEvent] = []
+    start_agent = current_agent
+
+    current_agent = _process_items(result.new_items, current_agent, messages, events)
 
     new_context = state["context"].dict()
     changes = {k: new_context[k] for k in new_context if old_context.get(k) != new_context[k]}
@@ -384,33 +479,445 @@ async def chat_endpoint(req: ChatRequest):
             )
         )
 
-    state["input_items"] = result.to_input_list()
+    input_items = ItemHelpers.to_input_items(result.new_items)
+    _remember_faq_answer(start_agent, current_agent, message, messages, events)
+    state["input_items"].extend(input_items)
     state["current_agent"] = current_agent.name
-    conversation_store.save(conversation_id, state)
-
-    # 构建守卫结果：标记失败（如果有），其他标记为通过
-    final_guardrails: List[GuardrailCheck] = []
-    for g in getattr(current_agent, "input_guardrails", []):
-        name = _get_guardrail_name(g)
-        failed = next((gc for gc in guardrail_checks if gc.name == name), None)
-        if failed:
-            final_guardrails.append(failed)
-        else:
-            final_guardrails.append(GuardrailCheck(
-                id=uuid4().hex,
-                name=name,
-                input=req.message,
-                reasoning="",
-                passed=True,
-                timestamp=time.time() * 1000,
-            ))
+    # 构建响应的耗时不包括保存会话（单独计入store阶段）
+    build_seconds = time.perf_counter() - started
+    await conversation_store.save(conversation_id, state)
+    history_manager.schedule_summary(conversation_id, state)
 
-    return ChatResponse(
+    started = time.perf_counter() - build_seconds
+    response = ChatResponse(
         conversation_id=conversation_id,
         current_agent=current_agent.name,
         messages=messages,
-        events=events,
+        events=(routed_events or []) + events,
+        context=state["context"].dict(),
+        agents=AGENT_CATALOG,
+        agents_version=AGENTS_VERSION,
+        guardrails=_passed_guardrails(current_agent, message),
+    )
+    metrics.observe_stage("build", metrics.RESPONSE_BUILD_SECONDS, started)
+    return response
+
+def _passed_guardrails(agent, message: str) -> List[GuardrailCheck]:
+    """构建守卫结果：所有守卫均已通过。"""
+    return [
+        GuardrailCheck(
+            id=uuid4().hex,
+            name=_get_guardrail_name(g),
+            input=message,
+            reasoning="",
+            passed=True,
+            timestamp=time.time() * 1000,
+        )
+        for g in getattr(agent, "input_guardrails", [])
+    ]
+
+# =========================
+# 意图快速路由
+# =========================
+
+_INTENT_AGENTS = {
+    "seat_booking": seat_booking_agent,
+    "flight_status": flight_status_agent,
+    "cancellation": cancellation_agent,
+    "faq": faq_agent,
+}
+
+async def _route_by_intent(state: Dict[str, Any], current_agent, message: str):
+    """
+    当前代理是分流代理且本地意图分类有把握时，跳过分流代理的LLM调用，直接转接到专门代理。
+    返回(本轮实际运行的代理, 转接事件列表)；没有路由时原样返回当前代理。
+    """
+    if current_agent is not triage_agent:
+        return current_agent, []
+    prediction = intent_router.route(message)
+    if prediction is None:
+        return current_agent, []
+    target = _INTENT_AGENTS[prediction.intent]
+    metrics.count_handoff(triage_agent.name, target.name, "intent_router")
+    ho = next((h for h in triage_agent.handoffs if isinstance(h, Handoff) and h.agent is target), None)
+    events = [
+        AgentEvent(
+            id=uuid4().hex,
+            type="handoff",
+            agent=triage_agent.name,
+            content=f"{triage_agent.name} -> {target.name}",
+            metadata={
+                "source_agent": triage_agent.name,
+                "target_agent": target.name,
+                "intent": prediction.intent,
+                "confidence": round(prediction.confidence, 4),
+            },
+        )
+    ]
+    if ho is not None and ho.on_handoff:
+        # 与分流代理自己转接时一样执行转接回调，并显示为工具调用
+        outcome = ho.on_invoke_handoff(RunContextWrapper(state["context"]))
+        if inspect.isawaitable(outcome):
+            await outcome
+        events.append(AgentEvent(
+            id=uuid4().hex,
+            type="tool_call",
+            agent=target.name,
+            content=getattr(ho.on_handoff, "__name__", repr(ho.on_handoff)),
+        ))
+    return target, events
+
+# =========================
+# FAQ答案缓存
+# =========================
+
+def _remember_faq_answer(
+    start_agent,
+    end_agent,
+    message: str,
+    messages: List[MessageResponse],
+    events: List[AgentEvent],
+) -> None:
+    """
+    FAQ代理直接作答（没有转接），且回复原样就是faq_lookup_tool对该问题给出的FAQ条目答案时，
+    记录该问题可由这个条目回答。模型改写过的回复与会话的历史和上下文有关，不缓存。
+    """
+    if start_agent is not faq_agent or end_agent is not faq_agent or len(messages) != 1:
+        return
+    if any(e.type == "handoff" for e in events):
+        return
+    entry = lookup_faq(message)
+    if entry is None:
+        return
+    answer = entry.answer.strip()
+    tool_outputs = [e.content.strip() for e in events if e.type == "tool_output"]
+    if tool_outputs == [answer] and messages[0].content.strip() == answer:
+        faq_answer_cache.put(message, entry)
+
+async def _cached_faq_response(
+    conversation_id: str, state: Dict[str, Any], current_agent, message: str
+) -> Optional[ChatResponse]:
+    """
+    当前代理是FAQ代理且问题命中答案缓存时，不调用FAQ代理的模型，直接用FAQ条目的答案作答。
+    输入守卫照常执行，触发时抛出InputGuardrailTripwireTriggered。
+    """
+    if current_agent is not faq_agent:
+        return None
+    entry = faq_answer_cache.get(message)
+    if entry is None:
+        return None
+    results = await Runner.check_input_guardrails(current_agent, message, state["context"])
+
+    # 与FAQ代理调用faq_lookup_tool后原样回复时写入历史的条目相同
+    call_id = f"call_{uuid4().hex[:24]}"
+    args = {"question": message}
+    state["input_items"].extend([
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "id": call_id,
+                "type": "function",
+                "function": {"name": "faq_lookup_tool", "arguments": json.dumps(args, ensure_ascii=False)},
+            }],
+        },
+        {"role": "tool", "tool_call_id": call_id, "content": entry.answer},
+        {"role": "assistant", "content": entry.answer},
+    ])
+    await conversation_store.save(conversation_id, state)
+    history_manager.schedule_summary(conversation_id, state)
+    now = time.time() * 1000
+    return ChatResponse(
+        conversation_id=conversation_id,
+        current_agent=current_agent.name,
+        messages=[MessageResponse(content=entry.answer, agent=current_agent.name)],
+        events=[
+            AgentEvent(id=uuid4().hex, type="tool_call", agent=current_agent.name, content="faq_lookup_tool",
+                       metadata={"tool_args": args}, timestamp=now),
+            AgentEvent(id=uuid4().hex, type="tool_output", agent=current_agent.name, content=entry.answer,
+                       metadata={"tool_result": entry.answer}, timestamp=now),
+            AgentEvent(id=uuid4().hex, type="message", agent=current_agent.name, content=entry.answer, timestamp=now),
+        ],
         context=state["context"].dict(),
-        agents=_build_agents_list(),
-        guardrails=final_guardrails,
+        agents=AGENT_CATALOG,
+        agents_version=AGENTS_VERSION,
+        guardrails=[
+            GuardrailCheck(
+                id=uuid4().hex,
+                name=_get_guardrail_name(result.guardrail),
+                input=message,
+                reasoning="",
+                passed=True,
+                timestamp=now,
+            )
+            for result in results
+        ],
+    )
+
+# =========================
+# 主聊天端点
+# =========================
+
+# 同一会话的轮次串行执行；重复提交的相同请求共享同一次执行
+conversation_locks = ConversationLockTable()
+chat_coalescer = RequestCoalescer()
+
+# 启用会话亲和时，不属于本节点的会话转发给所属节点；带此请求头的请求已被转发过，不再转发
+_FORWARDED_HEADER = "X-Forwarded-Node"
+_forward_client = httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=2.0))
+
+def _set_affinity_header(response: Response, conversation_id: Optional[str]) -> None:
+    """启用会话亲和时，告诉负载均衡器该会话归哪个节点处理。"""
+    owner = getattr(conversation_store, "owner", None)
+    if owner is not None and conversation_id:
+        response.headers["X-Conversation-Node"] = owner(conversation_id)
+
+def _forward_target(request: Request, req: ChatRequest) -> Optional[str]:
+    forward_url = getattr(conversation_store, "forward_url", None)
+    if forward_url is None or not req.conversation_id or request.headers.get(_FORWARDED_HEADER):
+        return None
+    return forward_url(req.conversation_id)
+
+def _response_for(req: ChatRequest, response: ChatResponse) -> Union[ChatResponse, ChatDeltaResponse]:
+    """请求delta时把完整响应转换为增量响应。"""
+    if not req.delta:
+        return response
+    if response.conversation_id != req.conversation_id:
+        # 新建的会话（包括已过期后重建的）：客户端还没有任何上下文
+        changes = response.context
+    else:
+        changes = {}
+        for event in response.events:
+            if event.type == "context_update":
+                changes.update(event.metadata["changes"])
+    return ChatDeltaResponse(
+        conversation_id=response.conversation_id,
+        current_agent=response.current_agent,
+        messages=response.messages,
+        events=response.events,
+        context_changes=changes,
+        agents_version=AGENTS_VERSION,
+        guardrails=[check for check in response.guardrails if not check.passed],
     )
+
+@app.post("/chat", response_model=Union[ChatResponse, ChatDeltaResponse])
+async def chat_endpoint(req: ChatRequest, request: Request, response: Response):
+    """
+    代理编排的主聊天端点。
+    处理会话状态、代理路由和守卫检查。
+    响应带Server-Timing头，给出本轮各阶段（store、guardrail、llm、tool、run、build等）的累计耗时。
+    """
+    started = time.perf_counter()
+    timings = metrics.collect_stage_timings()
+    target = _forward_target(request, req)
+    if target:
+        try:
+            upstream = await _forward_client.post(
+                f"{target}/chat", json=req.model_dump(), headers={_FORWARDED_HEADER: conversation_store.node}
+            )
+            forwarded = Response(upstream.content, status_code=upstream.status_code, media_type="application/json")
+            _set_affinity_header(forwarded, req.conversation_id)
+            return forwarded
+        except httpx.TransportError:
+            # 所属节点不可达时由本节点经共享层处理
+            logger.warning("转发到%s失败，改由本节点处理", target)
+
+    if not req.conversation_id:
+        result = await _chat_turn(req)
+    else:
+        result = await chat_coalescer.run((req.conversation_id, req.message), lambda: _locked_chat_turn(req))
+    _set_affinity_header(response, result.conversation_id)
+    if metrics.registry.enabled:
+        timings["total"] = time.perf_counter() - started
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+    return _response_for(req, result)
+
+async def _locked_chat_turn(req: ChatRequest) -> ChatResponse:
+    async with conversation_locks.hold(req.conversation_id):
+        return await _chat_turn(req)
+
+async def _chat_turn(req: ChatRequest) -> ChatResponse:
+    """执行一轮对话：读取会话状态、运行代理并保存结果。"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        conversation_id, state, is_new = await _load_or_create_state(req)
+        # 本轮（包括守卫和后台摘要）的上游用量记在该会话上
+        bind_conversation(conversation_id)
+        if is_new and req.message.strip() == "":
+            outcome = "empty"
+            return await _empty_response(conversation_id, state)
+
+        current_agent = _get_agent_by_name(state["current_agent"])
+        state["input_items"].append({"content": req.message, "role": "user"})
+        old_context = state["context"].model_dump().copy()
+
+        try:
+            usage_ledger.check_budget(conversation_id)
+            cached = await _cached_faq_response(conversation_id, state, current_agent, req.message)
+            if cached is not None:
+                outcome = "faq_cache"
+                return cached
+            agent, routed_events = await _route_by_intent(state, current_agent, req.message)
+            window = history_manager.window(conversation_id, agent, state)
+            result = await Runner.run(agent, window, context=state["context"])
+        except InputGuardrailTripwireTriggered as e:
+            outcome = "guardrail_tripped"
+            return await _guardrail_refusal(conversation_id, state, current_agent, req.message, e, old_context)
+        except TokenBudgetExceeded as e:
+            outcome = "budget_exceeded"
+            return await _budget_refusal(conversation_id, state, current_agent, e, old_context)
+        except UpstreamError:
+            outcome = "upstream_error"
+            _discard_turn(state, old_context)
+            raise
+
+        response = await _finish_turn(conversation_id, state, agent, result, old_context, req.message, routed_events)
+        outcome = "ok"
+        return response
+    finally:
+        metrics.observe_stage("turn", metrics.CHAT_TURN_SECONDS, started, "chat", outcome)
+
+# =========================
+# 流式聊天端点
+# =========================
+
+def _sse(event: str, data: Any) -> str:
+    """编码一条Server-Sent Events消息。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest, request: Request):
+    """
+    流式聊天端点（SSE）。
+    依次推送message_delta、guardrail、handoff、tool_call、tool_output等事件，
+    最后以done事件返回与/chat相同结构的完整ChatResponse。
+    """
+    target = _forward_target(request, req)
+
+    async def event_source():
+        if target:
+            started = False
+            try:
+                async with _forward_client.stream(
+                    "POST", f"{target}/chat/stream",
+                    json=req.model_dump(), headers={_FORWARDED_HEADER: conversation_store.node},
+                ) as upstream:
+                    async for chunk in upstream.aiter_raw():
+                        started = True
+                        yield chunk
+                return
+            except httpx.TransportError:
+                if started:
+                    raise
+                logger.warning("转发到%s失败，改由本节点处理", target)
+        # 持有会话锁直到整轮结束（包括客户端中途断开时）
+        async with conversation_locks.hold(req.conversation_id):
+            async for chunk in _stream_turn(req):
+                yield chunk
+
+    response = StreamingResponse(event_source(), media_type="text/event-stream")
+    _set_affinity_header(response, req.conversation_id)
+    return response
+
+async def _stream_turn(req: ChatRequest) -> AsyncIterator[str]:
+    """执行一轮流式对话，逐条产出SSE消息；整轮耗时按结束方式计入cs_chat_turn_seconds。"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        conversation_id, state, is_new = await _load_or_create_state(req)
+        bind_conversation(conversation_id)
+        if is_new and req.message.strip() == "":
+            outcome = "empty"
+            yield _sse("done", _response_for(req, await _empty_response(conversation_id, state)).model_dump())
+            return
+
+        current_agent = _get_agent_by_name(state["current_agent"])
+        state["input_items"].append({"content": req.message, "role": "user"})
+        old_context = state["context"].model_dump().copy()
+
+        try:
+            usage_ledger.check_budget(conversation_id)
+            cached = await _cached_faq_response(conversation_id, state, current_agent, req.message)
+        except TokenBudgetExceeded as e:
+            outcome = "budget_exceeded"
+            yield _sse("done", _response_for(req, await _budget_refusal(conversation_id, state, current_agent, e, old_context)).model_dump())
+            return
+        except InputGuardrailTripwireTriggered as e:
+            outcome = "guardrail_tripped"
+            response = await _guardrail_refusal(conversation_id, state, current_agent, req.message, e, old_context)
+            yield _sse("done", _response_for(req, response).model_dump())
+            return
+        except UpstreamError as e:
+            outcome = "upstream_error"
+            _discard_turn(state, old_context)
+            yield _sse("error", {"error": e.kind, "message": str(e), "retry_after": e.retry_after})
+            return
+        if cached is not None:
+            outcome = "faq_cache"
+            for check in cached.guardrails:
+                yield _sse("guardrail", check.model_dump())
+            for event in cached.events:
+                if event.type != "message":
+                    yield _sse(event.type, event.model_dump())
+            for message in cached.messages:
+                yield _sse("message_delta", {"agent": message.agent, "delta": message.content})
+            yield _sse("done", _response_for(req, cached).model_dump())
+            return
+
+        agent, routed_events = await _route_by_intent(state, current_agent, req.message)
+        # 意图路由的转接事件等守卫通过（模型的第一个事件到达）后再推送，守卫触发时整轮不生效
+        unsent_routed = list(routed_events)
+        window = history_manager.window(conversation_id, agent, state)
+        streamed = Runner.run_streamed(agent, window, context=state["context"])
+        try:
+            async for event in streamed.stream_events():
+                if unsent_routed and event.type != "guardrail_result":
+                    for routed in unsent_routed:
+                        yield _sse(routed.type, routed.model_dump())
+                    unsent_routed.clear()
+                if event.type == "message_delta":
+                    yield _sse("message_delta", {"agent": event.agent.name, "delta": event.delta})
+                elif event.type == "guardrail_result":
+                    output = event.item.output
+                    yield _sse("guardrail", GuardrailCheck(
+                        id=uuid4().hex,
+                        name=_get_guardrail_name(event.item.guardrail),
+                        input=req.message,
+                        reasoning=getattr(output.output_info, "reasoning", "") if output.tripwire_triggered else "",
+                        passed=not output.tripwire_triggered,
+                        timestamp=time.time() * 1000,
+                    ).model_dump())
+                elif event.type == "run_item" and not isinstance(event.item, MessageOutputItem):
+                    item_events: List[AgentEvent] = []
+                    _process_items([event.item], event.agent, [], item_events)
+                    for item_event in item_events:
+                        yield _sse(item_event.type, item_event.model_dump())
+        except InputGuardrailTripwireTriggered as e:
+            outcome = "guardrail_tripped"
+            response = await _guardrail_refusal(conversation_id, state, current_agent, req.message, e, old_context)
+            yield _sse("done", _response_for(req, response).model_dump())
+            return
+        except TokenBudgetExceeded as e:
+            # 运行中途用量达到预算：丢弃本轮已产生的条目
+            outcome = "budget_exceeded"
+            yield _sse("done", _response_for(req, await _budget_refusal(conversation_id, state, current_agent, e, old_context)).model_dump())
+            return
+        except UpstreamError as e:
+            # 已推送的增量作废；客户端收到error事件后可以原样重试
+            outcome = "upstream_error"
+            _discard_turn(state, old_context)
+            yield _sse("error", {"error": e.kind, "message": str(e), "retry_after": e.retry_after})
+            return
+
+        response = await _finish_turn(
+            conversation_id, state, agent, streamed.to_result(), old_context, req.message, routed_events
+        )
+        outcome = "ok"
+        yield _sse("done", _response_for(req, response).model_dump())
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端中途断开
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.observe_stage("turn", metrics.CHAT_TURN_SECONDS, started, "stream", outcome)
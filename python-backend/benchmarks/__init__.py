@@ -0,0 +1 @@
+# 性能基准测试脚本，从python-backend目录以 python -m benchmarks.<名称> 运行
@@ -0,0 +1,285 @@
+"""
+端到端负载测试：在子进程中启动LLM模拟器和api:app，由大量并发的模拟客户按多轮航空客服脚本
+调用/chat和/chat/stream，报告每秒轮次、各阶段延迟分位数、每轮上游调用次数和每千会话的内存增长，
+并把结果写入JSON文件，可与之前的结果对比以发现性能回退。
+
+用法（在python-backend目录下）：
+    python -m benchmarks.bench_chat --conversations 500 --concurrency 64 --profile fast --output results.json
+    python -m benchmarks.bench_chat --profile fast --compare results.json --max-regression 10
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+# 多轮客户脚本：(名称, 依次发送的消息)
+SCRIPTS = [
+    ("seat_change", ["我能换座位吗？", "请帮我换到14C", "谢谢"]),
+    ("flight_status", ["我的航班状态怎么样？", "航班号是FLT-123"]),
+    ("cancellation", ["我想取消航班", "确认取消"]),
+    ("faq", ["行李限额是多少", "飞机上有WiFi吗"]),
+    ("mixed", ["你好", "行李限额是多少", "我想换座位", "12A"]),
+    ("off_topic", ["你好", "帮我写一首诗"]),
+]
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _start(args: List[str], env: Dict[str, str], health_url: str, log_path: str) -> subprocess.Popen:
+    # 子进程的输出写入日志文件，不混入报告
+    with open(log_path, "wb") as log:
+        proc = subprocess.Popen([sys.executable, *args], env=env, stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise RuntimeError(f"{' '.join(args)} 启动失败，见{log_path}")
+        try:
+            httpx.get(health_url)
+            return proc
+        except httpx.TransportError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"{' '.join(args)} 启动超时")
+
+def _rss_kb(pid: int) -> int:
+    """读取进程的常驻内存（Linux /proc）。"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 2),
+        "p50": round(pick(50), 2),
+        "p90": round(pick(90), 2),
+        "p99": round(pick(99), 2),
+        "max": round(ordered[-1], 2),
+    }
+
+class Recorder:
+    """收集各阶段的延迟样本（毫秒）与错误。"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.turns = 0
+        self.conversations = 0
+        self.errors: Dict[str, int] = {}
+
+    def add(self, stage: str, ms: float) -> None:
+        self.samples.setdefault(stage, []).append(ms)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+async def _chat_turn(client: httpx.AsyncClient, body: Dict[str, Any], rec: Recorder) -> Optional[str]:
+    start = time.perf_counter()
+    response = await client.post("/chat", json=body)
+    rec.add("chat_total", (time.perf_counter() - start) * 1000)
+    if response.status_code != 200:
+        rec.error(f"http_{response.status_code}")
+        return None
+    # 服务端在Server-Timing头中给出的各阶段耗时
+    for entry in response.headers.get("server-timing", "").split(","):
+        stage, _, duration = entry.strip().partition(";dur=")
+        if duration:
+            rec.add(f"server_{stage}", float(duration))
+    return response.json()["conversation_id"]
+
+async def _stream_turn(client: httpx.AsyncClient, body: Dict[str, Any], rec: Recorder) -> Optional[str]:
+    start = time.perf_counter()
+    first_event = first_token = None
+    done: Optional[Dict[str, Any]] = None
+    async with client.stream("POST", "/chat/stream", json=body) as response:
+        if response.status_code != 200:
+            rec.error(f"http_{response.status_code}")
+            return None
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[7:]
+                if first_event is None:
+                    first_event = time.perf_counter()
+            elif line.startswith("data: "):
+                if event == "message_delta" and first_token is None:
+                    first_token = time.perf_counter()
+                elif event == "done":
+                    done = json.loads(line[6:])
+    end = time.perf_counter()
+    rec.add("stream_first_event", (first_event - start) * 1000 if first_event else (end - start) * 1000)
+    if first_token is not None:
+        rec.add("stream_first_token", (first_token - start) * 1000)
+    rec.add("stream_total", (end - start) * 1000)
+    if done is None:
+        rec.error("stream_incomplete")
+        return None
+    return done["conversation_id"]
+
+async def _customer(client: httpx.AsyncClient, script: List[str], stream: bool, think_ms: float, rec: Recorder) -> None:
+    conversation_id = None
+    turn = _stream_turn if stream else _chat_turn
+    for i, message in enumerate(script):
+        if i and think_ms:
+            await asyncio.sleep(think_ms / 1000)
+        try:
+            conversation_id = await turn(client, {"conversation_id": conversation_id, "message": message}, rec)
+        except httpx.HTTPError as e:
+            rec.error(type(e).__name__)
+            return
+        if conversation_id is None:
+            return
+        rec.turns += 1
+    rec.conversations += 1
+
+async def _drive(base_url: str, conversations: int, concurrency: int, mode: str, think_ms: float, seed: int) -> Recorder:
+    rng = random.Random(seed)
+    rec = Recorder()
+    slots = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120.0) as client:
+        async def one(i: int):
+            _, script = SCRIPTS[i % len(SCRIPTS)]
+            stream = mode == "stream" or (mode == "both" and rng.random() < 0.5)
+            async with slots:
+                await _customer(client, script, stream, think_ms, rec)
+        await asyncio.gather(*(one(i) for i in range(conversations)))
+    return rec
+
+# 对比时关注的指标：(路径, 越大越好)
+_COMPARED = [
+    (("turns_per_sec",), True),
+    (("upstream_calls_per_turn",), False),
+    (("rss_growth_kb_per_1k_conversations",), False),
+] + [
+    (("latency_ms", stage, pct), False)
+    for stage in ("chat_total", "stream_first_token", "stream_total")
+    for pct in ("p50", "p99")
+]
+
+def _lookup(data: Dict[str, Any], path) -> Optional[float]:
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], max_regression: Optional[float]) -> bool:
+    """打印与基线的差异；有指标变差超过max_regression（百分比）时返回False。"""
+    ok = True
+    print("\n与基线对比：")
+    for path, higher_is_better in _COMPARED:
+        new, old = _lookup(current, path), _lookup(baseline, path)
+        if new is None or old is None or old == 0:
+            continue
+        change = (new - old) / abs(old) * 100
+        worse = -change if higher_is_better else change
+        flag = ""
+        if max_regression is not None and worse > max_regression:
+            flag, ok = "  <-- 回退", False
+        print(f"  {'.'.join(path):40s} {old:>10.2f} -> {new:>10.2f}  ({change:+.1f}%){flag}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mode", choices=["chat", "stream", "both"], default="both")
+    parser.add_argument("--profile", default="fast", help="LLM模拟器的延迟配置")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--think-ms", type=float, default=0.0, help="客户两轮之间的停顿")
+    parser.add_argument("--warmup", type=int, default=20, help="计时前先跑的会话数")
+    parser.add_argument("--output", help="写入结果的JSON文件")
+    parser.add_argument("--compare", help="作为基线的结果文件")
+    parser.add_argument("--max-regression", type=float, help="任一指标变差超过该百分比时以非零状态退出")
+    args = parser.parse_args()
+
+    sim_port, api_port = _free_port(), _free_port()
+    env = {**os.environ, "LLM_SIM_PROFILE": args.profile, "LLM_SIM_SEED": str(args.seed)}
+    log_dir = tempfile.mkdtemp(prefix="bench_chat_")
+    simulator = _start(
+        ["-m", "llm_simulator", "--port", str(sim_port)], env,
+        f"http://127.0.0.1:{sim_port}/stats", os.path.join(log_dir, "simulator.log"),
+    )
+    api_env = {
+        **env,
+        "DEEPSEEK_DEV_MODE": "false",
+        "DASHSCOPE_API_KEY": "bench",
+        "DEEPSEEK_BASE_URL": f"http://127.0.0.1:{sim_port}/v1",
+    }
+    api = _start(
+        ["-m", "uvicorn", "api:app", "--port", str(api_port), "--log-level", "warning"],
+        api_env, f"http://127.0.0.1:{api_port}/stats", os.path.join(log_dir, "api.log"),
+    )
+    base_url = f"http://127.0.0.1:{api_port}"
+    try:
+        asyncio.run(_drive(base_url, args.warmup, args.concurrency, args.mode, 0.0, args.seed + 1))
+        rss_before = _rss_kb(api.pid)
+        calls_before = httpx.get(f"http://127.0.0.1:{sim_port}/stats").json()["requests"]
+        start = time.perf_counter()
+        rec = asyncio.run(_drive(base_url, args.conversations, args.concurrency, args.mode, args.think_ms, args.seed))
+        elapsed = time.perf_counter() - start
+        rss_after = _rss_kb(api.pid)
+        simulator_stats = httpx.get(f"http://127.0.0.1:{sim_port}/stats").json()
+        server_stats = httpx.get(f"{base_url}/stats").json()
+    finally:
+        for proc in (api, simulator):
+            proc.terminate()
+            proc.wait()
+
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "max_regression")},
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "duration_sec": round(elapsed, 3),
+        "conversations": rec.conversations,
+        "turns": rec.turns,
+        "errors": rec.errors,
+        "turns_per_sec": round(rec.turns / elapsed, 2),
+        "latency_ms": {stage: _percentiles(samples) for stage, samples in sorted(rec.samples.items())},
+        "upstream_calls_per_turn": round((simulator_stats["requests"] - calls_before) / max(rec.turns, 1), 3),
+        "rss_kb_before": rss_before,
+        "rss_kb_after": rss_after,
+        "rss_growth_kb_per_1k_conversations": round((rss_after - rss_before) * 1000 / max(rec.conversations, 1), 1),
+        "server_stats": server_stats,
+    }
+
+    print(f"{rec.conversations} 个会话，{rec.turns} 轮，用时 {elapsed:.1f}s：{results['turns_per_sec']} 轮/秒，"
+          f"每轮上游调用 {results['upstream_calls_per_turn']} 次，错误 {rec.errors or '无'}")
+    for stage, summary in results["latency_ms"].items():
+        print(f"  {stage:20s} p50 {summary['p50']:>8.1f}ms  p90 {summary['p90']:>8.1f}ms  p99 {summary['p99']:>8.1f}ms")
+    print(f"  内存：{rss_before / 1024:.1f}MB -> {rss_after / 1024:.1f}MB，"
+          f"每千会话增长 {results['rss_growth_kb_per_1k_conversations'] / 1024:.1f}MB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+SQLite会话存储基准：写后批量保存的吞吐，以及库中已有大量会话时get()的延迟分布。
+
+用法（在python-backend目录下）：
+    DEEPSEEK_DEV_MODE=true python -m benchmarks.bench_conversation_store --conversations 100000 --gets 20000
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from conversation_store import SQLiteConversationStore
+from main import AirlineAgentContext
+
+
+def _make_state(i: int) -> dict:
+    ctx = AirlineAgentContext(
+        account_number=str(10000000 + i),
+        confirmation_number=f"C{i:05d}",
+        flight_number=f"FLT-{i % 900 + 100}",
+    )
+    return {
+        "current_agent": "座位预订代理",
+        "context": ctx,
+        "input_items": [
+            {"role": "user", "content": "我能换座位吗？"},
+            {"role": "assistant", "content": "欢迎使用座位预订服务。为了帮您更换座位，请提供您的确认号码。"},
+            {"role": "user", "content": f"我的确认号是C{i:05d}，请换到23A"},
+            {"role": "assistant", "content": "您的座位已成功更改。如果您需要进一步帮助，请随时询问！"},
+        ],
+    }
+
+
+def _percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def _main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteConversationStore(os.path.join(tmp, "bench.db"), AirlineAgentContext)
+        await store.start()
+        ids = [f"conv-{i:08d}" for i in range(args.conversations)]
+        states = [_make_state(i) for i in range(args.conversations)]
+
+        start = time.perf_counter()
+        for conversation_id, state in zip(ids, states):
+            await store.save(conversation_id, state)
+            if store.saves % args.yield_every == 0:
+                await asyncio.sleep(0)
+        accepted = time.perf_counter() - start
+        await store.flush()
+        durable = time.perf_counter() - start
+        print(f"保存 {args.conversations} 个会话：受理 {args.conversations / accepted:,.0f} 次/秒，"
+              f"全部落盘 {args.conversations / durable:,.0f} 次/秒（{store.flushes} 批）")
+        db_path = os.path.join(tmp, "bench.db")
+        # WAL模式下尚未检查点的写入在-wal文件中
+        db_size = sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+        print(f"数据库大小（含WAL） {db_size / 1e6:.1f}MB")
+
+        rng = random.Random(0)
+
+        async def timed_get(conversation_id: str) -> float:
+            t0 = time.perf_counter()
+            state = await store.get(conversation_id)
+            assert state is not None
+            return (time.perf_counter() - t0) * 1000
+
+        for concurrency in args.concurrency:
+            latencies: list[float] = []
+            start = time.perf_counter()
+            for _ in range(args.gets // concurrency):
+                batch = [rng.choice(ids) for _ in range(concurrency)]
+                latencies.extend(await asyncio.gather(*(timed_get(c) for c in batch)))
+            elapsed = time.perf_counter() - start
+            print(f"get() 并发{concurrency:>3}：{len(latencies) / elapsed:,.0f} 次/秒，"
+                  f"p50 {statistics.median(latencies):.3f}ms，p99 {_percentile(latencies, 99):.3f}ms")
+
+        await store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=100_000)
+    parser.add_argument("--gets", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--yield-every", type=int, default=100, help="每保存多少次让出一次事件循环，使后台落盘任务运行")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
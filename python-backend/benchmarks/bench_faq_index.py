@@ -0,0 +1,81 @@
+"""
+FAQ倒排索引基准：在合成的大规模知识库上测量构建耗时、索引文件mmap加载耗时和检索吞吐。
+
+用法（在python-backend目录下）：
+    python -m benchmarks.bench_faq_index --entries 10000 --queries 20000
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from faq_index import FaqEntry, FaqIndex, load_faq_entries
+from faq import FAQ_DATA_PATH
+
+_SUBJECTS = [
+    "行李", "托运行李", "手提行李", "座位", "安全出口排", "经济舱", "商务舱", "WiFi", "机上餐食", "宠物",
+    "婴儿车", "值机", "登机牌", "改签", "退票", "里程", "会员", "中转", "延误", "贵宾室",
+    "baggage", "seat", "meal", "pet", "check-in", "refund", "upgrade", "lounge", "stroller", "delay",
+]
+_ASPECTS = ["限额", "费用", "规定", "时间", "流程", "尺寸", "重量", "数量", "条件", "补偿"]
+_ROUTES = ["国内航线", "国际航线", "北京", "上海", "广州", "成都", "东京", "新加坡", "伦敦", "悉尼"]
+_QUESTIONS = ["{s}的{a}是多少？", "{r}的{s}{a}有什么要求？", "请问{s}{a}怎么规定？", "What is the {s} {a} on {r}?"]
+
+def _synthetic_entries(count: int, rng: random.Random) -> list:
+    entries = load_faq_entries(FAQ_DATA_PATH)
+    while len(entries) < count:
+        s, a, r = rng.choice(_SUBJECTS), rng.choice(_ASPECTS), rng.choice(_ROUTES)
+        question = rng.choice(_QUESTIONS).format(s=s, a=a, r=r)
+        entries.append(FaqEntry(
+            id=f"faq-{len(entries)}",
+            question=question,
+            keywords=(s, a, r),
+            answer=f"关于{r}{s}的{a}：请以航空公司最新公布的规定为准，条目编号{len(entries)}。",
+        ))
+    return entries
+
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=20_000)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    entries = _synthetic_entries(args.entries, rng)
+    start = time.perf_counter()
+    index = FaqIndex.build(entries)
+    print(f"构建 {len(index)} 个条目的索引：{(time.perf_counter() - start) * 1000:.0f}ms，{len(index._terms)} 个词项")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "faq.idx")
+        index.save(path)
+        start = time.perf_counter()
+        index = FaqIndex.load(path)
+        print(f"mmap加载索引文件（{os.path.getsize(path) / 1e6:.1f}MB）：{(time.perf_counter() - start) * 1000:.0f}ms")
+
+        queries = [
+            rng.choice(["行李限额是多少", "飞机上有WiFi吗", "How many seats are on the plane?", "宠物托运费用"])
+            if i % 2 else rng.choice(entries).question
+            for i in range(args.queries)
+        ]
+        latencies = []
+        start = time.perf_counter()
+        for query in queries:
+            t0 = time.perf_counter()
+            index.search(query, k=args.top_k)
+            latencies.append((time.perf_counter() - t0) * 1e6)
+        elapsed = time.perf_counter() - start
+        print(f"检索 top-{args.top_k}：{len(queries) / elapsed:,.0f} 次/秒，"
+              f"p50 {statistics.median(latencies):.0f}µs，p99 {_percentile(latencies, 99):.0f}µs")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+意图快速路由评估：在标注数据上做留一法交叉验证，并在留出集上检验，统计不同阈值下的直接路由、误路由和回退比例，
+并测量分类耗时。
+
+用法（在python-backend目录下）：
+    python -m benchmarks.bench_intent_router --thresholds 0.7 0.8 0.9
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+from intent_router import INTENT_DATA_PATH, INTENT_HELDOUT_PATH, OTHER_INTENT, IntentRouter, load_examples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=INTENT_DATA_PATH)
+    parser.add_argument("--heldout", default=INTENT_HELDOUT_PATH, help="不参与训练的留出集")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.7, 0.8, 0.9])
+    parser.add_argument("--iterations", type=int, default=20_000)
+    args = parser.parse_args()
+
+    examples = load_examples(args.data)
+
+    # 每条样本用其余样本训练出的模型预测一次
+    predictions = []
+    for i, example in enumerate(examples):
+        router = IntentRouter()
+        router.train((e["text"], e["intent"]) for j, e in enumerate(examples) if j != i)
+        predictions.append((example, router.predict(example["text"])))
+
+    print(f"{len(examples)} 条标注样本，留一法：")
+    for threshold in args.thresholds:
+        routed = wrong = 0
+        for example, prediction in predictions:
+            if prediction is None or prediction.intent == OTHER_INTENT or prediction.confidence < threshold:
+                continue
+            routed += 1
+            wrong += prediction.intent != example["intent"]
+        print(f"  阈值 {threshold:.2f}：直接路由 {routed / len(examples):.0%}，"
+              f"其中误路由 {wrong}（{(wrong / routed) if routed else 0:.1%}），其余回退到分流代理")
+
+    router = IntentRouter.from_file(args.data)
+    heldout = load_examples(args.heldout)
+    print(f"{len(heldout)} 条留出样本：")
+    for threshold in args.thresholds:
+        report = router.evaluate(heldout, threshold)
+        print(f"  阈值 {threshold:.2f}：直接路由 {report['routed'] / len(heldout):.0%}，"
+              f"其中误路由 {len(report['misrouted'])}（{1 - report['precision']:.1%}）")
+        for text, expected, predicted, confidence in report["misrouted"]:
+            print(f"    {text}：应为{expected}，路由到{predicted}（{confidence:.2f}）")
+
+    texts = [e["text"] for e in examples]
+    start = time.perf_counter()
+    for i in range(args.iterations):
+        router.predict(texts[i % len(texts)])
+    elapsed = time.perf_counter() - start
+    print(f"分类耗时：平均 {elapsed / args.iterations * 1e6:.0f}µs/条")
+
+if __name__ == "__main__":
+    main()
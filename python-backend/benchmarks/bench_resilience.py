@@ -0,0 +1,122 @@
+"""
+上游容错测试：用注入故障的进程内LLM模拟器驱动DeepSeekClient，依次经历
+正常、限流、长尾超时、完全故障和恢复几个阶段，报告每个阶段的成功率、各类错误数、
+重试次数、熔断器状态和调用延迟，用于验证重试、Retry-After、单次调用时限和熔断器的行为。
+
+用法（在python-backend目录下）：
+    python -m benchmarks.bench_resilience
+    python -m benchmarks.bench_resilience --calls 400 --concurrency 16 --stream
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+os.environ.setdefault("DEEPSEEK_DEV_MODE", "true")
+
+from deepseek_agent import DeepSeekClient, UpstreamError
+from llm_simulator import LatencyProfile, LLMSimulator
+from resilience import ResilientCaller, RetryPolicy
+
+MESSAGES = [{"role": "system", "content": "你是航空公司的客服。"}, {"role": "user", "content": "我的航班状态怎么样？"}]
+
+# (阶段名称, 模拟器配置)
+PHASES = [
+    ("normal", LatencyProfile(ttft_ms=20, ttft_sigma=0.3)),
+    ("rate_limited", LatencyProfile(ttft_ms=20, ttft_sigma=0.3, rate_limit_rate=0.3, retry_after_ms=200)),
+    ("slow_tail", LatencyProfile(ttft_ms=20, ttft_sigma=0.3, tail_probability=0.1, tail_ms=4000)),
+    ("outage", LatencyProfile(ttft_ms=20, server_error_rate=1.0)),
+    ("recovery", LatencyProfile(ttft_ms=20, ttft_sigma=0.3)),
+]
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def _one_call(client: DeepSeekClient, stream: bool) -> None:
+    if stream:
+        async for _ in client.chat_completion_stream(MESSAGES, model="deepseek-v3"):
+            pass
+    else:
+        await client.chat_completion(MESSAGES, model="deepseek-v3")
+
+async def run_phase(client: DeepSeekClient, calls: int, concurrency: int, stream: bool) -> Dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    ok_latencies: List[float] = []
+    failed_latencies: List[float] = []
+    errors: Counter = Counter()
+    retries_before = client.resilience.retries
+
+    async def call():
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await _one_call(client, stream)
+                ok_latencies.append(time.perf_counter() - started)
+            except UpstreamError as e:
+                errors[e.kind] += 1
+                failed_latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(calls)))
+    breaker = client.resilience.breaker("deepseek-v3").stats()
+    return {
+        "seconds": time.perf_counter() - started,
+        "success_rate": len(ok_latencies) / calls,
+        "errors": dict(errors),
+        "retries": client.resilience.retries - retries_before,
+        "breaker": breaker["state"],
+        "trips": breaker["trips"],
+        "ok_p50_ms": _percentile(ok_latencies, 0.5) * 1000,
+        "ok_p99_ms": _percentile(ok_latencies, 0.99) * 1000,
+        "failed_mean_ms": statistics.fmean(failed_latencies) * 1000 if failed_latencies else 0.0,
+    }
+
+async def main_async(args) -> None:
+    simulator = LLMSimulator(PHASES[0][1], seed=args.seed)
+    resilience = ResilientCaller(
+        RetryPolicy(max_retries=args.max_retries, base_delay=0.05, max_delay=0.5, call_timeout=args.call_timeout),
+        failure_threshold=args.breaker_threshold,
+        recovery_timeout=args.breaker_recovery,
+    )
+    client = DeepSeekClient(dev_mode=True, simulator=simulator, resilience=resilience)
+    print(
+        f"{'阶段':<14}{'成功率':>8}{'重试':>7}{'熔断':>11}{'打开次数':>9}"
+        f"{'p50(ms)':>10}{'p99(ms)':>10}{'失败均值(ms)':>14}  错误"
+    )
+    try:
+        for name, profile in PHASES:
+            simulator.profile = profile
+            if name == "recovery":
+                # 等熔断器进入半开状态，由探测调用恢复
+                await asyncio.sleep(args.breaker_recovery)
+            result = await run_phase(client, args.calls, args.concurrency, args.stream)
+            print(
+                f"{name:<14}{result['success_rate']:>8.1%}{result['retries']:>7}{result['breaker']:>11}"
+                f"{result['trips']:>9}{result['ok_p50_ms']:>10.1f}{result['ok_p99_ms']:>10.1f}"
+                f"{result['failed_mean_ms']:>14.1f}  {result['errors']}"
+            )
+    finally:
+        await client.aclose()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200, help="每个阶段的调用次数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--stream", action="store_true", help="使用流式调用")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-retries", type=int, default=2)
+    parser.add_argument("--call-timeout", type=float, default=1.0, help="单次尝试的时限（秒）")
+    parser.add_argument("--breaker-threshold", type=int, default=5)
+    parser.add_argument("--breaker-recovery", type=float, default=1.0, help="熔断器打开后的等待（秒）")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+上游传输基准：对比旧的同步客户端与共享异步连接池。
+
+在子进程中启动一个固定延迟的本地OpenAI兼容服务器，然后以不同并发度
+模拟客户轮次（每轮 = 两次守卫调用 + 一次主模型调用，与Runner.run一致），
+报告单个事件循环（即单个uvicorn worker）每秒可完成的轮次。
+
+用法（在python-backend目录下）：
+    python -m benchmarks.bench_transport --latency-ms 200 --concurrency 1 8 32 128
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI
+from openai import OpenAI
+
+from deepseek_agent import DeepSeekClient, TransportConfig
+
+CALLS_PER_TURN = 3
+
+
+upstream_app = FastAPI()
+
+
+@upstream_app.post("/v1/chat/completions")
+async def completions(body: dict):
+    await asyncio.sleep(float(os.environ.get("BENCH_UPSTREAM_LATENCY", "0.1")))
+    return {
+        "id": "bench",
+        "object": "chat.completion",
+        "created": 0,
+        "model": body.get("model", "bench"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": "好的"},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+def _start_upstream(latency_s: float) -> tuple[subprocess.Popen, str]:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.bench_transport:upstream_app",
+         "--port", str(port), "--log-level", "error"],
+        env={**os.environ, "BENCH_UPSTREAM_LATENCY": str(latency_s)},
+    )
+    base_url = f"http://127.0.0.1:{port}/v1"
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs")
+            return proc, base_url
+        except httpx.TransportError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("本地上游服务器启动失败")
+
+
+class _BlockingClient:
+    """复现旧实现：在async方法中调用同步OpenAI客户端，且每个代理各自一个。"""
+
+    def __init__(self, base_url: str):
+        self.clients = [OpenAI(api_key="bench", base_url=base_url) for _ in range(CALLS_PER_TURN)]
+
+    async def turn(self):
+        for client in self.clients:
+            client.chat.completions.create(model="bench", messages=[{"role": "user", "content": "你好"}])
+
+
+class _PooledClient:
+    def __init__(self, base_url: str, max_connections: int):
+        transport = TransportConfig(base_url=base_url, max_connections=max_connections,
+                                    max_keepalive_connections=max_connections)
+        self.client = DeepSeekClient(api_key="bench", transport=transport)
+
+    async def turn(self):
+        for _ in range(CALLS_PER_TURN):
+            await self.client.chat_completion([{"role": "user", "content": "你好"}], model="bench")
+
+
+async def _measure(client, concurrency: int, turns: int) -> float:
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(turns):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            await client.turn()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return turns / (time.perf_counter() - start)
+
+
+async def _main(args):
+    proc, base_url = _start_upstream(args.latency_ms / 1000)
+    blocking = _BlockingClient(base_url)
+    pooled = _PooledClient(base_url, max(args.concurrency))
+    ideal = 1000 / (args.latency_ms * CALLS_PER_TURN)
+    print(f"上游延迟 {args.latency_ms}ms，每轮 {CALLS_PER_TURN} 次调用（单并发理论值 {ideal:.2f} 轮/秒）")
+    print(f"{'并发':>6} {'同步(轮/秒)':>14} {'异步池(轮/秒)':>16} {'加速比':>8}")
+    for concurrency in args.concurrency:
+        turns = max(concurrency * args.turns_per_worker, 4)
+        before = await _measure(blocking, concurrency, min(turns, args.max_blocking_turns))
+        after = await _measure(pooled, concurrency, turns)
+        print(f"{concurrency:>6} {before:>14.2f} {after:>16.2f} {after / before:>7.1f}x")
+    await pooled.client.aclose()
+    proc.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="模拟的上游延迟")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--turns-per-worker", type=int, default=2)
+    parser.add_argument("--max-blocking-turns", type=int, default=16,
+                        help="同步模式下的轮次上限（其吞吐与并发无关）")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, TypeVar
+
+R = TypeVar("R")
+
+class ConversationLockTable:
+    """
+    按会话串行化请求的锁表。
+    同一会话的轮次按到达顺序依次执行，不同会话之间完全并行。
+    锁按引用计数管理：最后一个持有/等待者离开时即从表中删除，
+    因此表的大小只取决于当前有请求在处理的会话数，不会随历史会话增长。
+    """
+
+    def __init__(self):
+        # conversation_id -> [锁, 持有和等待该锁的请求数]
+        self._entries: Dict[str, List[Any]] = {}
+        self.acquisitions = 0
+        self.contended = 0
+        self.peak_entries = 0
+
+    @asynccontextmanager
+    async def hold(self, conversation_id: Optional[str]) -> AsyncIterator[None]:
+        """持有会话锁；未指定会话（新会话）时无需加锁。"""
+        if not conversation_id:
+            yield
+            return
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            entry = self._entries[conversation_id] = [asyncio.Lock(), 0]
+            self.peak_entries = max(self.peak_entries, len(self._entries))
+        lock: asyncio.Lock = entry[0]
+        entry[1] += 1
+        if lock.locked():
+            self.contended += 1
+        try:
+            async with lock:
+                self.acquisitions += 1
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._entries[conversation_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._entries),
+            "peak": self.peak_entries,
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+        }
+
+class RequestCoalescer:
+    """
+    合并相同的在途请求：键相同的请求在第一个请求完成前到达时，不再重复执行，
+    而是等待并共享第一个请求的结果（包括异常）。
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[R]]) -> R:
+        task = self._in_flight.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.coalesced += 1
+        # 某个等待者被取消（如客户端断开）不应影响共享同一执行的其他请求
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # 所有等待者都已取消时没有人读取结果；在此取走异常，避免asyncio记录"Task exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+        }
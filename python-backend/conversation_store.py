@@ -0,0 +1,515 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# 会话状态的存储接口
+# =========================
+
+class ConversationStore:
+    """会话状态存储。state包含input_items、context（pydantic模型）和current_agent。"""
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        pass
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]):
+        pass
+
+    async def start(self) -> None:
+        """应用启动时调用（启动后台任务等）。"""
+
+    async def close(self) -> None:
+        """应用关闭时调用（落盘未写入的数据、释放连接）。"""
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+class InMemoryConversationStore(ConversationStore):
+    _conversations: Dict[str, Dict[str, Any]] = {}
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        return self._conversations.get(conversation_id)
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]):
+        self._conversations[conversation_id] = state
+
+# =========================
+# 序列化
+# =========================
+
+# 超过此长度的序列化结果会被压缩
+_COMPRESS_THRESHOLD = 512
+_RAW_PREFIX = b"j"
+_ZLIB_PREFIX = b"z"
+
+def serialize_state(state: Dict[str, Any]) -> bytes:
+    """将会话状态紧凑地编码为字节：短键名JSON，较大时使用zlib压缩。"""
+    payload = {
+        "a": state["current_agent"],
+        "c": state["context"].model_dump(exclude_none=True),
+        "i": state["input_items"],
+    }
+    for key in state.keys() - {"current_agent", "context", "input_items"}:
+        payload.setdefault("x", {})[key] = state[key]
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) > _COMPRESS_THRESHOLD:
+        return _ZLIB_PREFIX + zlib.compress(data, 1)
+    return _RAW_PREFIX + data
+
+def deserialize_state(data: bytes, context_type: Type[BaseModel]) -> Dict[str, Any]:
+    body = data[1:]
+    if data[:1] == _ZLIB_PREFIX:
+        body = zlib.decompress(body)
+    payload = json.loads(body)
+    state: Dict[str, Any] = {
+        "current_agent": payload["a"],
+        "context": context_type.model_validate(payload["c"]),
+        "input_items": payload["i"],
+    }
+    state.update(payload.get("x", {}))
+    return state
+
+# =========================
+# SQLite持久化存储
+# =========================
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    基于嵌入式SQLite（WAL模式）的持久化会话存储。
+    所有数据库操作在线程池中执行，不阻塞事件循环；save()采用写后（write-behind）批量落盘，
+    尚未落盘的状态在get()时直接从待写缓冲区返回，保证读己之写。
+    待写缓冲区最多max_pending个会话：已满时save()自己等待落盘（背压），落盘持续失败时异常传给调用方，
+    而不是让缓冲区无限增长；积压超过一半时记录一次警告。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        context_type: Type[BaseModel],
+        flush_interval: float = 0.05,
+        max_batch: int = 512,
+        reader_threads: int = 4,
+        max_pending: int = 10_000,
+    ):
+        self.path = path
+        self.context_type = context_type
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        # 写操作由单线程串行执行；读操作使用独立的只读连接并发执行（WAL允许读写并发）
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-store-writer")
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix="conversation-store-reader")
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._pending: Dict[str, bytes] = {}
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self.saves = 0
+        self.flushes = 0
+        self.backpressure_waits = 0
+        self._backlog_warned = False
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _init_schema(self) -> None:
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            " id TEXT PRIMARY KEY,"
+            " state BLOB NOT NULL,"
+            " updated_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        conn.commit()
+        conn.close()
+
+    # ---- 线程池中执行的同步操作 ----
+
+    def _read(self, conversation_id: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT state FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _write_batch(self, batch: List[Tuple[str, bytes, float]]) -> None:
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO conversations (id, state, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                batch,
+            )
+
+    def _close_connections(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    # ---- 异步接口 ----
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        data = self._pending.get(conversation_id)
+        if data is None:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(self._readers, self._read, conversation_id)
+        if data is None:
+            return None
+        return deserialize_state(data, self.context_type)
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]):
+        # 保存时即序列化，得到状态快照；同一会话的多次保存在落盘前合并为一次
+        data = serialize_state(state)
+        if conversation_id not in self._pending and len(self._pending) >= self.max_pending:
+            # 缓冲区已满：由本次保存自己落盘，落盘失败时异常传给调用方
+            self.backpressure_waits += 1
+            await self.flush()
+        self._pending[conversation_id] = data
+        self.saves += 1
+        if not self._backlog_warned and len(self._pending) >= self.max_pending // 2:
+            self._backlog_warned = True
+            logger.warning("会话状态待写缓冲区积压%d个会话（上限%d），落盘可能持续失败", len(self._pending), self.max_pending)
+        if self._flusher is None:
+            await self.flush()
+        elif len(self._pending) >= self.max_batch:
+            self._flush_requested.set()
+
+    async def flush(self) -> None:
+        """将待写缓冲区中的所有状态写入数据库。"""
+        while self._pending:
+            now = time.time()
+            batch: List[Tuple[str, bytes, float]] = []
+            for conversation_id, data in itertools.islice(self._pending.items(), self.max_batch):
+                batch.append((conversation_id, data, now))
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._writer, self._write_batch, batch)
+            self.flushes += 1
+            for conversation_id, data, _ in batch:
+                # 写入期间若有新的保存，则保留较新的版本等待下一批
+                if self._pending.get(conversation_id) is data:
+                    del self._pending[conversation_id]
+        self._backlog_warned = False
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("会话状态落盘失败，将在下一周期重试")
+
+    async def start(self) -> None:
+        if self._flusher is None:
+            self._flush_requested = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self._close_connections()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "max_pending": self.max_pending,
+            "saves": self.saves,
+            "flushes": self.flushes,
+            "backpressure_waits": self.backpressure_waits,
+        }
+
+# =========================
+# 有界内存存储
+# =========================
+
+# 估算大小时每条消息和每个会话计入的固定开销（字节）
+_ITEM_OVERHEAD = 16
+_STATE_OVERHEAD = 256
+
+def _estimate_size(state: Dict[str, Any]) -> int:
+    """
+    近似估算会话状态常驻内存的大小：消息中字符串字段按长度计，其他字段（如tool_calls）按repr长度计，
+    上下文和代理名计入固定开销。不做JSON编码和压缩，每次save()都可以计量。
+    """
+    size = _STATE_OVERHEAD
+    for item in state["input_items"]:
+        size += _ITEM_OVERHEAD
+        for value in item.values():
+            size += len(value) if isinstance(value, str) else len(repr(value))
+    return size
+
+class BoundedInMemoryConversationStore(ConversationStore):
+    """
+    有容量上限的内存会话存储。
+    - 按会话数和近似字节数（按未压缩的文本长度估算）限制常驻内存，超出时按LRU淘汰；
+    - 后台清扫任务淘汰空闲超过idle_ttl的会话；
+    - 配置了spill_store（如SQLiteConversationStore）时，被淘汰的会话写入磁盘层，
+      用户再次访问时透明地恢复到内存。
+    """
+
+    def __init__(
+        self,
+        max_conversations: int = 10_000,
+        max_bytes: int = 256 * 1024 * 1024,
+        idle_ttl: float = 3600.0,
+        sweep_interval: float = 60.0,
+        spill_store: Optional[ConversationStore] = None,
+    ):
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.spill_store = spill_store
+        # conversation_id -> (state, 近似字节数, 最近访问时间)，按访问顺序排列
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], int, float]]" = OrderedDict()
+        self._bytes = 0
+        self._sweeper: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spills = 0
+        self.rehydrations = 0
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(conversation_id)
+        if entry is not None:
+            state, size, _ = entry
+            self._entries[conversation_id] = (state, size, time.monotonic())
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            return state
+        self.misses += 1
+        if self.spill_store is None:
+            return None
+        state = await self.spill_store.get(conversation_id)
+        if state is not None:
+            self.rehydrations += 1
+            await self._put(conversation_id, state)
+        return state
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]):
+        await self._put(conversation_id, state)
+
+    async def _put(self, conversation_id: str, state: Dict[str, Any]) -> None:
+        size = _estimate_size(state)
+        previous = self._entries.pop(conversation_id, None)
+        if previous is not None:
+            self._bytes -= previous[1]
+        self._entries[conversation_id] = (state, size, time.monotonic())
+        self._bytes += size
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_conversations or self._bytes > self.max_bytes
+        ):
+            evicted_id = next(iter(self._entries))
+            await self._evict(evicted_id)
+            self.evictions += 1
+
+    async def _evict(self, conversation_id: str) -> None:
+        state, size, _ = self._entries.pop(conversation_id)
+        self._bytes -= size
+        if self.spill_store is not None:
+            await self.spill_store.save(conversation_id, state)
+            self.spills += 1
+
+    async def sweep(self) -> int:
+        """淘汰空闲超过idle_ttl的会话，返回淘汰数量。"""
+        deadline = time.monotonic() - self.idle_ttl
+        expired = 0
+        # 条目按访问顺序排列，遇到第一个未过期的即可停止
+        while self._entries:
+            conversation_id, (_, _, last_access) = next(iter(self._entries.items()))
+            if last_access > deadline:
+                break
+            await self._evict(conversation_id)
+            expired += 1
+        self.expirations += expired
+        return expired
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("清扫空闲会话失败")
+
+    async def start(self) -> None:
+        if self.spill_store is not None:
+            await self.spill_store.start()
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        if self.spill_store is not None:
+            # 关闭前把仍常驻内存的会话也写入磁盘层，重启后可以恢复
+            for conversation_id, (state, _, _) in self._entries.items():
+                await self.spill_store.save(conversation_id, state)
+            await self.spill_store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "resident_conversations": len(self._entries),
+            "resident_bytes": self._bytes,
+            "max_conversations": self.max_conversations,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "spills": self.spills,
+            "rehydrations": self.rehydrations,
+        }
+        if self.spill_store is not None:
+            stats["spill_store"] = self.spill_store.stats()
+        return stats
+
+# =========================
+# 耗时统计
+# =========================
+
+class InstrumentedConversationStore(ConversationStore):
+    """
+    记录get/save耗时的包装（cs_conversation_store_seconds及本请求的Server-Timing）。
+    owner、forward_url、node等其他属性透传给被包装的存储。
+    """
+
+    def __init__(self, store: ConversationStore):
+        self.store = store
+        self.backend = type(store).__name__
+
+    def __getattr__(self, name: str):
+        return getattr(self.store, name)
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            state = await self.store.get(conversation_id)
+            outcome = "hit" if state is not None else "miss"
+            return state
+        finally:
+            metrics.observe_stage("store", metrics.STORE_SECONDS, started, self.backend, "get", outcome)
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            await self.store.save(conversation_id, state)
+            outcome = "ok"
+        finally:
+            metrics.observe_stage("store", metrics.STORE_SECONDS, started, self.backend, "save", outcome)
+
+    async def start(self) -> None:
+        await self.store.start()
+
+    async def close(self) -> None:
+        await self.store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return self.store.stats()
+
+# =========================
+# 工厂
+# =========================
+
+def _sqlite_store(path: str, context_type: Type[BaseModel]) -> SQLiteConversationStore:
+    return SQLiteConversationStore(
+        path,
+        context_type,
+        flush_interval=float(os.environ.get("CONVERSATION_FLUSH_INTERVAL", "0.05")),
+        max_pending=int(os.environ.get("CONVERSATION_MAX_PENDING", "10000")),
+    )
+
+def _bounded_store(spill_store: Optional[ConversationStore] = None) -> BoundedInMemoryConversationStore:
+    return BoundedInMemoryConversationStore(
+        max_conversations=int(os.environ.get("CONVERSATION_MAX_RESIDENT", "10000")),
+        max_bytes=int(os.environ.get("CONVERSATION_MAX_BYTES", str(256 * 1024 * 1024))),
+        idle_ttl=float(os.environ.get("CONVERSATION_IDLE_TTL", "3600")),
+        sweep_interval=float(os.environ.get("CONVERSATION_SWEEP_INTERVAL", "60")),
+        spill_store=spill_store,
+    )
+
+def create_conversation_store(context_type: Type[BaseModel]) -> ConversationStore:
+    """
+    根据环境变量选择会话存储：
+    - bounded（默认）：有界内存存储，CONVERSATION_SPILL_PATH设置时被淘汰的会话溢出到该SQLite文件；
+    - memory：不设上限的内存存储；
+    - sqlite：持久化存储，使用CONVERSATION_DB_PATH（默认conversations.db）；
+    - redis：多worker/多节点共享的REDIS_URL；同时设置WORKER_NODES和WORKER_NODE时，
+      本节点按一致性哈希拥有的会话额外在本地保留热副本，WORKER_NODES中给出地址的节点之间互相转发请求。
+    启用指标（METRICS_ENABLED，默认开启）时外面再包一层耗时统计。
+    """
+    store = _create_backend_store(context_type)
+    return InstrumentedConversationStore(store) if metrics.registry.enabled else store
+
+def _create_backend_store(context_type: Type[BaseModel]) -> ConversationStore:
+    backend = os.environ.get("CONVERSATION_STORE", "bounded").lower()
+    if backend == "sqlite":
+        return _sqlite_store(os.environ.get("CONVERSATION_DB_PATH", "conversations.db"), context_type)
+    if backend == "bounded":
+        spill_path = os.environ.get("CONVERSATION_SPILL_PATH")
+        return _bounded_store(_sqlite_store(spill_path, context_type) if spill_path else None)
+    if backend == "redis":
+        from redis_store import (
+            HashRing, RedisClient, RedisConversationStore, TieredConversationStore, parse_worker_nodes,
+        )
+
+        shared = RedisConversationStore(
+            RedisClient(os.environ.get("REDIS_URL", "redis://localhost:6379/0")),
+            context_type,
+            ttl_seconds=int(os.environ.get("CONVERSATION_REDIS_TTL", str(7 * 24 * 3600))),
+        )
+        nodes = parse_worker_nodes(os.environ.get("WORKER_NODES", ""))
+        if not nodes:
+            return shared
+        return TieredConversationStore(
+            _bounded_store(), shared, HashRing(nodes), os.environ["WORKER_NODE"],
+            node_urls={name: url for name, url in nodes.items() if url},
+        )
+    if backend != "memory":
+        raise ValueError(f"未知的CONVERSATION_STORE: {backend}")
+    return InMemoryConversationStore()
@@ -1,16 +1,39 @@
 from __future__ import annotations as _annotations
 
+import asyncio
+import inspect
 import json
+import logging
 import os
-from typing import Any, Dict, List, Optional, TypeVar, Generic, Callable, Awaitable
-from pydantic import BaseModel, Field
-from openai import OpenAI
+import re
+import time
+import types
+import zlib
+from types import MappingProxyType
+from typing import (
+    Any, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple, TypeVar, Generic, Callable, Awaitable, Union,
+    get_args, get_origin, get_type_hints,
+)
+import httpx
+from pydantic import BaseModel, Field, ValidationError
+from openai import AsyncOpenAI
+
+import metrics
+from resilience import (
+    CircuitOpenError, ResilientCaller, RetryPolicy, UpstreamBadRequestError, UpstreamConnectionError, UpstreamError,
+    UpstreamRateLimitError, UpstreamServerError, UpstreamTimeoutError,
+)
+from json_stream import IncrementalJSONParser
+from model_tiers import model_router
+from token_usage import TokenBudgetExceeded, estimate_usage, parse_usage, usage_ledger
 
 # 显式加载.env文件
 from dotenv import load_dotenv
 load_dotenv()
 print("环境变量加载状态：", os.environ.get("DEEPSEEK_DEV_MODE"), os.environ.get("DASHSCOPE_API_KEY", "已设置但不显示"))
 
+logger = logging.getLogger(__name__)
+
 # Type for context
 T = TypeVar('T', bound=BaseModel)
 
@@ -26,49 +49,53 @@ class MessageOutputItem(BaseModel):
 class HandoffOutputItem(BaseModel):
     source_agent: Any
     target_agent: Any
-    reason: str
+    reason: str = ""
+    # 转接工具调用的ID及返回给模型的结果
+    call_id: Optional[str] = None
+    output: str = ""
+
+class ToolCall(BaseModel):
+    id: str
+    name: str
+    arguments: str = "{}"
 
 class ToolCallItem(BaseModel):
     agent: Any
     raw_item: Any
 
+class HandoffCallItem(BaseModel):
+    """The model invoking a handoff tool; followed by a HandoffOutputItem"""
+    agent: Any
+    raw_item: Any
+
 class ToolCallOutputItem(BaseModel):
     agent: Any
     output: Any
+    call_id: Optional[str] = None
 
 class RunResult(BaseModel):
+    input: Any = None
     new_items: List[Any] = Field(default_factory=list)
+    # 运行结束时的代理（发生转接时为最后一个目标代理）
+    last_agent: Any = None
     
     def to_input_list(self):
-        """Convert result items to input list format"""
-        result = []
-        for item in self.new_items:
-            if isinstance(item, MessageOutputItem):
-                result.append({"role": "assistant", "content": item.content})
-        return result
+        """The run's input followed by its new items, ready to be fed into the next run"""
+        if isinstance(self.input, str):
+            items = [{"role": "user", "content": self.input}]
+        else:
+            items = list(self.input or [])
+        return items + ItemHelpers.to_input_items(self.new_items)
     
     def final_output_as(self, output_type):
-        """Parse the final output as a specific type"""
-        # This is a simplified implementation
-        if self.new_items and isinstance(self.new_items[-1], MessageOutputItem):
-            content = self.new_items[-1].content
-            try:
-                # Try to parse the content as JSON
-                data = json.loads(content)
-                return output_type(**data)
-            except:
-                # Fallback for non-JSON content
-                # 检查output_type并返回相应的默认值
-                if hasattr(output_type, "__annotations__"):
-                    default_values = {"reasoning": "Parsed from text"}
-                    # 检查需要的字段
-                    if "is_safe" in output_type.__annotations__:
-                        default_values["is_safe"] = True
-                    elif "is_relevant" in output_type.__annotations__:
-                        default_values["is_relevant"] = True
-                    return output_type(**default_values)
-                return output_type()
-        return output_type()
+        """
+        Parse the last message as output_type (a pydantic model), validating strictly.
+        Raises ModelBehaviorError when there is no message or it does not match.
+        """
+        message = next((item for item in reversed(self.new_items) if isinstance(item, MessageOutputItem)), None)
+        if message is None:
+            raise ModelBehaviorError(f"运行没有产生可解析为{output_type.__name__}的消息")
+        return parse_structured_output(output_type, message.content)
 
 class ItemHelpers:
     @staticmethod
@@ -77,6 +104,28 @@ class ItemHelpers:
             return item.content
         return str(item)
 
+    @staticmethod
+    def to_input_items(items) -> List[Dict[str, Any]]:
+        """Convert run items into chat messages, keeping tool calls paired with their outputs"""
+        result: List[Dict[str, Any]] = []
+        for item in items:
+            if isinstance(item, MessageOutputItem):
+                result.append({"role": "assistant", "content": item.content})
+            elif isinstance(item, (ToolCallItem, HandoffCallItem)):
+                call = item.raw_item
+                spec = {"id": call.id, "type": "function", "function": {"name": call.name, "arguments": call.arguments}}
+                # 同一次模型回复中的文本和工具调用合并为一条assistant消息
+                if result and result[-1]["role"] == "assistant":
+                    result[-1].setdefault("tool_calls", []).append(spec)
+                    result[-1]["content"] = result[-1]["content"] or None
+                else:
+                    result.append({"role": "assistant", "content": None, "tool_calls": [spec]})
+            elif isinstance(item, ToolCallOutputItem):
+                result.append({"role": "tool", "tool_call_id": item.call_id, "content": str(item.output)})
+            elif isinstance(item, HandoffOutputItem) and item.call_id:
+                result.append({"role": "tool", "tool_call_id": item.call_id, "content": item.output})
+        return result
+
 class RunContextWrapper(Generic[T]):
     def __init__(self, context: T):
         self.context = context
@@ -85,19 +134,95 @@ class GuardrailFunctionOutput(BaseModel):
     output_info: Any
     tripwire_triggered: bool = False
 
+class InputGuardrailResult(BaseModel):
+    guardrail: Any
+    output: GuardrailFunctionOutput
+
+class MaxTurnsExceeded(Exception):
+    def __init__(self, max_turns):
+        self.max_turns = max_turns
+        super().__init__(f"Max turns ({max_turns}) exceeded")
+
+class ModelBehaviorError(Exception):
+    """The model's reply did not match the requested output_type"""
+
 class InputGuardrailTripwireTriggered(Exception):
     def __init__(self, guardrail_result):
         self.guardrail_result = guardrail_result
         super().__init__(f"Input guardrail tripwire triggered: {guardrail_result}")
 
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+def _env_flag(name: str, default: str = "") -> bool:
+    return os.environ.get(name, default).lower() in ("true", "1", "yes")
+
+class TransportConfig(BaseModel):
+    """Connection pool and timeout settings for the shared upstream HTTP client."""
+    base_url: str = DASHSCOPE_BASE_URL
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    write_timeout: float = 10.0
+    pool_timeout: float = 10.0
+
+    @classmethod
+    def from_env(cls) -> "TransportConfig":
+        """Read overrides from DEEPSEEK_* environment variables"""
+        env_fields = {
+            "base_url": "DEEPSEEK_BASE_URL",
+            "max_connections": "DEEPSEEK_MAX_CONNECTIONS",
+            "max_keepalive_connections": "DEEPSEEK_MAX_KEEPALIVE_CONNECTIONS",
+            "keepalive_expiry": "DEEPSEEK_KEEPALIVE_EXPIRY",
+            "connect_timeout": "DEEPSEEK_CONNECT_TIMEOUT",
+            "read_timeout": "DEEPSEEK_READ_TIMEOUT",
+            "write_timeout": "DEEPSEEK_WRITE_TIMEOUT",
+            "pool_timeout": "DEEPSEEK_POOL_TIMEOUT",
+        }
+        values = {field: os.environ[var] for field, var in env_fields.items() if os.environ.get(var)}
+        return cls(**values)
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.write_timeout,
+            pool=self.pool_timeout,
+        )
+
+    def build_http_client(self) -> httpx.AsyncClient:
+        """Create the keep-alive connection pool used for all upstream calls"""
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=self.timeout(),
+        )
+
 # DeepSeek API client for Aliyun Bailian
 class DeepSeekClient:
-    def __init__(self, api_key=None, dev_mode=False):
+    def __init__(
+        self,
+        api_key=None,
+        dev_mode=False,
+        transport: Optional[TransportConfig] = None,
+        simulator=None,
+        resilience: Optional[ResilientCaller] = None,
+    ):
         # 显式加载.env文件(如果尚未加载)
         load_dotenv()
         
         self.api_key = api_key or os.environ.get("DASHSCOPE_API_KEY")
-        self.dev_mode = dev_mode or os.environ.get("DEEPSEEK_DEV_MODE", "").lower() in ("true", "1", "yes")
+        self.dev_mode = dev_mode or _env_flag("DEEPSEEK_DEV_MODE")
+        self.transport = transport or TransportConfig.from_env()
+        # 重试、单次调用时限与按模型的熔断器；SDK自带的重试关闭，避免与之叠加
+        self.resilience = resilience or ResilientCaller.from_env()
+        self.client: Optional[AsyncOpenAI] = None
+        # 开发模式下使用的LLM模拟器
+        self.simulator = None
         
         # 打印详细的环境变量状态
         print("="*80)
@@ -119,134 +244,268 @@ class DeepSeekClient:
             print("="*80 + "\n")
             raise ValueError("DASHSCOPE_API_KEY环境变量或api_key参数必须设置，或者启用开发模式")
         
-        if self.api_key and not self.dev_mode:
+        if self.dev_mode:
+            # 开发模式：上游换成进程内的LLM模拟器，请求仍经过与生产相同的客户端、解析和流式路径
+            from llm_simulator import LLMSimulator, SimulatorTransport
+            self.simulator = simulator or LLMSimulator.from_env()
+            self.client = AsyncOpenAI(
+                api_key="simulator",
+                base_url="http://llm-simulator/v1",
+                http_client=httpx.AsyncClient(transport=SimulatorTransport(self.simulator)),
+                max_retries=0,
+                timeout=self.transport.timeout(),
+            )
+            logger.debug("开发模式：使用进程内LLM模拟器（种子%s）", self.simulator.seed)
+        elif self.api_key:
             try:
-                self.client = OpenAI(
+                # 所有代理共享同一个异步客户端及其keep-alive连接池
+                self.client = AsyncOpenAI(
                     api_key=self.api_key,
-                    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
+                    base_url=self.transport.base_url,
+                    http_client=self.transport.build_http_client(),
+                    # SDK的默认时限（600秒）会覆盖http_client上的设置，这里显式传入
+                    max_retries=0,
+                    timeout=self.transport.timeout(),
+                )
+                logger.debug(
+                    "已初始化异步OpenAI客户端，连接到%s（最大连接数%d）",
+                    self.transport.base_url, self.transport.max_connections,
                 )
-                print("成功初始化OpenAI客户端，连接到阿里云百炼API")
             except Exception as e:
                 print(f"初始化OpenAI客户端时出错: {e}")
                 raise
+
+    async def aclose(self):
+        """Close the underlying connection pool"""
+        if self.client is not None:
+            await self.client.close()
     
     async def chat_completion(self, messages, model="deepseek-v3", **kwargs):
         """
-        Call DeepSeek chat completion API via Aliyun Bailian
+        Call DeepSeek chat completion API via Aliyun Bailian.
+        Raises UpstreamError (after retries) when the call fails.
         """
-        # 如果处于开发模式，返回模拟响应
-        if self.dev_mode:
-            print(f"[开发模式] 模拟DeepSeek响应，模型: {model}")
-            
-            # 获取系统指令和用户消息
-            system_message = ""
-            user_message = ""
-            for msg in messages:
-                if msg["role"] == "system":
-                    system_message = msg["content"]
-                elif msg["role"] == "user" and not user_message:  # 获取最后一条用户消息
-                    user_message = msg["content"]
-            
-            # 根据系统指令和用户消息生成模拟响应
-            response_content = ""
-            
-            # 检查是否包含分流代理的指令
-            if "分流代理" in system_message or "Triage Agent" in system_message:
-                if "座位" in user_message or "换座" in user_message:
-                    response_content = "我理解您想更换座位。我会将您转接到座位预订代理，他们可以帮您处理座位变更。"
-                elif "航班状态" in user_message or "航班" in user_message:
-                    response_content = "您想查询航班状态。我会将您转接到航班状态代理，他们可以提供最新信息。"
-                elif "取消" in user_message:
-                    response_content = "您想取消航班。我会将您转接到取消代理，他们可以帮您处理取消流程。"
-                elif "行李" in user_message or "baggage" in user_message.lower():
-                    response_content = "您有关于行李的问题。我会将您转接到FAQ代理，他们可以回答您的问题。"
-                else:
-                    response_content = "您好！我是航空公司的客服助手。请问您需要什么帮助？您可以询问关于航班状态、座位预订、行李政策或取消航班的问题。"
-            
-            # 检查是否包含座位预订代理的指令
-            elif "座位预订代理" in system_message or "Seat Booking Agent" in system_message:
-                if "确认号" in user_message:
-                    response_content = "感谢您提供确认号。您想要更换到哪个座位？或者您想查看座位图吗？"
-                elif "23A" in user_message or "座位" in user_message:
-                    response_content = "您的座位已成功更改。如果您需要进一步帮助，请随时询问！"
-                else:
-                    response_content = "欢迎使用座位预订服务。为了帮您更换座位，请提供您的确认号码。"
-            
-            # 检查是否包含FAQ代理的指令
-            elif "FAQ代理" in system_message or "FAQ Agent" in system_message:
-                if "行李" in user_message:
-                    response_content = "您可以携带一个行李登机。它必须低于50磅，尺寸不超过22英寸 x 14英寸 x 9英寸。"
-                elif "座位" in user_message or "飞机" in user_message:
-                    response_content = "飞机上共有120个座位。其中有22个商务舱座位和98个经济舱座位。4排和16排是安全出口排。5-8排是经济舱Plus，提供更多腿部空间。"
-                elif "wifi" in user_message.lower() or "网络" in user_message:
-                    response_content = "我们在飞机上提供免费WiFi，连接名称为Airline-Wifi"
-                else:
-                    response_content = "这是FAQ代理。请问您有什么具体问题？我可以回答关于行李、座位、WiFi等方面的问题。"
-            
-            # 如果没有匹配到特定代理或问题，返回通用响应
-            if not response_content:
-                response_content = f"我是航空公司客服助手。您的问题是：{user_message}。请问您需要了解航班状态、座位预订还是行李政策？"
-            
-            return {
-                "id": "dev-mode-response",
-                "object": "chat.completion",
-                "created": 0,
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": response_content,
-                        },
-                        "finish_reason": "stop"
-                    }
-                ]
-            }
-        
-        # 正常API调用
+        completion = await self.resilience.call(
+            model, lambda: self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+        )
+        return {
+            "id": completion.id,
+            "object": "chat.completion",
+            "created": completion.created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": completion.choices[0].message.model_dump(
+                        include={"role", "content", "tool_calls"}, exclude_none=True
+                    ),
+                    "finish_reason": completion.choices[0].finish_reason
+                }
+            ],
+            "usage": completion.usage.model_dump() if completion.usage else None,
+        }
+
+    async def chat_completion_stream(self, messages, model="deepseek-v3", **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream a chat completion, yielding chat.completion.chunk dicts as they arrive.
+        Opening the stream and waiting for its first chunk is retried under the call
+        timeout; a failure after that raises UpstreamError.
+        """
+        # 最后一个分片带上整次调用的token用量
+        kwargs.setdefault("stream_options", {"include_usage": True})
+
+        async def open_stream():
+            stream = await self.client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+            chunks = stream.__aiter__()
+            try:
+                # 首个分片到达前还没有向调用方输出任何内容，超时或失败都可以安全重试
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await stream.close()
+                raise
+            return stream, chunks, first
+
+        stream, chunks, first = await self.resilience.call(model, open_stream)
         try:
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                **kwargs
-            )
-            
-            return {
-                "id": completion.id,
-                "object": "chat.completion",
-                "created": completion.created,
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": completion.choices[0].message.content,
-                        },
-                        "finish_reason": completion.choices[0].finish_reason
-                    }
-                ]
-            }
+            chunk = first
+            while chunk is not None:
+                if chunk.choices:
+                    choice = chunk.choices[0]
+                    yield _completion_chunk(
+                        chunk.id, model, choice.delta.model_dump(exclude_none=True), finish_reason=choice.finish_reason
+                    )
+                elif chunk.usage is not None:
+                    yield dict(_completion_chunk(chunk.id, model, {}), choices=[], usage=chunk.usage.model_dump())
+                chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            pass
         except Exception as e:
-            print(f"调用DeepSeek API时出错: {e}")
-            # 返回错误响应
-            return {
-                "id": "error",
-                "object": "chat.completion",
-                "created": 0,
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": f"抱歉，系统遇到了问题：{str(e)}",
-                        },
-                        "finish_reason": "error"
-                    }
-                ]
-            }
+            # 已经输出的内容无法撤回，因此不重试
+            error = self.resilience.failure(e, model)
+            raise error from (None if error is e else e)
+        finally:
+            await stream.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return self.resilience.stats()
+
+def _completion_chunk(chunk_id, model, delta, finish_reason=None) -> Dict[str, Any]:
+    return {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+# 进程级共享客户端：所有代理和守卫代理复用同一个连接池
+_default_client: Optional[DeepSeekClient] = None
+
+def get_default_client() -> DeepSeekClient:
+    """Return the process-wide DeepSeekClient, creating it on first use"""
+    global _default_client
+    if _default_client is None:
+        _default_client = DeepSeekClient()
+    return _default_client
+
+def set_default_client(client: Optional[DeepSeekClient]) -> None:
+    """Replace the process-wide DeepSeekClient (e.g. for benchmarks)"""
+    global _default_client
+    _default_client = client
+
+async def close_default_client() -> None:
+    """Close the process-wide client's connection pool, if it was created"""
+    global _default_client
+    if _default_client is not None:
+        client, _default_client = _default_client, None
+        # 置空后下次使用重新创建，避免应用再次启动时拿到已关闭的连接池
+        await client.aclose()
+
+# JSON Schema types for tool parameter annotations
+_JSON_SCHEMA_TYPES = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    list: "array",
+    dict: "object",
+}
+
+class ToolArgumentError(ValueError):
+    """Raised when tool-call arguments from the model do not match the tool's signature"""
+
+def _is_context_param(annotation) -> bool:
+    return annotation is RunContextWrapper or get_origin(annotation) is RunContextWrapper
+
+def _annotation_schema(annotation) -> Dict[str, Any]:
+    """Translate a parameter annotation into a JSON schema fragment"""
+    origin = get_origin(annotation)
+    if origin in (Union, types.UnionType):
+        args = [a for a in get_args(annotation) if a is not type(None)]
+        if len(args) == 1:
+            return _annotation_schema(args[0])
+        return {}
+    schema_type = _JSON_SCHEMA_TYPES.get(origin or annotation)
+    return {"type": schema_type} if schema_type else {}
+
+# 按JSON schema类型对模型给出的参数做宽松转换（例如"12"转为12），无法转换时抛出TypeError/ValueError
+def _coerce_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise TypeError
+
+def _coerce_integer(value):
+    if isinstance(value, bool):
+        raise TypeError
+    if isinstance(value, int):
+        return value
+    return int(str(value).strip())
+
+def _coerce_number(value):
+    if isinstance(value, bool):
+        raise TypeError
+    return float(value)
+
+def _coerce_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return value.strip().lower() == "true"
+    raise TypeError
+
+def _coerce_container(expected_type):
+    def coerce(value):
+        if not isinstance(value, expected_type):
+            raise TypeError
+        return value
+    return coerce
+
+_COERCERS: Dict[str, Callable[[Any], Any]] = {
+    "string": _coerce_string,
+    "integer": _coerce_integer,
+    "number": _coerce_number,
+    "boolean": _coerce_boolean,
+    "array": _coerce_container(list),
+    "object": _coerce_container(dict),
+}
+
+def _compile_tool(func) -> None:
+    """Introspect a function_tool's signature once and cache its schema, spec and argument coercer"""
+    hints = get_type_hints(func)
+    properties: Dict[str, Any] = {}
+    required: List[str] = []
+    params: List[tuple] = []
+    takes_context = False
+    for param in inspect.signature(func).parameters.values():
+        annotation = hints.get(param.name, Any)
+        if _is_context_param(annotation):
+            takes_context = True
+            continue
+        schema = _annotation_schema(annotation)
+        properties[param.name] = schema
+        is_required = param.default is inspect.Parameter.empty
+        if is_required:
+            required.append(param.name)
+        params.append((param.name, _COERCERS.get(schema.get("type")), is_required))
+
+    def coerce_arguments(arguments: Dict[str, Any]) -> Dict[str, Any]:
+        unknown = set(arguments) - set(properties)
+        if unknown:
+            raise ToolArgumentError(f"未知参数: {', '.join(sorted(unknown))}")
+        coerced: Dict[str, Any] = {}
+        for name, coercer, is_required in params:
+            if name not in arguments:
+                if is_required:
+                    raise ToolArgumentError(f"缺少参数: {name}")
+                continue
+            value = arguments[name]
+            if coercer is not None and value is not None:
+                try:
+                    value = coercer(value)
+                except (TypeError, ValueError):
+                    raise ToolArgumentError(f"参数{name}应为{properties[name]['type']}类型") from None
+            coerced[name] = value
+        return coerced
+
+    func.takes_context = takes_context
+    func.params_json_schema = {"type": "object", "properties": properties, "required": required}
+    func.tool_spec = {
+        "type": "function",
+        "function": {
+            "name": func.name,
+            "description": func.description or "",
+            "parameters": func.params_json_schema,
+        },
+    }
+    func.coerce_arguments = coerce_arguments
+
+def _ensure_compiled(func) -> None:
+    # 装饰时无法解析的前向引用注解，在首次使用时再编译
+    if not hasattr(func, "tool_spec"):
+        _compile_tool(func)
 
 # Function to create a tool from a function
 def function_tool(fn=None, *, name_override=None, description_override=None):
@@ -254,12 +513,48 @@ def function_tool(fn=None, *, name_override=None, description_override=None):
     def decorator(func):
         func.name = name_override or func.__name__
         func.description = description_override or func.__doc__
+        try:
+            _compile_tool(func)
+        except NameError:
+            pass
         return func
     
     if fn is None:
         return decorator
     return decorator(fn)
 
+# =========================
+# 结构化输出
+# =========================
+
+# 格式提示中各字段类型的写法
+_FORMAT_TYPE_NAMES = {str: "字符串", bool: "布尔值", int: "整数", float: "数字"}
+
+def output_format(output_type) -> str:
+    """The JSON shape of a pydantic model in field order, e.g. {"is_safe": 布尔值, "reasoning": 字符串}"""
+    fields = []
+    for name, field in output_type.model_fields.items():
+        annotation = field.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            shape = output_format(annotation)
+        else:
+            shape = _FORMAT_TYPE_NAMES.get(annotation, "JSON值")
+        fields.append(f'"{name}": {shape}')
+    return "{" + ", ".join(fields) + "}"
+
+# 附加在有output_type的代理指令之后；字段顺序决定流式解析时哪些字段先可用
+OUTPUT_FORMAT_PROMPT = "只输出如下格式的JSON对象，字段按此顺序：{format}"
+
+def parse_structured_output(output_type, content: str):
+    """Validate the JSON object in content (ignoring code fences around it) against output_type"""
+    start, end = content.find("{"), content.rfind("}")
+    if start < 0 or end <= start:
+        raise ModelBehaviorError(f"模型回复中没有JSON对象：{content[:100]!r}")
+    try:
+        return output_type.model_validate_json(content[start:end + 1])
+    except ValidationError as e:
+        raise ModelBehaviorError(f"模型回复不符合{output_type.__name__}（{e.error_count()}处错误）") from e
+
 # Agent class
 class Agent(Generic[T]):
     def __init__(
@@ -272,6 +567,7 @@ class Agent(Generic[T]):
         handoffs: List[Any] = None,
         input_guardrails: List[Any] = None,
         output_type: Any = None,
+        client: Optional[DeepSeekClient] = None,
     ):
         self.name = name
         self.model = model
@@ -281,14 +577,82 @@ class Agent(Generic[T]):
         self.handoffs = handoffs or []
         self.input_guardrails = input_guardrails or []
         self.output_type = output_type
-        self.client = DeepSeekClient(dev_mode=os.environ.get("DEEPSEEK_DEV_MODE", "").lower() in ("true", "1", "yes"))
+        self._client = client
+        if client is None:
+            # 启动时即创建共享客户端，以便尽早发现缺失的API密钥
+            get_default_client()
+
+    @property
+    def client(self) -> DeepSeekClient:
+        return self._client or get_default_client()
+
+    @property
+    def static_payload(self) -> "StaticRequestPayload":
+        """
+        The per-agent parts of every request that do not change between turns.
+        Built on first use and rebuilt only if tools, handoffs or instructions are replaced.
+        """
+        fingerprint = (
+            tuple(map(id, self.tools)), tuple(map(id, self.handoffs)), id(self.instructions), id(self.output_type)
+        )
+        payload = getattr(self, "_static_payload", None)
+        if payload is None or payload.fingerprint != fingerprint:
+            for tool in self.tools:
+                _ensure_compiled(tool)
+            handoffs = tuple(h if isinstance(h, Handoff) else Handoff(h) for h in self.handoffs)
+            output_instructions = (
+                "\n\n" + OUTPUT_FORMAT_PROMPT.format(format=output_format(self.output_type)) if self.output_type else ""
+            )
+            payload = StaticRequestPayload(
+                fingerprint=fingerprint,
+                tools=tuple(tool.tool_spec for tool in self.tools),
+                tools_by_name=MappingProxyType({tool.name: tool for tool in self.tools}),
+                handoffs=handoffs,
+                handoffs_by_name=MappingProxyType({h.tool_name: h for h in handoffs}),
+                handoff_tools=tuple(h.tool_spec for h in handoffs),
+                instructions=None if callable(self.instructions) else self.instructions + output_instructions,
+                output_instructions=output_instructions,
+            )
+            self._static_payload = payload
+        return payload
+
+class StaticRequestPayload(NamedTuple):
+    fingerprint: tuple
+    # 发送给模型的工具定义
+    tools: tuple
+    tools_by_name: MappingProxyType
+    handoffs: tuple
+    handoffs_by_name: MappingProxyType
+    # 转接以工具形式暴露给模型时的定义
+    handoff_tools: tuple
+    # 静态指令（含输出格式提示）；动态指令（可调用对象）每轮计算，此处为None
+    instructions: Optional[str]
+    # 有output_type时附加在指令之后的输出格式提示，否则为空
+    output_instructions: str
+
+def default_handoff_tool_name(agent) -> str:
+    """transfer_to_<agent name>, falling back to a stable hash for non-ASCII names"""
+    slug = re.sub(r"[^a-z0-9]+", "_", agent.name.lower()).strip("_")
+    if not slug:
+        slug = f"agent_{zlib.crc32(agent.name.encode('utf-8')):08x}"
+    return f"transfer_to_{slug}"
 
 # Handoff class
 class Handoff:
-    def __init__(self, agent, on_handoff=None):
+    def __init__(self, agent, on_handoff=None, tool_name_override=None, tool_description_override=None):
         self.agent = agent
         self.agent_name = agent.name
         self.on_handoff = on_handoff
+        self.tool_name = tool_name_override or default_handoff_tool_name(agent)
+        self.tool_description = tool_description_override or agent.handoff_description or f"转接到{agent.name}"
+        self.tool_spec = {
+            "type": "function",
+            "function": {
+                "name": self.tool_name,
+                "description": self.tool_description,
+                "parameters": {"type": "object", "properties": {}, "required": []},
+            },
+        }
         
     def on_invoke_handoff(self, context):
         """Called when a handoff is invoked"""
@@ -297,8 +661,8 @@ class Handoff:
         return None
 
 # Helper function to create a handoff
-def handoff(agent, on_handoff=None):
-    return Handoff(agent, on_handoff)
+def handoff(agent, on_handoff=None, tool_name_override=None, tool_description_override=None):
+    return Handoff(agent, on_handoff, tool_name_override, tool_description_override)
 
 # Input guardrail decorator
 def input_guardrail(name=None):
@@ -307,55 +671,603 @@ def input_guardrail(name=None):
         return func
     return decorator
 
+# Stream events
+class StreamEvent(BaseModel):
+    """Event emitted while a run is in progress.
+
+    type is one of:
+    - "message_delta": a piece of assistant text (``delta``)
+    - "run_item": a completed run item such as MessageOutputItem (``item``)
+    - "guardrail_result": an input guardrail finished (``item`` is an InputGuardrailResult)
+
+    ``model`` is the upstream model that produced a "message_delta" or a MessageOutputItem.
+    """
+    type: str
+    agent: Any = None
+    delta: str = ""
+    item: Any = None
+    model: Optional[str] = None
+
+class RunResultStreaming:
+    """Handle returned by Runner.run_streamed; iterate stream_events() to drive the run"""
+
+    def __init__(self, events: AsyncIterator[StreamEvent], input: Any = None, starting_agent: Any = None):
+        self._events = events
+        self.input = input
+        self.new_items: List[Any] = []
+        self.last_agent = starting_agent
+        self.is_complete = False
+
+    async def stream_events(self) -> AsyncIterator[StreamEvent]:
+        try:
+            async for event in self._events:
+                if event.type == "run_item":
+                    self.new_items.append(event.item)
+                    if isinstance(event.item, HandoffOutputItem):
+                        self.last_agent = event.item.target_agent
+                yield event
+            self.is_complete = True
+        finally:
+            # 消费方提前退出（如客户端断开）时取消仍在进行的模型调用
+            await self._events.aclose()
+
+    def to_result(self) -> RunResult:
+        """The equivalent non-streaming RunResult once the stream is exhausted"""
+        return RunResult(input=self.input, new_items=list(self.new_items), last_agent=self.last_agent)
+
+# 并发守卫的内部标记
+_GUARDRAILS_DONE = object()
+_MODEL_DONE = object()
+
 # Runner class
 class Runner:
+    # 并发模式：所有输入守卫同时运行，主模型调用与守卫乐观地并行开始
+    parallel_guardrails: bool = _env_flag("DEEPSEEK_PARALLEL_GUARDRAILS", "true")
+    # 单次运行最多的模型调用步数，以及每个工具调用的超时时间（秒）
+    max_turns: int = int(os.environ.get("DEEPSEEK_MAX_TURNS", "10"))
+    tool_timeout: float = float(os.environ.get("DEEPSEEK_TOOL_TIMEOUT", "30"))
+    # 单次运行中最多的代理转接次数，防止代理之间来回转接
+    max_handoffs: int = int(os.environ.get("DEEPSEEK_MAX_HANDOFFS", "3"))
+    # 有output_type的代理请求上游的JSON输出模式（response_format=json_object）
+    json_mode: bool = _env_flag("DEEPSEEK_JSON_MODE", "true")
+
     @staticmethod
-    async def run(agent, input_items, context=None):
-        """Run an agent with input items and context"""
-        # Check guardrails first
-        if hasattr(agent, "input_guardrails") and agent.input_guardrails:
-            for guardrail in agent.input_guardrails:
-                # Extract the latest user message
-                latest_user_message = None
-                if isinstance(input_items, list) and input_items:
-                    latest_item = input_items[-1]
-                    if isinstance(latest_item, dict) and latest_item.get("role") == "user":
-                        latest_user_message = latest_item.get("content", "")
-                    elif hasattr(latest_item, "role") and latest_item.role == "user":
-                        latest_user_message = latest_item.content
-                
-                if latest_user_message:
-                    # Run the guardrail check
-                    ctx_wrapper = RunContextWrapper(context)
-                    result = await guardrail(ctx_wrapper, agent, latest_user_message)
-                    if result.tripwire_triggered:
-                        raise InputGuardrailTripwireTriggered(
-                            type("GuardrailResult", (), {"guardrail": guardrail, "output": result})
-                        )
-        
-        # Process the input items into messages for DeepSeek API
-        messages = []
+    def _latest_user_message(input_items) -> Optional[str]:
+        """Extract the latest user message, if the last item is one"""
+        if isinstance(input_items, str):
+            return input_items
+        if isinstance(input_items, list) and input_items:
+            latest_item = input_items[-1]
+            if isinstance(latest_item, dict) and latest_item.get("role") == "user":
+                return latest_item.get("content", "")
+            elif hasattr(latest_item, "role") and latest_item.role == "user":
+                return latest_item.content
+        return None
+
+    @staticmethod
+    def _build_messages(agent, input_items, context) -> List[Dict[str, Any]]:
+        """Process the input items into messages for DeepSeek API"""
+        # 守卫代理以纯字符串作为输入
+        if isinstance(input_items, str):
+            input_items = [{"role": "user", "content": input_items}]
+
+        messages = [Runner._system_message(agent, context)]
         for item in input_items:
             if isinstance(item, dict):
                 messages.append(item)
             elif hasattr(item, "role") and hasattr(item, "content"):
                 messages.append({"role": item.role, "content": item.content})
-        
-        # Add system instructions
-        if callable(agent.instructions):
-            instructions = agent.instructions(RunContextWrapper(context), agent)
-        else:
-            instructions = agent.instructions
-            
-        messages.insert(0, {"role": "system", "content": instructions})
-        
-        # Call DeepSeek API
-        response = await agent.client.chat_completion(messages, model=agent.model)
-        
-        # Process response
-        result = RunResult()
-        if response and "choices" in response and response["choices"]:
-            message = response["choices"][0]["message"]
-            result.new_items.append(MessageOutputItem(agent=agent, content=message["content"]))
-        
-        return result 
\ No newline at end of file
+        return messages
+
+    @staticmethod
+    def _system_message(agent, context) -> Dict[str, Any]:
+        """System instructions; only dynamic instructions are computed per turn"""
+        payload = agent.static_payload
+        instructions = payload.instructions
+        if instructions is None:
+            instructions = agent.instructions(RunContextWrapper(context), agent) + payload.output_instructions
+        return {"role": "system", "content": instructions}
+
+    @staticmethod
+    def _tripwire(guardrail, result) -> InputGuardrailTripwireTriggered:
+        return InputGuardrailTripwireTriggered(InputGuardrailResult(guardrail=guardrail, output=result))
+
+    @staticmethod
+    async def _call_guardrail(guardrail, ctx_wrapper, agent, message: str) -> GuardrailFunctionOutput:
+        """Run one guardrail, recording its latency and verdict"""
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with metrics.enclosing_stage("guardrail"):
+                result = await guardrail(ctx_wrapper, agent, message)
+            outcome = "tripped" if result.tripwire_triggered else "passed"
+            return result
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            name = getattr(guardrail, "name", None) or getattr(guardrail, "__name__", "guardrail")
+            metrics.observe_stage("guardrail", metrics.GUARDRAIL_SECONDS, started, name, outcome)
+
+    @classmethod
+    async def _run_input_guardrails(cls, agent, message: str, context, on_result) -> None:
+        """Run guardrails one after another, stopping at the first tripwire"""
+        ctx_wrapper = RunContextWrapper(context)
+        for guardrail in agent.input_guardrails:
+            result = await cls._call_guardrail(guardrail, ctx_wrapper, agent, message)
+            on_result(guardrail, result)
+            if result.tripwire_triggered:
+                raise cls._tripwire(guardrail, result)
+
+    @classmethod
+    async def _run_input_guardrails_concurrently(cls, agent, message: str, context, on_result) -> None:
+        """Run all guardrails at once; raise as soon as any of them trips"""
+        ctx_wrapper = RunContextWrapper(context)
+        pending = {
+            asyncio.ensure_future(cls._call_guardrail(guardrail, ctx_wrapper, agent, message)): guardrail
+            for guardrail in agent.input_guardrails
+        }
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    guardrail = pending.pop(task)
+                    result = task.result()
+                    on_result(guardrail, result)
+                    if result.tripwire_triggered:
+                        raise cls._tripwire(guardrail, result)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _merge_tool_call_deltas(tool_calls: Dict[int, Dict[str, Any]], deltas: List[Dict[str, Any]]) -> None:
+        """Accumulate streamed tool-call fragments by index"""
+        for delta in deltas:
+            call = tool_calls.setdefault(
+                delta.get("index", len(tool_calls)),
+                {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            if delta.get("id"):
+                call["id"] = delta["id"]
+            function = delta.get("function") or {}
+            call["function"]["name"] += function.get("name") or ""
+            call["function"]["arguments"] += function.get("arguments") or ""
+
+    @classmethod
+    async def _model_events(cls, agent, messages, stream: bool, allow_handoffs: bool = True) -> AsyncIterator[StreamEvent]:
+        """
+        Call the model once, yielding text deltas (when streaming) and finally a
+        "model_response" event carrying the assistant message dict. A call that fails
+        before producing any output is retried on the next model of the agent's chain.
+        """
+        kwargs: Dict[str, Any] = {}
+        payload = agent.static_payload
+        # 转接次数用尽后不再向模型提供转接工具，由当前代理直接回答
+        tools = payload.tools + payload.handoff_tools if allow_handoffs else payload.tools
+        if tools:
+            kwargs["tools"] = list(tools)
+        if agent.output_type is not None and cls.json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+
+        # 会话的token用量已达预算时不再发起调用
+        usage_ledger.check_budget()
+        choices = model_router.plan(agent)
+        for attempt, choice in enumerate(choices):
+            model_router.record_selection(agent.name, choice)
+            emitted = False
+            events = cls._model_call(agent, choice.model, messages, stream, kwargs)
+            try:
+                async for event in events:
+                    emitted = True
+                    yield event
+                return
+            except UpstreamError as e:
+                # 已经输出了增量的流式调用无法换模型重来
+                if emitted or attempt == len(choices) - 1:
+                    raise
+                # 改用的模型计入cs_model_selections_total（reason为fallback）
+                logger.debug("代理%s调用模型%s失败（%s），改用%s", agent.name, choice.model, e.kind, choices[attempt + 1].model)
+            finally:
+                await events.aclose()
+
+    @classmethod
+    async def _model_call(cls, agent, model: str, messages, stream: bool, kwargs: Dict[str, Any]) -> AsyncIterator[StreamEvent]:
+        """One upstream call on the given model, timed and with its usage recorded"""
+        started = time.perf_counter()
+        outcome = "error"
+        # 自适应选择模型时比较的延迟：流式调用取首token延迟
+        latency: Optional[float] = None
+        cost = 0.0
+        parts: List[str] = []
+        usage_recorded = False
+        try:
+            if stream:
+                tool_calls: Dict[int, Dict[str, Any]] = {}
+                async for chunk in agent.client.chat_completion_stream(messages, model=model, **kwargs):
+                    if chunk.get("usage"):
+                        cost += cls._record_usage(agent, model, chunk["usage"])
+                        usage_recorded = True
+                    if not chunk["choices"]:
+                        continue
+                    choice = chunk["choices"][0]
+                    delta = choice["delta"]
+                    if latency is None and (delta.get("content") or delta.get("tool_calls")):
+                        latency = metrics.observe_stage(
+                            "llm_first_token", metrics.LLM_FIRST_TOKEN_SECONDS, started, agent.name, model
+                        )
+                    if delta.get("content"):
+                        parts.append(delta["content"])
+                        yield StreamEvent(type="message_delta", agent=agent, delta=delta["content"], model=model)
+                    if delta.get("tool_calls"):
+                        cls._merge_tool_call_deltas(tool_calls, delta["tool_calls"])
+                message: Dict[str, Any] = {"role": "assistant", "content": "".join(parts)}
+                if tool_calls:
+                    message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+                outcome = "ok"
+                model_router.observe(agent.name, model, latency or time.perf_counter() - started, cost)
+                yield StreamEvent(type="model_response", agent=agent, item=message, model=model)
+                return
+
+            # Call DeepSeek API
+            response = await agent.client.chat_completion(messages, model=model, **kwargs)
+            if response and response.get("usage"):
+                cost = cls._record_usage(agent, model, response["usage"])
+            outcome = "ok"
+            model_router.observe(agent.name, model, time.perf_counter() - started, cost)
+            if response and "choices" in response and response["choices"]:
+                yield StreamEvent(
+                    type="model_response", agent=agent, item=response["choices"][0]["message"], model=model
+                )
+        except UpstreamError as e:
+            outcome = e.kind
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            # 守卫触发、客户端断开或结构化输出提前结束时被取消
+            outcome = "cancelled"
+            if latency is not None and not usage_recorded:
+                # 提前关闭的流收不到带用量的最后一个分片，按已收到的内容估算
+                parsed = estimate_usage(messages, "".join(parts))
+                usage_ledger.record(agent.name, model, parsed)
+            raise
+        finally:
+            metrics.observe_stage("llm", metrics.LLM_REQUEST_SECONDS, started, agent.name, model, outcome)
+
+    @staticmethod
+    def _record_usage(agent, model: str, usage: Any) -> float:
+        """Record one call's token usage and return its estimated cost"""
+        parsed = parse_usage(usage)
+        usage_ledger.record(agent.name, model, parsed)
+        return parsed.cost
+
+    @classmethod
+    async def _invoke_tool(cls, agent, call: ToolCall, context, tool_timeout: float) -> str:
+        """Execute one tool call; failures are reported back to the model as text"""
+        started = time.perf_counter()
+        outcome, output = await cls._execute_tool(agent, call, context, tool_timeout)
+        # 模型给出的未知工具名不作为标签值，避免标签基数失控
+        tool_name = call.name if outcome != "unknown_tool" else "unknown"
+        metrics.observe_stage("tool", metrics.TOOL_SECONDS, started, agent.name, tool_name, outcome)
+        return output
+
+    @staticmethod
+    async def _execute_tool(agent, call: ToolCall, context, tool_timeout: float) -> Tuple[str, str]:
+        """Returns (outcome, output text)"""
+        tool = agent.static_payload.tools_by_name.get(call.name)
+        if tool is None:
+            return "unknown_tool", f"错误：未知工具{call.name}"
+        try:
+            arguments = json.loads(call.arguments or "{}")
+        except json.JSONDecodeError:
+            return "invalid_arguments", f"错误：工具{call.name}的参数不是合法的JSON"
+        if not isinstance(arguments, dict):
+            return "invalid_arguments", f"错误：工具{call.name}的参数必须是JSON对象"
+        try:
+            arguments = tool.coerce_arguments(arguments)
+        except ToolArgumentError as e:
+            return "invalid_arguments", f"错误：工具{call.name}的参数无效：{e}"
+        args = (RunContextWrapper(context),) if tool.takes_context else ()
+        try:
+            output = tool(*args, **arguments)
+            if inspect.isawaitable(output):
+                output = await asyncio.wait_for(output, timeout=tool_timeout)
+        except asyncio.TimeoutError:
+            return "timeout", f"错误：工具{call.name}执行超时（{tool_timeout}秒）"
+        except Exception as e:
+            logger.debug("执行工具%s时出错", call.name, exc_info=True)
+            return "error", f"错误：工具{call.name}执行失败：{e}"
+        return "ok", output if isinstance(output, str) else json.dumps(output, ensure_ascii=False, default=str)
+
+    @classmethod
+    async def _gated_events(cls, agent, message: str, context, model_events: AsyncIterator[StreamEvent]):
+        """
+        Run the guardrails concurrently with the model call. Model events are held back
+        until every guardrail has passed; if one trips, the model call is cancelled.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def on_result(guardrail, result):
+            queue.put_nowait(StreamEvent(
+                type="guardrail_result", agent=agent, item=InputGuardrailResult(guardrail=guardrail, output=result)
+            ))
+
+        async def pump():
+            try:
+                async for event in model_events:
+                    queue.put_nowait(event)
+            finally:
+                queue.put_nowait(_MODEL_DONE)
+
+        # 乐观地提前发起主模型调用；任一守卫触发时取消它并丢弃其输出
+        model_task = asyncio.ensure_future(pump())
+        guardrail_task = asyncio.ensure_future(cls._run_input_guardrails_concurrently(agent, message, context, on_result))
+        guardrail_task.add_done_callback(lambda _: queue.put_nowait(_GUARDRAILS_DONE))
+        held: List[StreamEvent] = []
+        passed = model_done = False
+        try:
+            while not (passed and model_done):
+                event = await queue.get()
+                if event is _GUARDRAILS_DONE:
+                    guardrail_task.result()
+                    passed = True
+                    for held_event in held:
+                        yield held_event
+                    held.clear()
+                elif event is _MODEL_DONE:
+                    model_done = True
+                elif event.type == "guardrail_result" or passed:
+                    yield event
+                else:
+                    held.append(event)
+            model_task.result()
+        finally:
+            for task in (guardrail_task, model_task):
+                task.cancel()
+            await asyncio.gather(guardrail_task, model_task, return_exceptions=True)
+
+    @staticmethod
+    async def _invoke_handoff(agent, handoff_call: ToolCall, context) -> HandoffOutputItem:
+        """Run the handoff's on_handoff callback and describe the switch to the target agent"""
+        spec = agent.static_payload.handoffs_by_name[handoff_call.name]
+        outcome = spec.on_invoke_handoff(RunContextWrapper(context))
+        if inspect.isawaitable(outcome):
+            await outcome
+        return HandoffOutputItem(
+            source_agent=agent,
+            target_agent=spec.agent,
+            reason=handoff_call.name,
+            call_id=handoff_call.id,
+            output=json.dumps({"assistant": spec.agent.name}, ensure_ascii=False),
+        )
+
+    @classmethod
+    async def _iter_run(cls, agent, input_items, context, **options):
+        """The run's event stream, timed as a whole and labelled with how it ended"""
+        started = time.perf_counter()
+        outcome = "error"
+        steps = cls._run_steps(agent, input_items, context, **options)
+        try:
+            async for event in steps:
+                yield event
+            outcome = "ok"
+        except InputGuardrailTripwireTriggered:
+            outcome = "guardrail_tripped"
+            raise
+        except MaxTurnsExceeded:
+            outcome = "max_turns"
+            raise
+        except TokenBudgetExceeded:
+            outcome = "budget_exceeded"
+            raise
+        except UpstreamError as e:
+            outcome = e.kind
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        finally:
+            await steps.aclose()
+            metrics.observe_stage("run", metrics.AGENT_RUN_SECONDS, started, agent.name, outcome)
+
+    @classmethod
+    async def _run_steps(
+        cls, agent, input_items, context, *,
+        parallel_guardrails: bool, stream: bool, max_turns: int, tool_timeout: float, max_handoffs: int,
+    ):
+        latest_user_message = cls._latest_user_message(input_items)
+        guarded = bool(getattr(agent, "input_guardrails", None)) and bool(latest_user_message)
+        messages = cls._build_messages(agent, input_items, context)
+
+        # Check guardrails first
+        if guarded and not parallel_guardrails:
+            results: List[StreamEvent] = []
+            await cls._run_input_guardrails(
+                agent, latest_user_message, context,
+                lambda guardrail, result: results.append(StreamEvent(
+                    type="guardrail_result", agent=agent,
+                    item=InputGuardrailResult(guardrail=guardrail, output=result),
+                )),
+            )
+            for event in results:
+                yield event
+
+        handoffs = 0
+        for turn in range(max_turns):
+            model_events = cls._model_events(agent, messages, stream, allow_handoffs=handoffs < max_handoffs)
+            if turn == 0 and guarded and parallel_guardrails:
+                # 只有第一次模型调用与守卫重叠；工具在所有守卫通过后才会执行
+                model_events = cls._gated_events(agent, latest_user_message, context, model_events)
+
+            message: Dict[str, Any] = {}
+            model: Optional[str] = None
+            try:
+                async for event in model_events:
+                    if event.type == "model_response":
+                        message, model = event.item, event.model
+                    else:
+                        yield event
+            finally:
+                # 运行被提前关闭时立即取消模型调用，而不是等生成器被回收
+                await model_events.aclose()
+
+            tool_calls = [
+                ToolCall(id=call["id"], name=call["function"]["name"], arguments=call["function"].get("arguments") or "{}")
+                for call in message.get("tool_calls") or []
+            ]
+            if message.get("content") or not tool_calls:
+                yield StreamEvent(
+                    type="run_item", agent=agent, model=model,
+                    item=MessageOutputItem(agent=agent, content=message.get("content") or ""),
+                )
+            if not tool_calls:
+                return
+
+            handoffs_by_name = agent.static_payload.handoffs_by_name
+            for call in tool_calls:
+                item_type = HandoffCallItem if call.name in handoffs_by_name else ToolCallItem
+                yield StreamEvent(type="run_item", agent=agent, item=item_type(agent=agent, raw_item=call))
+            # 同一步中的多个工具调用并发执行；一步中只执行第一个转接，且在工具执行完之后
+            handoff_call = next((call for call in tool_calls if call.name in handoffs_by_name), None)
+            function_calls = [call for call in tool_calls if call.name not in handoffs_by_name]
+            outputs = await asyncio.gather(*(
+                cls._invoke_tool(agent, call, context, tool_timeout) for call in function_calls
+            ))
+            for call in tool_calls:
+                if call.name in handoffs_by_name and call is not handoff_call:
+                    function_calls.append(call)
+                    outputs.append("错误：一次只能转接到一个代理")
+            if handoff_call is not None and handoffs >= max_handoffs:
+                function_calls.append(handoff_call)
+                outputs.append(f"错误：本次对话转接次数已达上限（{max_handoffs}次），请直接回复用户")
+                handoff_call = None
+            messages.append({
+                "role": "assistant",
+                "content": message.get("content") or None,
+                "tool_calls": [
+                    {"id": call.id, "type": "function", "function": {"name": call.name, "arguments": call.arguments}}
+                    for call in tool_calls
+                ],
+            })
+            for call, output in zip(function_calls, outputs):
+                messages.append({"role": "tool", "tool_call_id": call.id, "content": output})
+                yield StreamEvent(
+                    type="run_item", agent=agent,
+                    item=ToolCallOutputItem(agent=agent, output=output, call_id=call.id),
+                )
+
+            if handoff_call is not None:
+                # 在同一次运行中切换到目标代理，由它基于相同的对话继续回答
+                item = await cls._invoke_handoff(agent, handoff_call, context)
+                messages.append({"role": "tool", "tool_call_id": handoff_call.id, "content": item.output})
+                yield StreamEvent(type="run_item", agent=agent, item=item)
+                metrics.count_handoff(agent.name, item.target_agent.name, "model")
+                handoffs += 1
+                agent = item.target_agent
+                messages[0] = cls._system_message(agent, context)
+
+        raise MaxTurnsExceeded(max_turns)
+
+    @classmethod
+    def _run_options(cls, parallel_guardrails, max_turns, tool_timeout, max_handoffs) -> Dict[str, Any]:
+        return {
+            "parallel_guardrails": cls.parallel_guardrails if parallel_guardrails is None else parallel_guardrails,
+            "max_turns": max_turns or cls.max_turns,
+            "tool_timeout": tool_timeout or cls.tool_timeout,
+            "max_handoffs": cls.max_handoffs if max_handoffs is None else max_handoffs,
+        }
+
+    @classmethod
+    async def run(
+        cls, agent, input_items, context=None, *,
+        parallel_guardrails: Optional[bool] = None,
+        max_turns: Optional[int] = None,
+        tool_timeout: Optional[float] = None,
+        max_handoffs: Optional[int] = None,
+    ):
+        """Run an agent with input items and context"""
+        options = cls._run_options(parallel_guardrails, max_turns, tool_timeout, max_handoffs)
+        result = RunResult(input=input_items, last_agent=agent)
+        async for event in cls._iter_run(agent, input_items, context, stream=False, **options):
+            if event.type == "run_item":
+                result.new_items.append(event.item)
+                if isinstance(event.item, HandoffOutputItem):
+                    result.last_agent = event.item.target_agent
+        return result
+
+    @classmethod
+    async def check_input_guardrails(cls, agent, message: str, context=None) -> List[InputGuardrailResult]:
+        """
+        Run an agent's input guardrails without running the agent (e.g. before serving a cached reply).
+        Returns every result; raises InputGuardrailTripwireTriggered as soon as one trips.
+        """
+        results: List[InputGuardrailResult] = []
+        run_guardrails = cls._run_input_guardrails_concurrently if cls.parallel_guardrails else cls._run_input_guardrails
+        await run_guardrails(
+            agent, message, context,
+            lambda guardrail, output: results.append(InputGuardrailResult(guardrail=guardrail, output=output)),
+        )
+        return results
+
+    @classmethod
+    async def run_structured(
+        cls, agent, input_items, context=None,
+        accept: Optional[Callable[[Any], bool]] = None,
+        on_model: Optional[Callable[[str], None]] = None,
+    ):
+        """
+        Run an agent that has an output_type and return its validated output.
+        The reply is streamed through an incremental JSON parser: as soon as the fields
+        completed so far validate against output_type and accept(output) is true, the rest
+        of the generation is cancelled. Otherwise the whole reply is parsed strictly.
+        on_model, if given, is called with the model that produced the returned output
+        (which differs from the agent's first model after a fallback or adaptive downgrade).
+        Raises ModelBehaviorError when the reply does not match the output_type.
+        """
+        output_type = agent.output_type
+        result = cls.run_streamed(agent, input_items, context)
+        parser = IncrementalJSONParser() if accept is not None else None
+        events = result.stream_events()
+        model: Optional[str] = None
+        try:
+            async for event in events:
+                if event.model:
+                    model = event.model
+                if parser is None or event.type != "message_delta" or parser.done:
+                    continue
+                try:
+                    completed = parser.feed(event.delta)
+                except ValueError:
+                    # 不是合法的JSON，等回复结束后按严格解析报错
+                    parser = None
+                    continue
+                if not completed:
+                    continue
+                try:
+                    output = output_type.model_validate(parser.root)
+                except ValidationError:
+                    continue
+                if accept(output):
+                    if metrics.registry.enabled:
+                        metrics.STRUCTURED_EARLY_EXIT_TOTAL.inc(agent.name)
+                    if on_model is not None and model:
+                        on_model(model)
+                    return output
+        finally:
+            # 提前返回时关闭事件流，取消仍在生成的模型调用
+            await events.aclose()
+        output = result.to_result().final_output_as(output_type)
+        if on_model is not None and model:
+            on_model(model)
+        return output
+
+    @classmethod
+    def run_streamed(
+        cls, agent, input_items, context=None, *,
+        parallel_guardrails: Optional[bool] = None,
+        max_turns: Optional[int] = None,
+        tool_timeout: Optional[float] = None,
+        max_handoffs: Optional[int] = None,
+    ):
+        """Run an agent, streaming token deltas and run items as they are produced"""
+        options = cls._run_options(parallel_guardrails, max_turns, tool_timeout, max_handoffs)
+        return RunResultStreaming(cls._iter_run(agent, input_items, context, stream=True, **options), input_items, agent)
@@ -0,0 +1,138 @@
+"""
+进程内的Redis替身，实现会话存储用到的命令子集（PING/GET/MGET/SET/DEL/EXISTS/FLUSHDB及MULTI/EXEC事务等），
+用于在没有真实Redis的环境中测试多worker部署。
+
+单独运行（在python-backend目录下）：
+    python -m fake_redis --port 6379
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from redis_store import RedisError, read_reply
+
+def _encode_reply(value: Any) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RedisError):
+        return b"-%s\r\n" % str(value).encode("utf-8")
+    if isinstance(value, bool):
+        return b":%d\r\n" % int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode("utf-8")
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode_reply(v) for v in value)
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+class FakeRedisServer:
+    """单线程asyncio实现的内存键值服务，支持键过期。"""
+
+    def __init__(self):
+        # key -> (value, 过期时间或None)
+        self._data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self._server: Optional[asyncio.base_events.Server] = None
+        self.commands = 0
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> "FakeRedisServer":
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _live(self, key: bytes) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def execute(self, args: List[bytes]) -> Any:
+        self.commands += 1
+        name, args = args[0].upper().decode("ascii"), args[1:]
+        if name == "PING":
+            return "PONG"
+        if name in ("SELECT", "AUTH"):
+            return "OK"
+        if name == "GET":
+            return self._live(args[0])
+        if name == "MGET":
+            return [self._live(key) for key in args]
+        if name == "SET":
+            expires_at = None
+            options = [a.upper() for a in args[2:]]
+            if b"EX" in options:
+                expires_at = time.monotonic() + int(args[2 + options.index(b"EX") + 1])
+            elif b"PX" in options:
+                expires_at = time.monotonic() + int(args[2 + options.index(b"PX") + 1]) / 1000
+            self._data[args[0]] = (args[1], expires_at)
+            return "OK"
+        if name == "DEL":
+            return sum(self._data.pop(key, None) is not None for key in args)
+        if name == "EXISTS":
+            return sum(self._live(key) is not None for key in args)
+        if name == "DBSIZE":
+            return len(self._data)
+        if name == "FLUSHDB":
+            self._data.clear()
+            return "OK"
+        return RedisError(f"ERR unknown command '{name}'")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # MULTI之后排队的命令；服务是单线程的，EXEC时依次执行即为原子
+        queued: Optional[List[List[bytes]]] = None
+        try:
+            while True:
+                request = await read_reply(reader)
+                name = request[0].upper()
+                if name == b"MULTI":
+                    queued, reply = [], "OK"
+                elif name == b"EXEC":
+                    reply = [self.execute(command) for command in queued] if queued is not None else RedisError(
+                        "ERR EXEC without MULTI"
+                    )
+                    queued = None
+                elif queued is not None:
+                    queued.append(request)
+                    reply = "QUEUED"
+                else:
+                    reply = self.execute(request)
+                writer.write(_encode_reply(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+async def _serve(host: str, port: int) -> None:
+    server = await FakeRedisServer().start(host, port)
+    print(f"fake redis listening on {server.url}")
+    await asyncio.Event().wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    asyncio.run(_serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+from __future__ import annotations as _annotations
+
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from faq_index import FaqEntry, FaqHit, load_or_build_index, tokenize
+from guardrail_cache import normalize_message
+
+# =========================
+# FAQ知识库
+# =========================
+
+FAQ_DATA_PATH = os.environ.get("FAQ_DATA_PATH", os.path.join(os.path.dirname(__file__), "data", "faq.json"))
+# 可选的预构建索引文件；内容版本与数据文件不一致时会重新构建并覆盖
+FAQ_INDEX_PATH = os.environ.get("FAQ_INDEX_PATH") or None
+# 归一化BM25分数（0到1，见FaqIndex.search）低于该值的结果视为没有答案
+FAQ_MIN_SCORE = float(os.environ.get("FAQ_MIN_SCORE", "0.3"))
+
+FAQ_FALLBACK_ANSWER = "抱歉，我不知道这个问题的答案。"
+
+# 启动时构建（或加载）一次的进程级索引
+faq_index = load_or_build_index(FAQ_DATA_PATH, FAQ_INDEX_PATH)
+
+def search_faq(question: str, k: int = 3) -> List[FaqHit]:
+    """返回与问题最相关的k个FAQ条目及其分数。"""
+    return faq_index.search(question, k=k, min_score=FAQ_MIN_SCORE)
+
+def lookup_faq(question: str) -> Optional[FaqEntry]:
+    """返回与问题最相关的FAQ条目，没有足够相关的条目时返回None。"""
+    hits = search_faq(question, k=1)
+    return hits[0].entry if hits else None
+
+# =========================
+# 问题规范化
+# =========================
+
+# 同义词折叠到统一写法（中英文变体归一），按长度从长到短替换
+_SYNONYMS: Dict[str, Tuple[str, ...]] = {
+    "行李": ("luggage", "baggage", "bags", "bag", "行李箱", "托运物品", "箱子"),
+    "wifi": ("wi-fi", "wi fi", "wireless", "internet", "无线网络", "无线网", "上网", "网络"),
+    "座位": ("seats", "seat", "座椅", "位子"),
+    "飞机": ("aircraft", "airplane", "plane", "机舱"),
+    "限额": ("allowance", "limits", "limit", "限制", "额度", "规定"),
+    "费用": ("fees", "fee", "cost", "price", "收费", "价格", "多少钱"),
+}
+_SYNONYM_PATTERNS = tuple(
+    (canonical, re.compile(r"\b" + re.escape(variant) + r"\b" if variant.isascii() else re.escape(variant)))
+    for canonical, variant in sorted(
+        # 统一写法本身也参与替换，使其与相邻的字分开切分
+        ((c, v) for c, variants in _SYNONYMS.items() for v in (c, *variants)), key=lambda cv: -len(cv[1])
+    )
+)
+
+# 不影响问题含义的客套话、疑问词和虚词
+_CJK_FILLERS = (
+    "请问", "我想知道", "我想问", "想问一下", "问一下", "能告诉我", "告诉我", "一下",
+    "是多少", "有多少", "多少", "几个", "是什么", "什么", "怎么样", "如何",
+    "你们", "您们", "我的", "的", "吗", "呢", "啊", "吧", "呀", "是", "有", "上", "个",
+)
+_ENGLISH_STOPWORDS = frozenset({
+    "please", "can", "could", "you", "tell", "me", "what", "whats", "how", "many", "much", "is", "are",
+    "there", "the", "a", "an", "on", "of", "in", "my", "your", "about", "do", "does", "have", "i", "to",
+})
+def canonicalize_question(text: str) -> str:
+    """
+    把问题规范化为缓存键：统一大小写/全半角/标点，折叠同义词和中英文变体，
+    去掉客套话与疑问词，剩余部分按英文单词和中文字符二元组切分后排序去重。
+    例如"行李限额是多少？"和"What is the baggage allowance"得到同一个键；
+    按二元组而不是单字切分，字相同但词不同的问题（如"机票改签"和"改机票签"）不会共用一个键。
+    """
+    text = normalize_message(text).replace("'", "")
+    for canonical, pattern in _SYNONYM_PATTERNS:
+        text = pattern.sub(f" {canonical} ", text)
+    for filler in _CJK_FILLERS:
+        text = text.replace(filler, " ")
+    tokens = {token for token in tokenize(text) if token not in _ENGLISH_STOPWORDS}
+    return " ".join(sorted(tokens))
+
+# =========================
+# 答案缓存
+# =========================
+
+class FaqAnswerCache:
+    """
+    记录哪些问题已由FAQ代理原样用某个FAQ条目的答案作答，键为(条目ID, 规范化后的问题)。
+    缓存中只有条目ID，不保存任何一轮的回复：命中时用当前FAQ条目自己的答案构建回复，
+    因此不会把某个会话基于其历史和上下文生成的内容带给其他会话。
+    每个条目记录写入时的FAQ内容版本，内容版本变化后旧条目全部失效。
+    """
+
+    def __init__(self, version: str, max_entries: int = 1000, ttl_seconds: float = 24 * 3600.0):
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # (条目ID, 规范化后的问题) -> (过期时间, 写入时的FAQ内容版本)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls, version: str) -> "FaqAnswerCache":
+        return cls(
+            version,
+            max_entries=int(os.environ.get("FAQ_CACHE_MAX_ENTRIES", "1000")),
+            ttl_seconds=float(os.environ.get("FAQ_CACHE_TTL", str(24 * 3600))),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def set_version(self, version: str) -> None:
+        """FAQ内容更新后调用，丢弃基于旧内容的所有答案。"""
+        if version != self.version:
+            self.version = version
+            self._entries.clear()
+            self.invalidations += 1
+
+    def _key(self, question: str, entry: Optional[FaqEntry]) -> Optional[Tuple[str, str]]:
+        if not self.enabled or entry is None:
+            return None
+        canonical = canonicalize_question(question)
+        return (entry.id, canonical) if canonical else None
+
+    def get(self, question: str) -> Optional[FaqEntry]:
+        """问题当前对应的FAQ条目曾被原样用来回答该问题时，返回该条目。"""
+        entry = lookup_faq(question) if self.enabled else None
+        key = self._key(question, entry)
+        cached = self._entries.get(key) if key else None
+        if cached is None or cached[0] < time.monotonic() or cached[1] != self.version:
+            if cached is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, question: str, entry: FaqEntry) -> None:
+        """记录该问题由FAQ条目entry的答案原样作答。"""
+        key = self._key(question, entry)
+        if key is None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, self.version)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "version": self.version,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+# 进程级共享的FAQ答案缓存
+faq_answer_cache = FaqAnswerCache.from_env(faq_index.version)
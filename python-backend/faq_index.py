@@ -0,0 +1,265 @@
+"""
+FAQ知识库的倒排索引检索：中文字符n-gram与英文单词分词，BM25打分，返回带分数的top-k结果。
+
+预先构建索引文件（在python-backend目录下）：
+    python -m faq_index data/faq.json data/faq.idx
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import re
+import struct
+import unicodedata
+from array import array
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# =========================
+# 知识库条目
+# =========================
+
+@dataclass(frozen=True)
+class FaqEntry:
+    id: str
+    question: str
+    keywords: Tuple[str, ...]
+    answer: str
+
+def load_faq_entries(path: str) -> List[FaqEntry]:
+    """从JSON数据文件读取FAQ条目：[{"id", "question", "keywords", "answer"}, ...]。"""
+    with open(path, encoding="utf-8") as f:
+        return [
+            FaqEntry(id=str(item["id"]), question=item["question"], keywords=tuple(item.get("keywords", ())), answer=item["answer"])
+            for item in json.load(f)
+        ]
+
+def faq_content_version(entries: Iterable[FaqEntry]) -> str:
+    """FAQ内容的版本号：内容任何改动都会得到不同的版本。"""
+    data = json.dumps([asdict(entry) for entry in entries], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:12]
+
+# =========================
+# 分词
+# =========================
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_CJK_RUN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+# 疑问词、客套话等与主题无关的词项：几乎任何问题都可能包含，只靠它们匹配到的条目不算答案
+STOP_TERMS = frozenset({
+    "怎么", "么样", "么办", "什么", "么是", "是什", "为什", "可以", "能否", "是否", "有没", "没有",
+    "多少", "哪些", "哪里", "如何", "请问", "一下", "我的", "我们", "你们", "是不", "不是", "上有", "有什",
+    "吗", "呢", "吧", "啊",
+    "what", "how", "is", "are", "the", "a", "an", "do", "does", "can", "i", "my", "on", "in", "of", "to", "there",
+})
+
+def _fold_plural(word: str) -> str:
+    # 英文复数折叠为单数（bags -> bag），与旧的子串匹配一样让复数命中单数关键词
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+def tokenize(text: str) -> List[str]:
+    """英文按单词切分（复数折叠为单数）；中文连续片段切成字符二元组（单字片段保留单字）。去掉STOP_TERMS。"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = [_fold_plural(word) for word in _WORD_RE.findall(text)]
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return [token for token in tokens if token not in STOP_TERMS]
+
+def _document_text(entry: FaqEntry) -> str:
+    # 问题出现两次、人工整理的关键词出现三次，使其比答案正文权重更高
+    keywords = " ".join(entry.keywords)
+    return " ".join((entry.question, entry.question, keywords, keywords, keywords, entry.answer))
+
+# =========================
+# 倒排索引
+# =========================
+
+class FaqHit(NamedTuple):
+    entry: FaqEntry
+    score: float
+
+# 分词规则或文件格式变化时递增，旧格式的索引文件会被重新构建
+_MAGIC = b"FAQIDX3\n"
+
+class FaqIndex:
+    """
+    内存倒排索引。每个词项的倒排表存放在连续的数组片段中（文档号与词频分两个uint32数组，
+    预先计算的BM25分量为一个float64数组），因此索引可以整体写入文件，并通过mmap零拷贝加载。
+    """
+
+    k1 = 1.2
+    # 长度归一化弱于常用的0.75：条目长度主要取决于答案正文，不应让答案短的条目占优
+    b = 0.5
+    # 文档频率超过该比例的词项视为停用词
+    max_df_ratio = 0.2
+
+    def __init__(
+        self,
+        entries: Sequence[FaqEntry],
+        version: str,
+        terms: Dict[str, Tuple[int, int]],
+        doc_ids: Sequence[int],
+        term_freqs: Sequence[int],
+        doc_lengths: Sequence[int],
+        impacts: Optional[Sequence[float]] = None,
+    ):
+        self.entries = list(entries)
+        self.version = version
+        # 词项 -> (倒排表在数组中的起始位置, 文档频率)
+        self._terms = terms
+        self._doc_ids = doc_ids
+        self._term_freqs = term_freqs
+        self._doc_lengths = doc_lengths
+        # 每条倒排记录除idf以外的BM25分量，检索时只需一次乘加；从索引文件加载时直接引用文件映射
+        self._impacts = impacts if impacts is not None else self._compute_impacts(doc_ids, term_freqs, doc_lengths)
+        self._mmap: Optional[mmap.mmap] = None
+
+    @classmethod
+    def _compute_impacts(cls, doc_ids: Sequence[int], term_freqs: Sequence[int], doc_lengths: Sequence[int]) -> array:
+        average = (sum(doc_lengths) / len(doc_lengths)) if len(doc_lengths) else 1.0
+        norms = [cls.k1 * (1 - cls.b + cls.b * length / average) for length in doc_lengths]
+        return array("d", (tf * (cls.k1 + 1) / (tf + norms[doc_id]) for doc_id, tf in zip(doc_ids, term_freqs)))
+
+    @classmethod
+    def build(cls, entries: Sequence[FaqEntry]) -> "FaqIndex":
+        postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        doc_lengths = array("I")
+        for doc_id, entry in enumerate(entries):
+            tokens = tokenize(_document_text(entry))
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term].append((doc_id, tf))
+        terms: Dict[str, Tuple[int, int]] = {}
+        doc_ids, term_freqs = array("I"), array("I")
+        for term in sorted(postings):
+            terms[term] = (len(doc_ids), len(postings[term]))
+            for doc_id, tf in postings[term]:
+                doc_ids.append(doc_id)
+                term_freqs.append(tf)
+        return cls(entries, faq_content_version(entries), terms, doc_ids, term_freqs, doc_lengths)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def search(self, query: str, k: int = 5, min_score: float = 0.0) -> List[FaqHit]:
+        """
+        返回得分最高的k个条目（分数不低于min_score）。分数是归一化的BM25：
+        条目的BM25得分除以参与打分的查询词项都以最大词频命中时的得分，在0到1之间，
+        与查询长度和知识库大小无关，因此可以用固定的阈值判断是否算答案。
+        """
+        n = len(self.entries)
+        locations = [self._terms[term] for term in set(tokenize(query)) if term in self._terms]
+        # 出现在大部分条目中的词项近似停用词，idf很小却要遍历很长的倒排表；
+        # 只要查询中还有更有区分度的词项就跳过它们
+        selective = [loc for loc in locations if loc[1] <= n * self.max_df_ratio]
+        doc_ids, impacts = self._doc_ids, self._impacts
+        scores: Dict[int, float] = {}
+        get = scores.get
+        ideal = 0.0
+        for start, df in selective or locations:
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            ideal += idf * (self.k1 + 1)
+            for i in range(start, start + df):
+                doc_id = doc_ids[i]
+                scores[doc_id] = get(doc_id, 0.0) + idf * impacts[i]
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [FaqHit(self.entries[doc_id], score / ideal) for doc_id, score in best if score >= min_score * ideal]
+
+    # ---------- 序列化 ----------
+
+    def save(self, path: str) -> None:
+        """
+        写入索引文件：魔数、头部长度、JSON头部（条目、词项表及BM25参数）、
+        按8字节对齐的float64 BM25分量数组，以及文档号、词频、文档长度三个uint32数组。
+        """
+        header = json.dumps({
+            "version": self.version,
+            "entries": [asdict(entry) for entry in self.entries],
+            "terms": self._terms,
+            "postings": len(self._doc_ids),
+            "documents": len(self._doc_lengths),
+            "k1": self.k1,
+            "b": self.b,
+        }, ensure_ascii=False).encode("utf-8")
+        header += b" " * (-(len(_MAGIC) + 8 + len(header)) % 8)
+        with open(path, "wb") as f:
+            f.write(_MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.write(array("d", self._impacts).tobytes())
+            for values in (self._doc_ids, self._term_freqs, self._doc_lengths):
+                f.write(array("I", values).tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> "FaqIndex":
+        """
+        通过mmap加载索引文件，倒排表和BM25分量直接引用文件映射，不复制到Python对象中。
+        文件中的BM25参数与当前的k1、b不同时，BM25分量重新计算。
+        """
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(_MAGIC)] != _MAGIC:
+            mapped.close()
+            raise ValueError(f"{path}不是FAQ索引文件")
+        (header_length,) = struct.unpack_from("<Q", mapped, len(_MAGIC))
+        offset = len(_MAGIC) + 8
+        header = json.loads(mapped[offset:offset + header_length])
+        offset += header_length
+        view = memoryview(mapped)
+        postings, documents = header["postings"], header["documents"]
+        impacts = view[offset:offset + 8 * postings].cast("d")
+        offset += 8 * postings
+        doc_ids = view[offset:offset + 4 * postings].cast("I")
+        offset += 4 * postings
+        term_freqs = view[offset:offset + 4 * postings].cast("I")
+        offset += 4 * postings
+        doc_lengths = view[offset:offset + 4 * documents].cast("I")
+        entries = [
+            FaqEntry(id=item["id"], question=item["question"], keywords=tuple(item["keywords"]), answer=item["answer"])
+            for item in header["entries"]
+        ]
+        terms = {term: (start, df) for term, (start, df) in header["terms"].items()}
+        if (header["k1"], header["b"]) != (cls.k1, cls.b):
+            impacts = None
+        index = cls(entries, header["version"], terms, doc_ids, term_freqs, doc_lengths, impacts)
+        index._mmap = mapped
+        return index
+
+def load_or_build_index(data_path: str, index_path: Optional[str] = None) -> FaqIndex:
+    """
+    启动时获取FAQ索引：index_path处的预构建索引与数据文件内容版本一致时直接mmap加载，
+    否则从数据文件构建（并在给定index_path时写入，供下次启动使用）。
+    """
+    entries = load_faq_entries(data_path)
+    if index_path:
+        try:
+            index = FaqIndex.load(index_path)
+            if index.version == faq_content_version(entries):
+                return index
+        except (OSError, ValueError):
+            pass
+    index = FaqIndex.build(entries)
+    if index_path:
+        index.save(index_path)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_path", help="FAQ数据文件（JSON）")
+    parser.add_argument("index_path", help="输出的索引文件")
+    args = parser.parse_args()
+    index = FaqIndex.build(load_faq_entries(args.data_path))
+    index.save(args.index_path)
+    print(f"已为{len(index)}个条目构建索引（版本{index.version}）：{args.index_path}")
+
+if __name__ == "__main__":
+    main()
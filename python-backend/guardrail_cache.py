@@ -0,0 +1,103 @@
+from __future__ import annotations as _annotations
+
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+# 规范化时去除的首尾标点（中英文）
+_EDGE_PUNCTUATION = "!！?？.。,，~～…、;；:：\"'“”‘’()（）[]【】 "
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def normalize_message(text: str) -> str:
+    """
+    将用户消息规范化为缓存键：全角转半角、小写、合并空白、去除首尾标点。
+    例如"你好！"、" 你好 "和"你好。"得到同一个键。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _WHITESPACE_RE.sub(" ", text)
+    return text.strip(_EDGE_PUNCTUATION)
+
+class GuardrailVerdictCache:
+    """
+    守卫判定结果的有界LRU+TTL缓存。
+    键为(守卫名称, 守卫模型, 规范化后的最新用户消息)，值为RelevanceOutput/JailbreakOutput等判定。
+    """
+
+    def __init__(self, max_entries: int = 10_000, ttl_seconds: float = 3600.0, max_message_length: int = 512):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_message_length = max_message_length
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[float, BaseModel]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls) -> "GuardrailVerdictCache":
+        return cls(
+            max_entries=int(os.environ.get("GUARDRAIL_CACHE_MAX_ENTRIES", "10000")),
+            ttl_seconds=float(os.environ.get("GUARDRAIL_CACHE_TTL", "3600")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def _key(self, guardrail_name: str, model: str, message: str) -> Optional[Tuple[str, str, str]]:
+        normalized = normalize_message(message)
+        if not normalized or len(normalized) > self.max_message_length:
+            return None
+        return (guardrail_name, model, normalized)
+
+    def get(self, guardrail_name: str, model: str, message: str) -> Optional[BaseModel]:
+        key = self._key(guardrail_name, model, message) if self.enabled else None
+        entry = self._entries.get(key) if key else None
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, verdict = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return verdict
+
+    def contains(self, guardrail_name: str, model: str, message: str) -> bool:
+        """是否有未过期的缓存判定；不计入命中率，也不调整LRU顺序。"""
+        key = self._key(guardrail_name, model, message) if self.enabled else None
+        entry = self._entries.get(key) if key else None
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def put(self, guardrail_name: str, model: str, message: str, verdict: BaseModel) -> None:
+        key = self._key(guardrail_name, model, message) if self.enabled else None
+        if key is None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+# 进程级共享的守卫判定缓存
+guardrail_verdict_cache = GuardrailVerdictCache.from_env()
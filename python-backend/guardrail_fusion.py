@@ -0,0 +1,219 @@
+"""
+融合守卫：同一代理上的多个LLM守卫对同一条用户消息只发起一次上游调用。
+
+各守卫登记自己的守卫代理（指令）、判定模式和本地判定（预分类器）。一次运行中第一个需要调用LLM的守卫
+找出同一代理上其余同样需要LLM（本地判定和判定缓存都未命中）的守卫，用合并的指令和合并的JSON模式
+发起一次调用，再把结果按守卫拆开；其余守卫直接取走自己的那一份。合并模式先列出各守卫的判定字段、
+再列出各自的理由，调用以流式结构化输出运行，所有守卫都判定通过后即结束生成，不等待理由。只剩一个守卫、守卫未登记、输入不是字符串或合并输出无法解析时，
+退回各自单独调用。
+"""
+from __future__ import annotations as _annotations
+
+import asyncio
+import logging
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from pydantic import BaseModel, create_model
+
+import metrics
+from deepseek_agent import Agent, ModelBehaviorError, RunContextWrapper, Runner
+from guardrail_cache import guardrail_verdict_cache
+from model_tiers import model_router
+
+logger = logging.getLogger(__name__)
+
+# 合并调用使用的代理名称：在data/models.json中为它配置模型链，用量也记在该名称下
+FUSED_AGENT_NAME = "融合守卫"
+
+class FusableGuardrail(NamedTuple):
+    # 守卫名称，与input_guardrail(name=...)一致
+    name: str
+    # 合并指令中该守卫的项名，其理由在合并JSON中的键为"<key>_reasoning"
+    key: str
+    agent: Agent
+    output_type: Type[BaseModel]
+    # 本地判定；返回非None时该守卫不需要调用LLM
+    local: Callable[[str], Optional[BaseModel]]
+    # 判定模式中表示通过的布尔字段（如is_relevant），应为第一个字段，以便流式输出时尽早得到判定
+    verdict_field: str
+
+    def passed(self, verdict: BaseModel) -> bool:
+        return bool(getattr(verdict, self.verdict_field))
+
+    def fail_closed(self, reasoning: str) -> BaseModel:
+        """判定无法得到时使用的未通过判定。"""
+        return self.output_type.model_validate({self.verdict_field: False, "reasoning": reasoning})
+
+_SENTENCE_RE = re.compile(r"[^。！？!?]+[。！？!?]?")
+
+def build_fused_instructions(members: List[FusableGuardrail]) -> str:
+    """
+    合并各守卫的指令；前面的守卫已经出现过的句子（如"只评估最近的用户消息"）不再重复。
+    输出格式提示由合并代理的output_type生成。
+    """
+    sections = ["按以下各项的说明，分别独立判定最近的用户消息，各项的理由写入“项名_reasoning”。"]
+    seen = set()
+    for member in members:
+        sentences = [s for s in _SENTENCE_RE.findall(member.agent.instructions) if s not in seen]
+        seen.update(sentences)
+        sections.append(f"### {member.key}（{member.name}）\n{''.join(sentences)}")
+    return "\n\n".join(sections)
+
+class _FusedBatch:
+    """一次合并调用：task的结果为({守卫名称: 判定}, 给出判定的模型)，合并输出无法解析时判定为空字典。"""
+
+    def __init__(self, task: "asyncio.Task[Tuple[Dict[str, BaseModel], Optional[str]]]", members: List[str]):
+        self.task = task
+        self.members = members
+        self.waiters = 0
+
+FUSION_TOTAL = metrics.registry.counter(
+    "cs_guardrail_fusion_total",
+    "守卫LLM判定的方式：fused（合并调用中的一项）、separate（单独调用）或parse_fallback（合并输出无法解析后单独调用）",
+    ("guardrail", "mode"),
+)
+
+class GuardrailFuser:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._specs: Dict[str, FusableGuardrail] = {}
+        # 按成员组合缓存合并代理（其output_type为合并的判定模式）
+        self._fused: Dict[Tuple[str, ...], Agent] = {}
+        self.fused_calls = 0
+        self.fused_verdicts = 0
+        self.separate_calls = 0
+        self.parse_failures = 0
+
+    @classmethod
+    def from_env(cls) -> "GuardrailFuser":
+        return cls(enabled=os.environ.get("GUARDRAIL_FUSION", "true").lower() in ("true", "1", "yes"))
+
+    def register(self, spec: FusableGuardrail) -> None:
+        self._specs[spec.name] = spec
+
+    def _fused_agent(self, members: List[FusableGuardrail]) -> Agent:
+        key = tuple(member.key for member in members)
+        agent = self._fused.get(key)
+        if agent is None:
+            # 如{"is_relevant": 布尔值, "is_safe": 布尔值, "relevance_reasoning": 字符串, ...}
+            fields: Dict[str, Any] = {member.verdict_field: (bool, ...) for member in members}
+            fields.update({f"{member.key}_reasoning": (str, "") for member in members})
+            output_model = create_model("FusedGuardrailOutput", **fields)
+            agent = self._fused[key] = Agent(
+                name=FUSED_AGENT_NAME,
+                model=members[0].agent.model,
+                instructions=build_fused_instructions(members),
+                output_type=output_model,
+            )
+        return agent
+
+    def _pending_members(self, guarded_agent, message: str) -> List[FusableGuardrail]:
+        """被守卫代理上需要调用LLM的已登记守卫。"""
+        members = []
+        for guardrail in guarded_agent.input_guardrails:
+            spec = self._specs.get(getattr(guardrail, "name", None))
+            if spec is None or spec.local(message) is not None:
+                continue
+            if guardrail_verdict_cache.contains(spec.name, model_router.primary(spec.agent), message):
+                continue
+            members.append(spec)
+        # 判定字段在合并模式中不能重名
+        if len({member.verdict_field for member in members}) < len(members):
+            return []
+        return members
+
+    async def _run_fused(
+        self, members: List[FusableGuardrail], context: Any, message: str
+    ) -> Tuple[Dict[str, BaseModel], Optional[str]]:
+        agent = self._fused_agent(members)
+        self.fused_calls += 1
+        models: List[str] = []
+        try:
+            # 所有守卫都通过时不必等待最后一项的理由输出完
+            parsed = await Runner.run_structured(
+                agent, message, context=context,
+                accept=lambda output: all(getattr(output, member.verdict_field) for member in members),
+                on_model=models.append,
+            )
+        except ModelBehaviorError as e:
+            # 各项守卫改为单独调用，计入cs_guardrail_fusion_total{mode="parse_fallback"}
+            logger.debug("合并守卫的输出无法解析，改为单独调用：%s", e)
+            self.parse_failures += 1
+            return {}, None
+        verdicts = {
+            member.name: member.output_type.model_validate({
+                member.verdict_field: getattr(parsed, member.verdict_field),
+                "reasoning": getattr(parsed, f"{member.key}_reasoning"),
+            })
+            for member in members
+        }
+        return verdicts, models[-1] if models else None
+
+    async def evaluate(
+        self,
+        name: str,
+        context: RunContextWrapper,
+        guarded_agent,
+        message: Any,
+        separate: Callable[[], Awaitable[BaseModel]],
+        on_model: Optional[Callable[[str], None]] = None,
+    ) -> BaseModel:
+        """
+        返回守卫name对message的判定：能合并时取合并调用中的一份，否则调用separate()单独判定。
+        合并调用挂在本次运行的RunContextWrapper上，因此只在同一次运行的守卫之间共享。
+        判定来自合并调用时，以给出它的模型调用on_model；单独判定由separate()自行报告模型。
+        """
+        if not self.enabled or not isinstance(message, str) or name not in self._specs:
+            return await self._separate(name, separate, "separate")
+
+        batches: Dict[str, _FusedBatch] = context.__dict__.setdefault("_fused_guardrails", {})
+        batch = batches.get(message)
+        if batch is None or batch.task.cancelled():
+            members = self._pending_members(guarded_agent, message)
+            if len(members) < 2 or name not in (member.name for member in members):
+                return await self._separate(name, separate, "separate")
+            task = asyncio.ensure_future(self._run_fused(members, context.context, message))
+            batch = batches[message] = _FusedBatch(task, [member.name for member in members])
+        if name not in batch.members:
+            return await self._separate(name, separate, "separate")
+
+        batch.waiters += 1
+        try:
+            # 其他守卫可能仍在等待同一个合并调用，单个守卫被取消时不取消它
+            verdicts, model = await asyncio.shield(batch.task)
+        except asyncio.CancelledError:
+            batch.waiters -= 1
+            if batch.waiters == 0:
+                batch.task.cancel()
+            raise
+        batch.waiters -= 1
+        verdict = verdicts.get(name)
+        if verdict is None:
+            return await self._separate(name, separate, "parse_fallback")
+        self.fused_verdicts += 1
+        if metrics.registry.enabled:
+            FUSION_TOTAL.inc(name, "fused")
+        if on_model is not None and model:
+            on_model(model)
+        return verdict
+
+    async def _separate(self, name: str, separate: Callable[[], Awaitable[BaseModel]], mode: str) -> BaseModel:
+        self.separate_calls += 1
+        if metrics.registry.enabled:
+            FUSION_TOTAL.inc(name, mode)
+        return await separate()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "guardrails": sorted(self._specs),
+            "fused_calls": self.fused_calls,
+            "fused_verdicts": self.fused_verdicts,
+            "separate_calls": self.separate_calls,
+            "parse_failures": self.parse_failures,
+        }
+
+# 进程级共享的守卫合并器
+guardrail_fuser = GuardrailFuser.from_env()
@@ -0,0 +1,144 @@
+from __future__ import annotations as _annotations
+
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from guardrail_cache import normalize_message
+
+# =========================
+# 多模式匹配自动机
+# =========================
+
+class AhoCorasick:
+    """
+    Aho-Corasick多关键词自动机：构建一次，之后对每条消息只需线性扫描一遍，
+    与关键词数量无关。
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[str, ...]] = [()]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build_links()
+
+    def _add(self, pattern: str) -> None:
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = nxt
+        self._output[state] += (pattern,)
+
+    def _build_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._output[nxt] += self._output[self._fail[nxt]]
+
+    def find_first(self, text: str) -> Optional[str]:
+        """返回文本中第一个匹配到的关键词，没有则返回None。"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                return output[state][0]
+        return None
+
+# =========================
+# 规则
+# =========================
+
+# 本地拦截没有LLM复核：命中即拒绝，守卫模型没有机会纠正。因此这里只收录明确针对模型自身指令或设定的完整说法，
+# 误报预算为零——正常的航空客服消息一条都不能命中（tests/test_guardrail_prefilter.py中的正常消息集）。
+# "系统消息"、"提示词"、"delete from"这类单独出现时可能是正常说法的词（"我收到一条系统消息说航班取消了"、
+# "delete from my itinerary the return leg"）不在其中，这类消息交给LLM守卫判断。
+# 新增规则前应先把会误伤的正常说法加入测试中的正常消息集。
+
+# 提示词泄露与越狱的完整说法（匹配前会去掉空白，因此这里不含空格）
+INJECTION_KEYWORDS = (
+    "扮演一个没有限制", "进入开发者模式", "启用开发者模式", "开启开发者模式", "dan模式",
+    "ignorepreviousinstructions", "ignoreallpreviousinstructions", "ignoretheaboveinstructions",
+    "ignoreyourinstructions", "disregardpreviousinstructions", "disregardallpreviousinstructions",
+    "enterdevelopermode", "enabledevelopermode", "doanythingnow",
+)
+
+# 要求无视或泄露模型指令的句式，以及代码注入/SQL注入等结构化特征
+INJECTION_PATTERNS = (
+    re.compile(r"(忽略|无视|忘记|忘掉)\s*(之前|以上|上面|前面|先前|所有|全部|你的)\S{0,6}?(指令|提示词|系统设定)"),
+    re.compile(r"(输出|显示|打印|重复|泄露|展示|告诉我|给我看)\s*(一下)?\s*(你的)?\s*(系统提示词|系统指令|初始指令|提示词)"),
+    re.compile(r"\b(ignore|disregard|forget)\s+(all\s+)?(of\s+)?(the\s+|your\s+)?(previous|prior|above|earlier|system)\s+(instructions|prompts?)\b"),
+    re.compile(r"\b(reveal|print|show|repeat|output)\s+(me\s+)?(your|the)\s+(system|initial)\s+prompt\b"),
+    re.compile(r"\b(drop|truncate|alter)\s+table\s+\w+"),
+    re.compile(r"\bdelete\s+from\s+\w+\s*(;|\bwhere\b)"),
+    re.compile(r"\bunion\s+(all\s+)?select\b"),
+    re.compile(r"(^|')\s*or\s+'?\d+'?\s*=\s*'?\d+"),
+    re.compile(r"<\s*script\b"),
+    re.compile(r"\brm\s+-rf\s+/"),
+)
+
+# 无需调用模型即可放行的对话性消息（规范化后的完整消息）
+CONVERSATIONAL_FILLERS = frozenset({
+    "你好", "您好", "嗨", "哈喽", "在吗", "在么", "早上好", "下午好", "晚上好",
+    "好", "好的", "好吧", "行", "可以", "嗯", "嗯嗯", "对", "对的", "是", "是的", "没错", "正确",
+    "谢谢", "谢谢你", "谢谢您", "多谢", "感谢", "非常感谢", "不客气", "没问题", "明白", "明白了", "知道了",
+    "不用了", "没有了", "就这些", "再见", "拜拜",
+    "hi", "hello", "hey", "ok", "okay", "yes", "no", "sure", "thanks", "thank you", "thx", "bye", "goodbye",
+})
+
+@dataclass(frozen=True)
+class PrefilterVerdict:
+    """本地预分类的确定结论。"""
+    safe: bool
+    relevant: Optional[bool]
+    reason: str
+
+class GuardrailPrefilter:
+    """
+    在LLM守卫之前运行的本地确定性预分类。
+    只在有把握时给出结论（明确的注入/提示词泄露说法，或纯对话性消息），否则返回None交给LLM判断；
+    只命中单个可疑词的消息不在本地拦截。
+    """
+
+    def __init__(
+        self,
+        keywords: Iterable[str] = INJECTION_KEYWORDS,
+        patterns: Iterable[re.Pattern] = INJECTION_PATTERNS,
+        fillers: Iterable[str] = CONVERSATIONAL_FILLERS,
+    ):
+        self._keywords = AhoCorasick(keywords)
+        self._patterns = tuple(patterns)
+        self._fillers = frozenset(fillers)
+
+    def classify(self, message: str) -> Optional[PrefilterVerdict]:
+        normalized = normalize_message(message)
+        if normalized in self._fillers:
+            return PrefilterVerdict(safe=True, relevant=True, reason=f"对话性消息「{normalized}」，本地预分类直接放行")
+        keyword = self._keywords.find_first(normalized.replace(" ", ""))
+        if keyword is not None:
+            return PrefilterVerdict(safe=False, relevant=None, reason=f"命中提示词泄露/越狱特征「{keyword}」")
+        for pattern in self._patterns:
+            match = pattern.search(normalized)
+            if match:
+                return PrefilterVerdict(safe=False, relevant=None, reason=f"命中注入特征「{match.group(0)}」")
+        return None
+
+# 进程级共享的预分类器（自动机只构建一次）
+guardrail_prefilter = GuardrailPrefilter()
@@ -0,0 +1,233 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from deepseek_agent import Agent, MessageOutputItem, RunContextWrapper, Runner
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# 本地token估算
+# =========================
+
+# 中日韩字符及全角标点大致各占一个token，其余文本约每4个字符一个token
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """不依赖分词器的token数估算，偏保守。"""
+    if not text:
+        return 0
+    cjk = len(text) - len(_CJK_RE.sub("", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def message_tokens(item: Dict[str, Any]) -> int:
+    """估算一条聊天消息（含工具调用）的token数。"""
+    tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(item.get("content"))
+    for call in item.get("tool_calls") or []:
+        function = call.get("function") or {}
+        tokens += estimate_tokens(function.get("name")) + estimate_tokens(function.get("arguments"))
+    return tokens
+
+# =========================
+# 滚动摘要
+# =========================
+
+SUMMARY_INSTRUCTIONS = (
+    "你是对话摘要助手。根据已有摘要和新的对话片段，用不超过200字的中文更新摘要。"
+    "保留用户的诉求、已提供的确认号/航班号/座位号等关键信息，以及已完成和未完成的事项。只输出摘要本身。"
+)
+
+summarizer_agent = Agent(
+    name="对话摘要代理",
+    model="qwen-turbo",
+    instructions=SUMMARY_INSTRUCTIONS,
+)
+
+_ROLE_LABELS = {"user": "用户", "assistant": "助手", "tool": "工具结果"}
+
+def _render_transcript(previous_summary: str, items: List[Dict[str, Any]]) -> str:
+    lines = [f"已有摘要：{previous_summary or '（无）'}", "", "新的对话："]
+    for item in items:
+        if item.get("content"):
+            lines.append(f"{_ROLE_LABELS.get(item.get('role'), item.get('role'))}：{item['content']}")
+        for call in item.get("tool_calls") or []:
+            function = call.get("function") or {}
+            lines.append(f"助手调用工具：{function.get('name')}({function.get('arguments')})")
+    return "\n".join(lines)
+
+async def summarize_with_llm(previous_summary: str, items: List[Dict[str, Any]]) -> str:
+    """用摘要代理把已有摘要和新折叠的对话合并为新的摘要。"""
+    result = await Runner.run(summarizer_agent, _render_transcript(previous_summary, items))
+    outputs = [item.content for item in result.new_items if isinstance(item, MessageOutputItem)]
+    return outputs[-1].strip() if outputs else previous_summary
+
+# =========================
+# 历史管理
+# =========================
+
+class HistoryManager:
+    """
+    会话历史管理。
+    - state["input_items"]保存完整对话记录，state["token_counts"]增量地记录每条消息的估算token数；
+    - 每轮按代理构建提示窗口：扣除该代理的系统提示与工具定义后，在预算内保留最近的完整轮次；
+    - 较早的轮次在后台折叠进state["summary"]（滚动摘要），摘要完成后在下一轮请求时生效，
+      因此摘要调用从不出现在请求路径上。
+    """
+
+    # 未摘要部分超过预算的该比例时开始折叠，折叠后剩余部分不超过预算的一半
+    fold_trigger_ratio = 0.75
+    fold_target_ratio = 0.5
+
+    def __init__(
+        self,
+        token_budget: int = 3000,
+        agent_budgets: Optional[Dict[str, int]] = None,
+        summarize: Callable[[str, List[Dict[str, Any]]], Awaitable[str]] = summarize_with_llm,
+        max_pending_summaries: int = 10_000,
+    ):
+        self.token_budget = token_budget
+        self.agent_budgets = dict(agent_budgets or {})
+        self.summarize = summarize
+        self.max_pending_summaries = max_pending_summaries
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # 已完成但尚未写回会话状态的摘要：conversation_id -> summary
+        self._completed: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # 按代理静态负载指纹缓存的工具定义token数
+        self._tool_tokens: Dict[tuple, int] = {}
+        self.summaries = 0
+        self.summary_failures = 0
+
+    @classmethod
+    def from_env(cls) -> "HistoryManager":
+        return cls(token_budget=int(os.environ.get("HISTORY_TOKEN_BUDGET", "3000")))
+
+    def budget_for(self, agent) -> int:
+        return self.agent_budgets.get(agent.name, self.token_budget)
+
+    @staticmethod
+    def token_counts(state: Dict[str, Any]) -> List[int]:
+        """返回与input_items一一对应的token数，只为新增的消息计算。"""
+        items = state["input_items"]
+        counts = state.setdefault("token_counts", [])
+        if len(counts) > len(items):
+            counts.clear()
+        counts.extend(message_tokens(item) for item in items[len(counts):])
+        return counts
+
+    def _agent_overhead(self, agent, context) -> int:
+        payload = agent.static_payload
+        tools = self._tool_tokens.get(payload.fingerprint)
+        if tools is None:
+            tools = estimate_tokens(json.dumps(list(payload.tools), ensure_ascii=False)) if payload.tools else 0
+            self._tool_tokens[payload.fingerprint] = tools
+        instructions = payload.instructions
+        if instructions is None:
+            instructions = agent.instructions(RunContextWrapper(context), agent)
+        return tools + estimate_tokens(instructions) + MESSAGE_OVERHEAD_TOKENS
+
+    def _apply_completed_summary(self, conversation_id: str, state: Dict[str, Any]) -> None:
+        summary = self._completed.pop(conversation_id, None)
+        current = state.get("summary")
+        if summary is None or summary["upto"] > len(state["input_items"]):
+            return
+        if current is None or summary["upto"] > current["upto"]:
+            state["summary"] = summary
+
+    def window(self, conversation_id: str, agent, state: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """构建发送给agent的消息窗口：滚动摘要 + 预算内最近的完整轮次（至少包含最新一轮）。"""
+        self._apply_completed_summary(conversation_id, state)
+        items = state["input_items"]
+        counts = self.token_counts(state)
+        summary = state.get("summary")
+        floor = summary["upto"] if summary else 0
+        budget = self.budget_for(agent) - self._agent_overhead(agent, state["context"])
+        if summary:
+            budget -= summary["tokens"]
+
+        # 从最新的消息向前累加，只在用户消息处截断，避免工具调用与其结果被拆开
+        start = len(items)
+        used = 0
+        for i in range(len(items) - 1, floor - 1, -1):
+            used += counts[i]
+            if used > budget:
+                break
+            if items[i].get("role") == "user":
+                start = i
+        if start == len(items):
+            # 最新一轮本身超出预算时仍完整保留
+            start = next((i for i in range(len(items) - 1, floor - 1, -1) if items[i].get("role") == "user"), floor)
+
+        window = items[start:]
+        if summary:
+            window = [{"role": "system", "content": f"此前对话的摘要：{summary['text']}"}] + window
+        return window
+
+    def schedule_summary(self, conversation_id: str, state: Dict[str, Any]) -> None:
+        """未摘要部分过长时，在后台把较早的轮次折叠进滚动摘要。"""
+        if conversation_id in self._tasks:
+            return
+        items = state["input_items"]
+        counts = self.token_counts(state)
+        summary = state.get("summary")
+        floor = summary["upto"] if summary else 0
+        remaining = sum(counts[floor:])
+        if remaining <= self.token_budget * self.fold_trigger_ratio:
+            return
+
+        # 折叠到第一个使剩余部分不超过目标的用户消息边界，最新一轮永远不折叠
+        target = self.token_budget * self.fold_target_ratio
+        upto = floor
+        for i in range(floor, len(items)):
+            if i > floor and items[i].get("role") == "user":
+                upto = i
+                if remaining <= target:
+                    break
+            remaining -= counts[i]
+        if upto == floor:
+            return
+
+        previous = summary["text"] if summary else ""
+        task = asyncio.create_task(self._summarize(conversation_id, previous, items[floor:upto], upto))
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+
+    async def _summarize(self, conversation_id: str, previous: str, items: List[Dict[str, Any]], upto: int) -> None:
+        try:
+            text = await self.summarize(previous, items)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.summary_failures += 1
+            logger.exception("生成对话摘要失败")
+            return
+        self.summaries += 1
+        self._completed[conversation_id] = {"text": text, "upto": upto, "tokens": estimate_tokens(text)}
+        self._completed.move_to_end(conversation_id)
+        while len(self._completed) > self.max_pending_summaries:
+            self._completed.popitem(last=False)
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "token_budget": self.token_budget,
+            "summaries_in_flight": len(self._tasks),
+            "summaries_pending_apply": len(self._completed),
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+        }
+
+# 进程级共享的历史管理器
+history_manager = HistoryManager.from_env()
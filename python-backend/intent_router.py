@@ -0,0 +1,146 @@
+from __future__ import annotations as _annotations
+
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from guardrail_cache import normalize_message
+
+# 不属于任何专门代理、需要分流代理自己处理的意图
+OTHER_INTENT = "other"
+
+_WORD_RE = re.compile(r"[a-z]+")
+_CJK_RUN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+def extract_features(text: str) -> Counter:
+    """中文连续片段取字符1-3元组，英文取单词和相邻词二元组。"""
+    normalized = normalize_message(text)
+    words = _WORD_RE.findall(normalized)
+    features: Counter = Counter(f"w:{word}" for word in words)
+    features.update(f"w:{a} {b}" for a, b in zip(words, words[1:]))
+    for run in _CJK_RUN_RE.findall(normalized):
+        for n in (1, 2, 3):
+            features.update(run[i:i + n] for i in range(len(run) - n + 1))
+    return features
+
+class IntentPrediction(NamedTuple):
+    intent: str
+    confidence: float
+
+class IntentRouter:
+    """
+    本地意图分类：基于字符n-gram的多项式朴素贝叶斯，从标注文件训练，启动时训练一次即可。
+    分类结果是某个专门代理且置信度不低于threshold时才给出路由，否则交回分流代理的LLM。
+    相互重叠的n-gram并不独立，原始后验概率明显偏高，因此用temperature把对数得分缩放后再归一化。
+    temperature按留出集（data/intents_heldout.jsonl）选取：阈值0.8时直接路由的留出样本中误路由不超过一成。
+    """
+
+    def __init__(self, threshold: float = 0.8, alpha: float = 0.5, temperature: float = 3.0):
+        self.threshold = threshold
+        self.alpha = alpha
+        self.temperature = temperature
+        self._log_priors: Dict[str, float] = {}
+        self._log_likelihoods: Dict[str, Dict[str, float]] = {}
+        self._log_unseen: Dict[str, float] = {}
+        self._vocabulary: frozenset = frozenset()
+        self.routed: Counter = Counter()
+        self.fallbacks = 0
+
+    @classmethod
+    def from_file(cls, path: str, threshold: float = 0.8) -> "IntentRouter":
+        """从JSON Lines标注文件训练：每行{"text": ..., "intent": ...}。"""
+        router = cls(threshold=threshold)
+        router.train((example["text"], example["intent"]) for example in load_examples(path))
+        return router
+
+    def train(self, examples: Iterable[Tuple[str, str]]) -> None:
+        documents: Counter = Counter()
+        feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        for text, intent in examples:
+            documents[intent] += 1
+            feature_counts[intent].update(extract_features(text))
+        vocabulary = set().union(*feature_counts.values())
+        total = sum(documents.values())
+        self._vocabulary = frozenset(vocabulary)
+        self._log_priors = {intent: math.log(count / total) for intent, count in documents.items()}
+        for intent, counts in feature_counts.items():
+            denominator = sum(counts.values()) + self.alpha * len(vocabulary)
+            self._log_likelihoods[intent] = {
+                feature: math.log((count + self.alpha) / denominator) for feature, count in counts.items()
+            }
+            self._log_unseen[intent] = math.log(self.alpha / denominator)
+
+    def predict(self, text: str) -> Optional[IntentPrediction]:
+        """返回最可能的意图及其后验概率；消息中没有任何已知特征时返回None。"""
+        features = [(f, n) for f, n in extract_features(text).items() if f in self._vocabulary]
+        if not features or not self._log_priors:
+            return None
+        scores = {
+            intent: prior + sum(
+                n * self._log_likelihoods[intent].get(f, self._log_unseen[intent]) for f, n in features
+            )
+            for intent, prior in self._log_priors.items()
+        }
+        best = max(scores, key=scores.get)
+        normalizer = sum(math.exp((score - scores[best]) / self.temperature) for score in scores.values())
+        return IntentPrediction(best, 1.0 / normalizer)
+
+    def route(self, text: str) -> Optional[IntentPrediction]:
+        """有把握转给某个专门代理时返回预测，否则返回None。"""
+        prediction = self.predict(text)
+        if prediction is None or prediction.intent == OTHER_INTENT or prediction.confidence < self.threshold:
+            self.fallbacks += 1
+            return None
+        self.routed[prediction.intent] += 1
+        return prediction
+
+    def evaluate(self, examples: Iterable[Dict[str, str]], threshold: Optional[float] = None) -> Dict[str, Any]:
+        """
+        在未参与训练的标注样本上检验直接路由：按threshold（默认为self.threshold）会直接路由的样本数、
+        其中的误路由（包括把other意图的消息转给专门代理）及其明细。不计入stats()。
+        """
+        threshold = self.threshold if threshold is None else threshold
+        total = routed = 0
+        misrouted = []
+        for example in examples:
+            total += 1
+            prediction = self.predict(example["text"])
+            if prediction is None or prediction.intent == OTHER_INTENT or prediction.confidence < threshold:
+                continue
+            routed += 1
+            if prediction.intent != example["intent"]:
+                misrouted.append((example["text"], example["intent"], prediction.intent, prediction.confidence))
+        return {
+            "examples": total,
+            "routed": routed,
+            "misrouted": misrouted,
+            "precision": (1 - len(misrouted) / routed) if routed else 1.0,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        routed = sum(self.routed.values())
+        decisions = routed + self.fallbacks
+        return {
+            "threshold": self.threshold,
+            "routed": dict(self.routed),
+            "fallbacks": self.fallbacks,
+            "routed_rate": (routed / decisions) if decisions else 0.0,
+        }
+
+def load_examples(path: str) -> List[Dict[str, str]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+INTENT_DATA_PATH = os.environ.get(
+    "INTENT_DATA_PATH", os.path.join(os.path.dirname(__file__), "data", "intents.jsonl")
+)
+# 不参与训练的留出集，用于检验置信度阈值下的直接路由是否可靠
+INTENT_HELDOUT_PATH = os.path.join(os.path.dirname(__file__), "data", "intents_heldout.jsonl")
+
+# 进程级共享的意图路由器；INTENT_ROUTER_THRESHOLD设为大于1的值即可关闭快速路由
+intent_router = IntentRouter.from_file(
+    INTENT_DATA_PATH, threshold=float(os.environ.get("INTENT_ROUTER_THRESHOLD", "0.8"))
+)
@@ -0,0 +1,144 @@
+"""
+流式JSON的增量解析：随着模型输出逐段喂入文本，随时可以取到已经完整输出的字段。
+用于结构化输出的提前结束——判定字段一旦输出完毕即可作出决定，不必等待后面的理由文本。
+"""
+from __future__ import annotations as _annotations
+
+import json
+from typing import Any, List, Optional
+
+_WHITESPACE = " \t\r\n"
+_LITERAL_CHARS = set("0123456789+-.eEtrufalsn")
+
+class IncrementalJSONParser:
+    """
+    逐字符解析一个JSON对象。root是解析出的部分结果：对象在开始时即挂到父对象上，
+    此后其中的字符串、数字、布尔值和null在完整输出后才出现；数组（以及数组中的元素）在闭合后才出现，
+    因此root中的每个标量都是最终值。第一个"{"或"["之前的内容（如```json）被忽略。
+    """
+
+    def __init__(self):
+        self.root: Any = None
+        self.done = False
+        # 栈中每项为[容器, 对象中当前的键]
+        self._stack: List[List[Any]] = []
+        self._state = "start"
+        self._buffer: List[str] = []
+        self._escape = False
+        self._string_is_key = False
+
+    def feed(self, text: str) -> bool:
+        """喂入一段文本；返回本段中是否有值（标量或容器）完整输出。"""
+        completed = False
+        for char in text:
+            if self.done:
+                break
+            completed = self._step(char) or completed
+        return completed
+
+    def _step(self, char: str) -> bool:
+        state = self._state
+        if state == "string":
+            if self._escape:
+                self._escape = False
+                self._buffer.append(char)
+            elif char == "\\":
+                self._escape = True
+                self._buffer.append(char)
+            elif char == '"':
+                value = json.loads('"' + "".join(self._buffer) + '"')
+                self._buffer.clear()
+                if self._string_is_key:
+                    self._stack[-1][1] = value
+                    self._state = "colon"
+                    return False
+                return self._complete(value)
+            else:
+                self._buffer.append(char)
+            return False
+
+        if state == "literal":
+            if char in _LITERAL_CHARS:
+                self._buffer.append(char)
+                return False
+            value = json.loads("".join(self._buffer))
+            self._buffer.clear()
+            completed = self._complete(value)
+            return self._step(char) or completed
+
+        if char in _WHITESPACE:
+            return False
+
+        if state == "start":
+            if char in "{[":
+                self._open(char)
+            return False
+        # next_key：逗号之后的键，此时"}"是非法的尾随逗号
+        if state in ("key", "next_key"):
+            if char == '"':
+                self._string_is_key = True
+                self._state = "string"
+                return False
+            if char == "}" and state == "key":
+                return self._close()
+            raise ValueError(f"JSON对象中应为键，实际为{char!r}")
+        if state == "colon":
+            if char != ":":
+                raise ValueError(f"JSON对象的键后应为冒号，实际为{char!r}")
+            self._state = "value"
+            return False
+        if state == "value":
+            if char in "{[":
+                self._open(char)
+                return False
+            if char == '"':
+                self._string_is_key = False
+                self._state = "string"
+                return False
+            if char == "]" and isinstance(self._stack[-1][0], list) and not self._stack[-1][0]:
+                return self._close()
+            if char in _LITERAL_CHARS:
+                self._buffer.append(char)
+                self._state = "literal"
+                return False
+            raise ValueError(f"应为JSON值，实际为{char!r}")
+        if state == "after_value":
+            if char == ",":
+                self._state = "next_key" if isinstance(self._stack[-1][0], dict) else "value"
+                return False
+            if char in "}]":
+                return self._close()
+            raise ValueError(f"JSON值后应为逗号或括号，实际为{char!r}")
+        return False
+
+    def _open(self, char: str) -> None:
+        container: Any = {} if char == "{" else []
+        if not self._stack:
+            self.root = container
+        elif isinstance(container, dict) and isinstance(self._stack[-1][0], dict):
+            # 对象中的对象立即挂上，使其中已完整的字段可见
+            self._stack[-1][0][self._stack[-1][1]] = container
+        self._stack.append([container, None])
+        self._state = "key" if isinstance(container, dict) else "value"
+
+    def _close(self) -> bool:
+        container, _ = self._stack.pop()
+        if not self._stack:
+            self.done = True
+            return True
+        return self._complete(container)
+
+    def _complete(self, value: Any) -> bool:
+        parent, key = self._stack[-1]
+        if isinstance(parent, dict):
+            parent[key] = value
+        else:
+            parent.append(value)
+        self._state = "after_value"
+        return True
+
+def parse_partial(text: str) -> Optional[Any]:
+    """一次性解析一段可能不完整的JSON，返回已完整输出的部分。"""
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return parser.root
@@ -0,0 +1,479 @@
+"""
+离线LLM模拟器：OpenAI兼容的chat completions接口，按规则（或脚本）生成回复、工具调用和守卫的JSON输出，
+并按可复现的随机种子模拟首token延迟、生成速度、长尾延迟以及429/5xx错误。
+
+两种用法：
+- 进程内：DEEPSEEK_DEV_MODE=true时DeepSeekClient通过SimulatorTransport直接调用模拟器，不经过网络；
+- 独立服务（在python-backend目录下）：
+      python -m llm_simulator --port 8001 --profile typical --seed 42
+  然后设置DEEPSEEK_BASE_URL=http://127.0.0.1:8001/v1（API密钥任意）。
+"""
+from __future__ import annotations as _annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Union
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+# =========================
+# 延迟与错误配置
+# =========================
+
+class LatencyProfile(BaseModel):
+    """一次模拟调用的延迟分布与错误率。"""
+    # 首token延迟：对数正态分布的中位数与形状参数
+    ttft_ms: float = 0.0
+    ttft_sigma: float = 0.0
+    # 提示词预填充耗时，按每1000个提示词token计
+    prefill_ms_per_1k_tokens: float = 0.0
+    # 生成速度，0表示瞬间生成
+    tokens_per_sec: float = 0.0
+    # 长尾：以tail_probability的概率在首token前额外等待tail_ms的50%~100%
+    tail_probability: float = 0.0
+    tail_ms: float = 0.0
+    # 注入的429与5xx错误比例
+    rate_limit_rate: float = 0.0
+    server_error_rate: float = 0.0
+    # 429响应携带的建议重试等待
+    retry_after_ms: float = 1000.0
+
+    @classmethod
+    def from_env(cls) -> "LatencyProfile":
+        """LLM_SIM_PROFILE选择预设，LLM_SIM_*环境变量覆盖单项。"""
+        name = os.environ.get("LLM_SIM_PROFILE", "instant")
+        if name not in PROFILES:
+            raise ValueError(f"未知的模拟器延迟配置{name}，可选：{', '.join(PROFILES)}")
+        env_fields = {
+            "ttft_ms": "LLM_SIM_TTFT_MS",
+            "tokens_per_sec": "LLM_SIM_TOKENS_PER_SEC",
+            "tail_probability": "LLM_SIM_TAIL_PROBABILITY",
+            "rate_limit_rate": "LLM_SIM_RATE_LIMIT_RATE",
+            "server_error_rate": "LLM_SIM_SERVER_ERROR_RATE",
+            "retry_after_ms": "LLM_SIM_RETRY_AFTER_MS",
+        }
+        values = {field: os.environ[var] for field, var in env_fields.items() if os.environ.get(var)}
+        return PROFILES[name].model_copy(update={k: float(v) for k, v in values.items()})
+
+PROFILES: Dict[str, LatencyProfile] = {
+    # 开发模式默认：不等待、不出错
+    "instant": LatencyProfile(),
+    "fast": LatencyProfile(
+        ttft_ms=150, ttft_sigma=0.3, prefill_ms_per_1k_tokens=10, tokens_per_sec=120,
+        tail_probability=0.01, tail_ms=1000,
+    ),
+    # 接近公有云大模型接口的日常表现
+    "typical": LatencyProfile(
+        ttft_ms=400, ttft_sigma=0.4, prefill_ms_per_1k_tokens=30, tokens_per_sec=50,
+        tail_probability=0.02, tail_ms=3000, rate_limit_rate=0.005, server_error_rate=0.005,
+    ),
+    # 上游过载：慢、长尾重、错误多
+    "degraded": LatencyProfile(
+        ttft_ms=1200, ttft_sigma=0.6, prefill_ms_per_1k_tokens=60, tokens_per_sec=20,
+        tail_probability=0.05, tail_ms=8000, rate_limit_rate=0.05, server_error_rate=0.03,
+    ),
+}
+
+# =========================
+# 分词（只用于计时和用量统计）
+# =========================
+
+_TOKEN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]|[^\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]{1,4}")
+
+def split_tokens(text: str) -> List[str]:
+    """近似的token切分：每个汉字一个token，其他文本约4个字符一个token。"""
+    return _TOKEN_RE.findall(text or "")
+
+def _prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(4 + len(split_tokens(json.dumps(m, ensure_ascii=False))) for m in messages)
+
+# =========================
+# 回复生成
+# =========================
+
+_ROLE_RE = re.compile(r"您是一名(?:有用的)?(\S+?代理)")
+_SEAT_RE = re.compile(r"(?<![0-9A-Za-z])\d{1,2}[A-Fa-f](?![0-9A-Za-z])")
+_CONFIRMATION_RE = re.compile(r"确认号是([A-Z0-9]{6})")
+_FLIGHT_RE = re.compile(r"FLT-\d+")
+# (关键词, 负责的代理, 转接工具名)
+_ROUTES = (
+    (("取消", "cancel"), "取消代理", "transfer_to_cancellation_agent"),
+    (("行李", "baggage", "wifi", "网络"), "FAQ代理", "transfer_to_faq_agent"),
+    (("座位", "换座", "seat"), "座位预订代理", "transfer_to_seat_booking_agent"),
+    (("航班", "flight"), "航班状态代理", "transfer_to_flight_status_agent"),
+)
+# 守卫判定用的关键词
+_OFF_TOPIC_WORDS = ("写一首诗", "写诗", "poem", "笑话", "joke", "数学", "math", "天气", "weather", "股票")
+_JAILBREAK_WORDS = ("系统提示", "system prompt", "忽略之前", "忽略以上", "ignore previous", "ignore all", "drop table")
+_CONFIRM_WORDS = ("确认", "是的", "好的", "yes", "confirm")
+
+# 代理有output_type时指令末尾的格式提示，如 只输出如下格式的JSON对象，字段按此顺序：{"is_safe": 布尔值, ...}
+_OUTPUT_FORMAT_RE = re.compile(r"只输出如下格式的JSON对象[^：\n]*：(\{.*\})$", re.MULTILINE)
+_FORMAT_TYPE_RE = re.compile(r":\s*(字符串|布尔值|整数|数字|JSON值)")
+_REASONING = "模拟判定：已按说明逐项核对最近一条用户消息的内容，结论如判定字段所示。"
+
+class RuleBasedResponder:
+    """
+    按系统指令识别代理身份，用关键词模拟模型的决策：分流代理调用转接工具，
+    专门代理调用各自的工具并根据工具结果作答，守卫代理输出JSON判定，摘要代理做抽取式摘要。
+    """
+
+    @classmethod
+    def _structured(cls, shape: Dict[str, Any], lowered: str) -> Dict[str, Any]:
+        """按格式提示中的字段顺序填值；is_relevant/is_safe按关键词判定。"""
+        output: Dict[str, Any] = {}
+        for name, kind in shape.items():
+            if isinstance(kind, dict):
+                output[name] = cls._structured(kind, lowered)
+            elif name == "is_relevant":
+                output[name] = not any(word in lowered for word in _OFF_TOPIC_WORDS)
+            elif name == "is_safe":
+                output[name] = not any(word in lowered for word in _JAILBREAK_WORDS)
+            else:
+                output[name] = {"字符串": _REASONING, "布尔值": True, "整数": 0, "数字": 0.0}.get(kind)
+        return output
+
+    def respond(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        system = next((m.get("content") or "" for m in messages if m["role"] == "system"), "")
+        last_user = max((i for i, m in enumerate(messages) if m["role"] == "user"), default=-1)
+        user = (messages[last_user].get("content") or "") if last_user >= 0 else ""
+        lowered = user.lower()
+        tool_names = {tool["function"]["name"] for tool in tools or ()}
+
+        # 结构化输出（守卫、合并守卫）按指令末尾的格式提示作答；摘要代理做抽取式摘要
+        output_format = _OUTPUT_FORMAT_RE.search(system)
+        if output_format:
+            shape = json.loads(_FORMAT_TYPE_RE.sub(r': "\1"', output_format.group(1)))
+            return _text(json.dumps(self._structured(shape, lowered), ensure_ascii=False))
+        if "对话摘要" in system:
+            said = [line[3:] for line in user.splitlines() if line.startswith("用户：")]
+            return _text(("用户先后提到：" + "；".join(said))[:200])
+
+        # 本轮已经拿到自己工具的结果时，根据结果作答
+        turn = messages[last_user + 1:]
+        calls = {
+            call["id"]: call["function"]["name"]
+            for m in turn if m["role"] == "assistant" for call in m.get("tool_calls") or []
+        }
+        results = [
+            m.get("content") or "" for m in turn
+            if m["role"] == "tool" and not calls.get(m.get("tool_call_id"), "").startswith("transfer_to_")
+        ]
+        if results:
+            return _text(results[-1] if results[-1] != "DISPLAY_SEAT_MAP" else "请在座位图中选择您想要的座位。")
+
+        role = _ROLE_RE.search(system)
+        agent = role.group(1) if role else ""
+        route = next((r for r in _ROUTES if any(k in lowered for k in r[0])), None)
+        call_id = f"call_{len(messages)}"
+
+        if agent == "分流代理":
+            if route and route[2] in tool_names:
+                return _tool_call(call_id, route[2], {})
+            return _text("您好！我是航空公司的客服助手。请问您需要什么帮助？您可以询问关于航班状态、座位预订、行李政策或取消航班的问题。")
+
+        # 专门代理：问题属于其他代理时转回分流代理
+        if route and route[1] != agent and "transfer_to_triage_agent" in tool_names:
+            return _tool_call(call_id, "transfer_to_triage_agent", {})
+
+        confirmation = _CONFIRMATION_RE.search(system)
+        flight = _FLIGHT_RE.search(system) or _FLIGHT_RE.search(user)
+        if agent == "座位预订代理":
+            seat = _SEAT_RE.search(user)
+            if seat and confirmation and "update_seat" in tool_names:
+                arguments = {"confirmation_number": confirmation.group(1), "new_seat": seat.group(0).upper()}
+                return _tool_call(call_id, "update_seat", arguments)
+            if ("座位图" in user or "seat map" in lowered) and "display_seat_map" in tool_names:
+                return _tool_call(call_id, "display_seat_map", {})
+            if not confirmation:
+                return _text("为了帮您更换座位，请提供您的确认号码。")
+            return _text("欢迎使用座位预订服务。请告诉我您想更换到哪个座位，或者查看座位图。")
+        if agent == "FAQ代理" and "faq_lookup_tool" in tool_names:
+            return _tool_call(call_id, "faq_lookup_tool", {"question": user})
+        if agent == "航班状态代理":
+            if flight and "flight_status_tool" in tool_names:
+                return _tool_call(call_id, "flight_status_tool", {"flight_number": flight.group(0)})
+            return _text("请提供您的航班号，我来为您查询航班状态。")
+        if agent == "取消代理":
+            if any(word in lowered for word in _CONFIRM_WORDS) and "cancel_flight" in tool_names:
+                return _tool_call(call_id, "cancel_flight", {})
+            return _text(f"请确认是否要取消航班{flight.group(0) if flight else ''}？")
+        return _text(f"我是航空公司客服助手。您的问题是：{user}。请问您需要了解航班状态、座位预订还是行李政策？")
+
+class ScriptedResponder:
+    """按顺序循环返回脚本中的回复；脚本项可以是字符串（纯文本回复）或完整的assistant消息。"""
+
+    def __init__(self, responses: List[Union[str, Dict[str, Any]]]):
+        if not responses:
+            raise ValueError("模拟器脚本至少需要一条回复")
+        self._responses = itertools.cycle([_text(r) if isinstance(r, str) else r for r in responses])
+
+    @classmethod
+    def from_file(cls, path: str) -> "ScriptedResponder":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def respond(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        return dict(next(self._responses))
+
+def _text(content: str) -> Dict[str, Any]:
+    return {"role": "assistant", "content": content}
+
+def _tool_call(call_id: str, name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "role": "assistant",
+        "content": "",
+        "tool_calls": [{
+            "id": call_id,
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments, ensure_ascii=False)},
+        }],
+    }
+
+# =========================
+# 模拟器
+# =========================
+
+class SimulatedResponse(NamedTuple):
+    status_code: int
+    headers: Dict[str, str]
+    # 非流式为完整的响应体，流式为SSE字节片段的异步迭代器
+    body: Union[bytes, AsyncIterator[bytes]]
+
+class LLMSimulator:
+    """
+    OpenAI chat completions接口的模拟实现。
+    每个请求使用由种子和请求序号派生的独立随机数，同样的请求顺序得到同样的延迟和错误。
+    """
+
+    def __init__(self, profile: Optional[LatencyProfile] = None, seed: int = 0, responder=None, unavailable_models=()):
+        self.profile = profile or LatencyProfile()
+        self.seed = seed
+        self.responder = responder or RuleBasedResponder()
+        # 这些模型的请求一律返回503，用于演练模型链的后备
+        self.unavailable_models = set(unavailable_models)
+        self._requests = itertools.count()
+        self.requests = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        # 见过的系统提示，模拟上游的前缀缓存
+        self._cached_prefixes: "OrderedDict[str, None]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "LLMSimulator":
+        script = os.environ.get("LLM_SIM_SCRIPT")
+        return cls(
+            LatencyProfile.from_env(),
+            seed=int(os.environ.get("LLM_SIM_SEED", "0")),
+            responder=ScriptedResponder.from_file(script) if script else None,
+            unavailable_models=[m for m in os.environ.get("LLM_SIM_UNAVAILABLE_MODELS", "").split(",") if m],
+        )
+
+    async def handle(self, body: Dict[str, Any]) -> SimulatedResponse:
+        """处理一次/chat/completions请求体。"""
+        rng = random.Random(f"{self.seed}:{next(self._requests)}")
+        self.requests += 1
+        profile = self.profile
+        model = body.get("model", "simulator")
+        messages = body.get("messages") or []
+
+        if model in self.unavailable_models:
+            self.server_errors += 1
+            return _error(503, "model_unavailable", f"模拟的模型{model}不可用")
+
+        if rng.random() < profile.rate_limit_rate:
+            self.rate_limited += 1
+            retry_after = {
+                "retry-after": str(max(1, round(profile.retry_after_ms / 1000))),
+                "retry-after-ms": str(int(profile.retry_after_ms)),
+            }
+            return _error(429, "rate_limit_exceeded", "模拟的限流错误", retry_after)
+
+        prompt_tokens = _prompt_tokens(messages)
+        delay = profile.prefill_ms_per_1k_tokens * prompt_tokens / 1000
+        if profile.ttft_ms:
+            delay += profile.ttft_ms * rng.lognormvariate(0.0, profile.ttft_sigma)
+        if rng.random() < profile.tail_probability:
+            delay += profile.tail_ms * rng.uniform(0.5, 1.0)
+        if rng.random() < profile.server_error_rate:
+            self.server_errors += 1
+            await asyncio.sleep(delay / 1000)
+            return _error(rng.choice((500, 502, 503)), "server_error", "模拟的上游错误")
+
+        message = self.responder.respond(messages, body.get("tools"))
+        tokens = split_tokens(message.get("content") or "")
+        call_tokens = sum(len(split_tokens(c["function"]["arguments"])) + 4 for c in message.get("tool_calls") or [])
+        cached_tokens = self._cached_prefix_tokens(messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens) + call_tokens,
+            "total_tokens": prompt_tokens + len(tokens) + call_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        self.completion_tokens += usage["completion_tokens"]
+        finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+        completion_id = f"chatcmpl-sim-{rng.getrandbits(48):012x}"
+
+        if body.get("stream"):
+            return SimulatedResponse(200, {"content-type": "text/event-stream"}, self._stream(
+                completion_id, model, message, tokens, usage, finish_reason, delay / 1000,
+                include_usage=bool((body.get("stream_options") or {}).get("include_usage")),
+            ))
+
+        if profile.tokens_per_sec:
+            delay += 1000 * usage["completion_tokens"] / profile.tokens_per_sec
+        await asyncio.sleep(delay / 1000)
+        return SimulatedResponse(200, {"content-type": "application/json"}, json.dumps({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": usage,
+        }, ensure_ascii=False).encode("utf-8"))
+
+    def _cached_prefix_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """系统提示此前出现过时，其token计为缓存命中。"""
+        if not messages or messages[0].get("role") != "system":
+            return 0
+        key = messages[0].get("content") or ""
+        if key in self._cached_prefixes:
+            self._cached_prefixes.move_to_end(key)
+            return _prompt_tokens(messages[:1])
+        self._cached_prefixes[key] = None
+        if len(self._cached_prefixes) > 1024:
+            self._cached_prefixes.popitem(last=False)
+        return 0
+
+    async def _stream(
+        self, completion_id: str, model: str, message: Dict[str, Any], tokens: List[str],
+        usage: Dict[str, int], finish_reason: str, ttft: float, include_usage: bool,
+    ) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        def chunk(delta: Dict[str, Any], finish: Optional[str] = None, **extra) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if delta is not None else [],
+                **extra,
+            }
+            return b"data: " + json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+        await asyncio.sleep(ttft)
+        yield chunk({"role": "assistant", "content": ""})
+        interval = 1 / self.profile.tokens_per_sec if self.profile.tokens_per_sec else 0.0
+        for i, token in enumerate(tokens):
+            # 按生成速度排期；积累超过5毫秒再等待，避免每个token一次sleep
+            due = start + ttft + (i + 1) * interval
+            if due - loop.time() > 0.005:
+                await asyncio.sleep(due - loop.time())
+            yield chunk({"content": token})
+        for index, call in enumerate(message.get("tool_calls") or []):
+            yield chunk({"tool_calls": [dict(call, index=index)]})
+        yield chunk({}, finish_reason)
+        if include_usage:
+            yield chunk(None, usage=usage)
+        yield b"data: [DONE]\n\n"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "profile": self.profile.model_dump(),
+            "seed": self.seed,
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "server_errors": self.server_errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+        }
+
+def _error(status_code: int, code: str, message: str, headers: Optional[Dict[str, str]] = None) -> SimulatedResponse:
+    body = json.dumps({"error": {"message": message, "type": code, "code": code}}, ensure_ascii=False)
+    return SimulatedResponse(status_code, {"content-type": "application/json", **(headers or {})}, body.encode("utf-8"))
+
+# =========================
+# 进程内传输
+# =========================
+
+class _SimulatedStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self._chunks = chunks
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._chunks:
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._chunks.aclose()
+
+class SimulatorTransport(httpx.AsyncBaseTransport):
+    """把httpx请求直接交给进程内的模拟器，OpenAI客户端的解析、流式和错误处理路径与生产一致。"""
+
+    def __init__(self, simulator: LLMSimulator):
+        self.simulator = simulator
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not request.url.path.endswith("/chat/completions"):
+            return httpx.Response(404, json={"error": {"message": "模拟器只实现了/chat/completions"}}, request=request)
+        result = await self.simulator.handle(json.loads(await request.aread()))
+        if isinstance(result.body, bytes):
+            return httpx.Response(result.status_code, headers=result.headers, content=result.body, request=request)
+        return httpx.Response(result.status_code, headers=result.headers, stream=_SimulatedStream(result.body), request=request)
+
+# =========================
+# HTTP服务
+# =========================
+
+def create_app(simulator: LLMSimulator) -> FastAPI:
+    """独立运行的OpenAI兼容服务：POST /v1/chat/completions，GET /stats。"""
+    app = FastAPI(title="LLM simulator")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        result = await simulator.handle(await request.json())
+        if isinstance(result.body, bytes):
+            return Response(result.body, status_code=result.status_code, headers=result.headers)
+        return StreamingResponse(result.body, status_code=result.status_code, headers=result.headers)
+
+    @app.get("/stats")
+    async def stats():
+        return simulator.stats()
+
+    return app
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--profile", choices=sorted(PROFILES), help="延迟配置（默认读取LLM_SIM_PROFILE）")
+    parser.add_argument("--seed", type=int, help="随机种子（默认读取LLM_SIM_SEED）")
+    parser.add_argument("--script", help="脚本回复文件（JSON列表），不指定则按规则生成回复")
+    args = parser.parse_args()
+    for var, value in (("LLM_SIM_PROFILE", args.profile), ("LLM_SIM_SEED", args.seed), ("LLM_SIM_SCRIPT", args.script)):
+        if value is not None:
+            os.environ[var] = str(value)
+    uvicorn.run(create_app(LLMSimulator.from_env()), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+进程内的轻量指标：Prometheus文本格式的计数器与直方图（GET /metrics），
+以及按请求累计各阶段耗时、用于Server-Timing响应头的收集器。
+
+不依赖prometheus_client；一次观测只是一次字典查找、一次二分查找和两次加法。
+指标只在事件循环线程中更新，因此不加锁。
+"""
+from __future__ import annotations as _annotations
+
+import bisect
+import math
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# 默认的耗时桶（秒）：覆盖从本地操作到较慢的上游调用
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+# =========================
+# 指标类型
+# =========================
+
+class Counter:
+    """单调递增的计数器；标签值按labelnames的顺序以位置参数给出。"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+class Histogram:
+    """
+    累积桶直方图。每个标签组合保存各桶的（非累积）计数和观测值总和，
+    导出时再累加成Prometheus要求的le桶。
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数..., +Inf桶计数, 总和]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return int(sum(series[:-1])) if series else 0
+
+    def samples(self) -> Iterator[str]:
+        bounds = self.buckets + (math.inf,)
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            label_text = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_text} {_format_value(series[-1])}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+Metric = Union[Counter, Histogram]
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError(f"指标{metric.name}已以不同的类型或标签注册")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Prometheus文本格式（0.0.4）。"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+# 进程级指标注册表；METRICS_ENABLED=false时不记录任何观测
+registry = MetricsRegistry(enabled=os.environ.get("METRICS_ENABLED", "true").lower() in ("true", "1", "yes"))
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# =========================
+# 各阶段的指标
+# =========================
+
+CHAT_TURN_SECONDS = registry.histogram(
+    "cs_chat_turn_seconds", "一轮对话在服务端的处理耗时", ("endpoint", "outcome")
+)
+AGENT_RUN_SECONDS = registry.histogram(
+    "cs_agent_run_seconds", "Runner一次运行（含守卫、模型调用、工具与转接）的耗时", ("agent", "outcome")
+)
+GUARDRAIL_SECONDS = registry.histogram(
+    "cs_guardrail_seconds", "单个输入守卫的耗时", ("guardrail", "outcome")
+)
+LLM_REQUEST_SECONDS = registry.histogram(
+    "cs_llm_request_seconds", "单次上游模型调用的耗时（流式调用到最后一个分片为止）", ("agent", "model", "outcome")
+)
+LLM_FIRST_TOKEN_SECONDS = registry.histogram(
+    "cs_llm_first_token_seconds", "流式上游调用收到第一个内容或工具调用分片的耗时", ("agent", "model")
+)
+TOOL_SECONDS = registry.histogram(
+    "cs_tool_seconds", "单次工具调用的耗时", ("agent", "tool", "outcome")
+)
+STORE_SECONDS = registry.histogram(
+    "cs_conversation_store_seconds", "会话存储操作的耗时", ("backend", "operation", "outcome")
+)
+RESPONSE_BUILD_SECONDS = registry.histogram(
+    "cs_response_build_seconds", "把运行结果转换为ChatResponse的耗时"
+)
+HANDOFFS_TOTAL = registry.counter(
+    "cs_handoffs_total", "代理转接次数；via为model（模型调用转接工具）或intent_router", ("source", "target", "via")
+)
+STRUCTURED_EARLY_EXIT_TOTAL = registry.counter(
+    "cs_structured_early_exit_total", "结构化输出在判定字段输出后即提前结束、取消其余生成的次数", ("agent",)
+)
+GUARDRAIL_UNPARSABLE_TOTAL = registry.counter(
+    "cs_guardrail_unparsable_total", "守卫判定无法解析、按未通过处理的次数", ("guardrail",)
+)
+
+# =========================
+# 按请求的阶段耗时（Server-Timing）
+# =========================
+
+_stage_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+_enclosing_stage: ContextVar[Optional[str]] = ContextVar("enclosing_stage", default=None)
+
+def collect_stage_timings() -> Dict[str, float]:
+    """
+    为当前请求开始累计各阶段耗时（秒，同名阶段相加）。
+    之后在此上下文中创建的任务（并发守卫、合并请求等）共享同一个字典。
+    """
+    timings: Dict[str, float] = {}
+    _stage_timings.set(timings)
+    return timings
+
+def observe_stage(stage: str, histogram: Histogram, started: float, *labels: str) -> float:
+    """记录从started（time.perf_counter()）到现在的耗时：写入直方图，并计入当前请求的阶段耗时。"""
+    elapsed = time.perf_counter() - started
+    if registry.enabled:
+        histogram.observe(elapsed, *labels)
+        timings = _stage_timings.get()
+        if timings is not None and _enclosing_stage.get() is None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+    return elapsed
+
+@contextmanager
+def enclosing_stage(stage: str) -> Iterator[None]:
+    """
+    在此范围内发生的其他阶段（如守卫内部的运行和模型调用）照常写入直方图，
+    但不再计入本请求的阶段耗时，因为它们已包含在stage自身的耗时中。
+    """
+    token = _enclosing_stage.set(stage)
+    try:
+        yield
+    finally:
+        _enclosing_stage.reset(token)
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """编码为Server-Timing响应头，例如"guardrail;dur=12.3, llm;dur=410.5"（毫秒）。"""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+def count_handoff(source: str, target: str, via: str) -> None:
+    if registry.enabled:
+        HANDOFFS_TOTAL.inc(source, target, via)
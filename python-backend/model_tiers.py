@@ -0,0 +1,212 @@
+"""
+按代理（含守卫代理）选择上游模型：每个代理配置一条有序的模型链，首选模型调用失败时依次换用后面的模型；
+可选的自适应策略在首选模型的实测延迟或单次费用超出预算时，改用链中更便宜的模型。
+
+配置来自MODEL_CONFIG_PATH指向的JSON文件（默认data/models.json），AGENT_MODELS环境变量中的同格式JSON覆盖其中的代理：
+    {
+        "agents": {
+            "相关性守卫": {"models": ["qwen-turbo", "deepseek-v3"], "latency_budget_ms": 800},
+            "分流代理": "deepseek-v3"
+        }
+    }
+未配置的代理只使用其Agent(model=...)。配置的模型链应以代理声明的模型开头，
+降级到更小的模型写在Agent(model=...)中（如守卫代理的qwen-turbo），而不是只出现在配置里。
+"""
+from __future__ import annotations as _annotations
+
+import json
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from pydantic import BaseModel
+
+import metrics
+from token_usage import usage_ledger
+
+MODEL_CONFIG_PATH = os.environ.get(
+    "MODEL_CONFIG_PATH", os.path.join(os.path.dirname(__file__), "data", "models.json")
+)
+
+# =========================
+# 配置
+# =========================
+
+class AgentModelConfig(BaseModel):
+    # 有序的模型链：第一个为首选，其余依次作为后备
+    models: List[str]
+    # 自适应策略的预算；None表示使用全局预算
+    latency_budget_ms: Optional[float] = None
+    cost_budget: Optional[float] = None
+
+def _parse_agents(spec: Dict[str, Any]) -> Dict[str, AgentModelConfig]:
+    agents: Dict[str, AgentModelConfig] = {}
+    for name, value in (spec.get("agents") or {}).items():
+        if isinstance(value, str):
+            value = {"models": [value]}
+        elif isinstance(value, list):
+            value = {"models": value}
+        config = AgentModelConfig(**value)
+        if not config.models:
+            raise ValueError(f"代理{name}的模型链为空")
+        agents[name] = config
+    return agents
+
+def load_model_config(path: Optional[str], override: str = "") -> Dict[str, AgentModelConfig]:
+    """读取配置文件（不存在时视为空），再用override（AGENT_MODELS）中的代理覆盖。"""
+    agents: Dict[str, AgentModelConfig] = {}
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            agents.update(_parse_agents(json.load(f)))
+    if override:
+        agents.update(_parse_agents(json.loads(override)))
+    return agents
+
+# =========================
+# 选择与自适应
+# =========================
+
+class ModelChoice(NamedTuple):
+    model: str
+    # primary（首选）、fallback（前一个模型失败）、probe（自适应期间回访首选模型）、
+    # adaptive_latency或adaptive_cost（因首选模型超出预算而降级）
+    reason: str
+
+class _ModelHealth:
+    """某代理在某模型上的延迟与单次费用的指数加权平均。"""
+
+    __slots__ = ("latency", "cost", "samples")
+
+    def __init__(self):
+        self.latency = 0.0
+        self.cost = 0.0
+        self.samples = 0
+
+    def observe(self, latency: float, cost: float, alpha: float) -> None:
+        if self.samples == 0:
+            self.latency, self.cost = latency, cost
+        else:
+            self.latency += alpha * (latency - self.latency)
+            self.cost += alpha * (cost - self.cost)
+        self.samples += 1
+
+MODEL_SELECTIONS_TOTAL = metrics.registry.counter(
+    "cs_model_selections_total", "每次上游调用尝试所用的模型及选择原因", ("agent", "model", "reason")
+)
+
+class ModelRouter:
+    """
+    为每次模型调用给出依次尝试的模型。自适应策略开启时，首选模型的延迟（流式调用为首token延迟）
+    或单次费用的加权平均超出预算后，改从链中第一个更便宜的模型开始；每probe_every次调用仍回访一次首选模型，
+    以便它恢复后切回。
+    """
+
+    def __init__(
+        self,
+        agents: Optional[Dict[str, AgentModelConfig]] = None,
+        adaptive: bool = False,
+        latency_budget_ms: float = 0.0,
+        cost_budget: float = 0.0,
+        min_samples: int = 5,
+        probe_every: int = 20,
+        alpha: float = 0.2,
+    ):
+        self.agents = agents or {}
+        self.adaptive = adaptive
+        self.latency_budget_ms = latency_budget_ms
+        self.cost_budget = cost_budget
+        self.min_samples = min_samples
+        self.probe_every = probe_every
+        self.alpha = alpha
+        self._health: Dict[Tuple[str, str], _ModelHealth] = {}
+        self._calls: Dict[str, int] = {}
+        self.selections: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> "ModelRouter":
+        return cls(
+            load_model_config(MODEL_CONFIG_PATH, os.environ.get("AGENT_MODELS", "")),
+            adaptive=os.environ.get("MODEL_ROUTING_ADAPTIVE", "false").lower() in ("true", "1", "yes"),
+            latency_budget_ms=float(os.environ.get("MODEL_LATENCY_BUDGET_MS", "0")),
+            cost_budget=float(os.environ.get("MODEL_COST_BUDGET", "0")),
+            probe_every=int(os.environ.get("MODEL_ROUTING_PROBE_EVERY", "20")),
+        )
+
+    def chain(self, agent) -> List[str]:
+        config = self.agents.get(agent.name)
+        return list(config.models) if config else [agent.model]
+
+    def primary(self, agent) -> str:
+        return self.chain(agent)[0]
+
+    def _over_budget(self, agent_name: str, model: str) -> Optional[str]:
+        config = self.agents.get(agent_name)
+        latency_budget = (config.latency_budget_ms if config and config.latency_budget_ms is not None
+                          else self.latency_budget_ms)
+        cost_budget = config.cost_budget if config and config.cost_budget is not None else self.cost_budget
+        health = self._health.get((agent_name, model))
+        if health is None or health.samples < self.min_samples:
+            return None
+        if latency_budget > 0 and health.latency * 1000 > latency_budget:
+            return "adaptive_latency"
+        if cost_budget > 0 and health.cost > cost_budget:
+            return "adaptive_cost"
+        return None
+
+    @staticmethod
+    def _unit_price(model: str) -> Optional[float]:
+        price = usage_ledger.prices.get(model)
+        return price.prompt + price.completion if price else None
+
+    def plan(self, agent) -> List[ModelChoice]:
+        """本次调用依次尝试的模型：选中的模型在前，链中其余模型按顺序作为后备。"""
+        chain = self.chain(agent)
+        if not self.adaptive or len(chain) == 1:
+            return [ModelChoice(chain[0], "primary")] + [ModelChoice(model, "fallback") for model in chain[1:]]
+
+        calls = self._calls[agent.name] = self._calls.get(agent.name, 0) + 1
+        start, reason = 0, "primary"
+        over = self._over_budget(agent.name, chain[0])
+        if over is not None:
+            if calls % self.probe_every == 0:
+                reason = "probe"
+            else:
+                primary_price = self._unit_price(chain[0])
+                for index, model in enumerate(chain[1:], start=1):
+                    price = self._unit_price(model)
+                    if primary_price is not None and price is not None and price < primary_price:
+                        start, reason = index, over
+                        break
+        ordered = chain[start:] + chain[:start]
+        return [ModelChoice(ordered[0], reason)] + [ModelChoice(model, "fallback") for model in ordered[1:]]
+
+    def record_selection(self, agent_name: str, choice: ModelChoice) -> None:
+        self.selections[choice.reason] = self.selections.get(choice.reason, 0) + 1
+        if metrics.registry.enabled:
+            MODEL_SELECTIONS_TOTAL.inc(agent_name, choice.model, choice.reason)
+
+    def observe(self, agent_name: str, model: str, latency: float, cost: float) -> None:
+        """记录一次成功调用的延迟（秒）与费用（元）。"""
+        if not self.adaptive:
+            return
+        health = self._health.get((agent_name, model))
+        if health is None:
+            health = self._health[(agent_name, model)] = _ModelHealth()
+        health.observe(latency, cost, self.alpha)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "adaptive": self.adaptive,
+            "agents": {name: config.models for name, config in self.agents.items()},
+            "selections": dict(self.selections),
+            "health": {
+                f"{agent_name}/{model}": {
+                    "latency_ms": round(health.latency * 1000, 1),
+                    "cost": round(health.cost, 6),
+                    "samples": health.samples,
+                }
+                for (agent_name, model), health in self._health.items()
+            },
+        }
+
+# 进程级共享的模型选择器
+model_router = ModelRouter.from_env()
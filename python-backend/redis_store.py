@@ -0,0 +1,340 @@
+from __future__ import annotations as _annotations
+
+import asyncio
+import bisect
+import copy
+import hashlib
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+from urllib.parse import urlparse
+
+from pydantic import BaseModel
+
+from conversation_store import ConversationStore, deserialize_state, serialize_state
+
+# =========================
+# Redis协议（RESP2）客户端
+# =========================
+
+class RedisError(Exception):
+    """Redis服务端返回的错误回复。"""
+
+def _encode_command(args: Iterable[Any]) -> bytes:
+    parts: List[bytes] = []
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif not isinstance(arg, (bytes, bytearray)):
+            arg = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"*%d\r\n" % len(parts) + b"".join(parts)
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    """读取一条RESP回复；错误回复以RedisError对象返回，由调用方决定是否抛出。"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis连接已关闭")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode("utf-8")
+    if kind == b"-":
+        return RedisError(body.decode("utf-8"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"无法解析的Redis回复: {line!r}")
+
+class RedisClient:
+    """
+    最小的asyncio Redis客户端，只实现会话存储需要的命令。
+    连接按需建立并放回池中复用；命令出错的连接直接丢弃，不再复用。
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", max_connections: int = 32):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        for command in ((("AUTH", self.password),) if self.password else ()) + ((("SELECT", self.db),) if self.db else ()):
+            writer.write(_encode_command(command))
+            await writer.drain()
+            reply = await read_reply(reader)
+            if isinstance(reply, RedisError):
+                writer.close()
+                raise reply
+        return reader, writer
+
+    async def execute(self, *args: Any) -> Any:
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._connect()
+            reader, writer = connection
+            try:
+                writer.write(_encode_command(args))
+                await writer.drain()
+                reply = await read_reply(reader)
+            except BaseException:
+                writer.close()
+                raise
+            self._idle.append(connection)
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def ping(self) -> bool:
+        return await self.execute("PING") == "PONG"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.execute("GET", key)
+
+    async def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None:
+        if ex:
+            await self.execute("SET", key, value, "EX", ex)
+        else:
+            await self.execute("SET", key, value)
+
+    async def delete(self, *keys: str) -> int:
+        return await self.execute("DEL", *keys)
+
+    async def mget(self, *keys: str) -> List[Optional[bytes]]:
+        return await self.execute("MGET", *keys)
+
+    async def transaction(self, *commands: Tuple[Any, ...]) -> List[Any]:
+        """在同一连接上以MULTI/EXEC原子地执行多条命令，返回各命令的回复。"""
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._connect()
+            reader, writer = connection
+            try:
+                writer.write(b"".join(_encode_command(args) for args in (("MULTI",), *commands, ("EXEC",))))
+                await writer.drain()
+                # MULTI和各条命令的排队回复（+OK/+QUEUED），最后是EXEC的结果
+                queued = [await read_reply(reader) for _ in range(len(commands) + 1)]
+                replies = await read_reply(reader)
+            except BaseException:
+                writer.close()
+                raise
+            self._idle.append(connection)
+        for reply in queued + (replies if isinstance(replies, list) else [replies]):
+            if isinstance(reply, RedisError):
+                raise reply
+        if replies is None:
+            raise RedisError("EXEC被中止")
+        return replies
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+# =========================
+# 共享会话存储
+# =========================
+
+class RedisConversationStore(ConversationStore):
+    """
+    存放在Redis中的会话状态，供多个worker/节点共享。
+    状态沿用serialize_state的紧凑编码，并设置过期时间，被放弃的会话会自动清理。
+    每次保存都在同一个事务中写入一个随机版本标记；持有本地副本的进程只需读取这个短键
+    即可判断副本是否仍是最新（见TieredConversationStore）。
+    """
+
+    def __init__(
+        self,
+        client: RedisClient,
+        context_type: Type[BaseModel],
+        ttl_seconds: int = 7 * 24 * 3600,
+        key_prefix: str = "conversation:",
+        version_prefix: str = "conversation-version:",
+    ):
+        self.client = client
+        self.context_type = context_type
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+        self.version_prefix = version_prefix
+        self.gets = 0
+        self.misses = 0
+        self.saves = 0
+        self.version_checks = 0
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        state, _ = await self.get_versioned(conversation_id)
+        return state
+
+    async def get_versioned(self, conversation_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[bytes]]:
+        """原子地读取会话状态及其版本标记；旧数据没有版本标记时版本为None。"""
+        self.gets += 1
+        data, version = await self.client.mget(self.key_prefix + conversation_id, self.version_prefix + conversation_id)
+        if data is None:
+            self.misses += 1
+            return None, None
+        return deserialize_state(data, self.context_type), version
+
+    async def version(self, conversation_id: str) -> Optional[bytes]:
+        self.version_checks += 1
+        return await self.client.get(self.version_prefix + conversation_id)
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]) -> bytes:
+        """保存状态并返回新的版本标记。"""
+        self.saves += 1
+        version = os.urandom(8).hex().encode("ascii")
+        await self.client.transaction(
+            ("SET", self.key_prefix + conversation_id, serialize_state(state), "EX", self.ttl_seconds),
+            ("SET", self.version_prefix + conversation_id, version, "EX", self.ttl_seconds),
+        )
+        return version
+
+    async def start(self) -> None:
+        # 启动时即确认Redis可达，避免第一个请求才发现配置错误
+        await self.client.ping()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"gets": self.gets, "misses": self.misses, "saves": self.saves, "version_checks": self.version_checks}
+
+# =========================
+# 会话亲和
+# =========================
+
+def parse_worker_nodes(spec: str) -> Dict[str, Optional[str]]:
+    """解析WORKER_NODES，如"a=http://10.0.0.1:8000,b=http://10.0.0.2:8000"；地址可省略。"""
+    nodes: Dict[str, Optional[str]] = {}
+    for entry in spec.split(","):
+        name, _, url = entry.strip().partition("=")
+        if name.strip():
+            nodes[name.strip()] = url.strip().rstrip("/") or None
+    return nodes
+
+class HashRing:
+    """一致性哈希环：增删节点时只有约1/N的会话改变归属。"""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 128):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("哈希环至少需要一个节点")
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas)
+        )
+        self._keys = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._owners[index]
+
+# 本地副本中记录其对应的共享层版本标记的键
+_VERSION_KEY = "_shared_version"
+
+class TieredConversationStore(ConversationStore):
+    """
+    本地 + 共享两级会话存储。
+    归本节点所有（按哈希环）的会话在本地层保留热副本；每次保存都写穿到共享层，因此其他节点始终能读到最新状态。
+    本地副本记下它对应的共享层版本标记，命中时只读取共享层的版本标记（一个短键）比对，
+    不一致——其他节点、同一节点的其他worker进程或转发失败时的直接写入改写过该会话——时重新读取完整状态。
+    因此本地副本按进程校验，多个worker共用一个WORKER_NODE也不会读到过期状态。
+    不属于本节点的会话直接读写共享层，不在本地缓存；配置了node_urls时，
+    API层会先把这类请求转发给所属节点（见forward_url），让本地副本尽量命中。
+    """
+
+    def __init__(
+        self,
+        local: ConversationStore,
+        shared: RedisConversationStore,
+        ring: HashRing,
+        node: str,
+        node_urls: Optional[Dict[str, str]] = None,
+    ):
+        if node not in ring.nodes:
+            raise ValueError(f"节点{node}不在哈希环中: {ring.nodes}")
+        self.local = local
+        self.shared = shared
+        self.ring = ring
+        self.node = node
+        self.node_urls = dict(node_urls or {})
+        self.local_hits = 0
+        self.stale_hits = 0
+        self.shared_reads = 0
+        self.foreign_requests = 0
+
+    def owner(self, conversation_id: str) -> str:
+        return self.ring.node_for(conversation_id)
+
+    def owns(self, conversation_id: str) -> bool:
+        return self.owner(conversation_id) == self.node
+
+    def forward_url(self, conversation_id: str) -> Optional[str]:
+        """会话属于其他节点且该节点地址已知时，返回应转发到的基础URL。"""
+        owner = self.owner(conversation_id)
+        if owner == self.node:
+            return None
+        return self.node_urls.get(owner)
+
+    async def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        owned = self.owns(conversation_id)
+        if owned:
+            cached = await self.local.get(conversation_id)
+            if cached is not None:
+                # 返回深拷贝：调用方会就地追加input_items、修改context，共享层保存失败时本地副本不能随之改变
+                state = copy.deepcopy(cached)
+                version = state.pop(_VERSION_KEY, None)
+                if version is not None and version.encode("ascii") == await self.shared.version(conversation_id):
+                    self.local_hits += 1
+                    return state
+                self.stale_hits += 1
+        else:
+            self.foreign_requests += 1
+        self.shared_reads += 1
+        state, version = await self.shared.get_versioned(conversation_id)
+        if state is not None and owned and version is not None:
+            await self.local.save(conversation_id, {**state, _VERSION_KEY: version.decode("ascii")})
+        return state
+
+    async def save(self, conversation_id: str, state: Dict[str, Any]):
+        version = await self.shared.save(conversation_id, state)
+        if self.owns(conversation_id):
+            await self.local.save(conversation_id, {**state, _VERSION_KEY: version.decode("ascii")})
+
+    async def start(self) -> None:
+        await self.shared.start()
+        await self.local.start()
+
+    async def close(self) -> None:
+        await self.local.close()
+        await self.shared.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "node": self.node,
+            "nodes": self.ring.nodes,
+            "process": os.getpid(),
+            "local_hits": self.local_hits,
+            "stale_hits": self.stale_hits,
+            "shared_reads": self.shared_reads,
+            "foreign_requests": self.foreign_requests,
+            "local": self.local.stats(),
+            "shared": self.shared.stats(),
+        }
@@ -0,0 +1,274 @@
+"""
+上游LLM调用的容错：带类型的错误、抖动指数退避的有限重试（遵守Retry-After）和按模型的熔断器。
+"""
+from __future__ import annotations as _annotations
+
+import asyncio
+import email.utils
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+import openai
+from pydantic import BaseModel
+
+import metrics
+
+R = TypeVar("R")
+
+# =========================
+# 错误类型
+# =========================
+
+class UpstreamError(Exception):
+    """上游模型调用失败。kind区分失败原因，retryable表示稍后重试可能成功。"""
+
+    kind = "error"
+    retryable = False
+
+    def __init__(self, message: str, model: str = "", status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        self.model = model
+        self.status_code = status_code
+        # 上游（或熔断器）建议的重试等待秒数
+        self.retry_after = retry_after
+        super().__init__(message)
+
+class UpstreamTimeoutError(UpstreamError):
+    kind = "timeout"
+    retryable = True
+
+class UpstreamConnectionError(UpstreamError):
+    kind = "connection"
+    retryable = True
+
+class UpstreamRateLimitError(UpstreamError):
+    kind = "rate_limited"
+    retryable = True
+
+class UpstreamServerError(UpstreamError):
+    kind = "server_error"
+    retryable = True
+
+class UpstreamBadRequestError(UpstreamError):
+    """上游拒绝了请求本身（4xx），重试不会成功，也不说明上游不健康。"""
+    kind = "bad_request"
+
+class CircuitOpenError(UpstreamError):
+    """熔断器打开，未发起调用即快速失败。"""
+    kind = "circuit_open"
+
+def parse_retry_after(headers: Any) -> Optional[float]:
+    """读取retry-after-ms或retry-after（秒数或HTTP日期）。"""
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value) if value else None
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+def to_upstream_error(error: BaseException, model: str) -> Optional[UpstreamError]:
+    """把openai/httpx异常转换为带类型的UpstreamError；无法识别的异常返回None。"""
+    if isinstance(error, UpstreamError):
+        return error
+    if isinstance(error, (openai.APITimeoutError, asyncio.TimeoutError, httpx.TimeoutException)):
+        return UpstreamTimeoutError(f"调用模型{model}超时", model)
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return UpstreamConnectionError(f"无法连接模型{model}的上游：{error}", model)
+    if isinstance(error, openai.APIStatusError):
+        status = error.status_code
+        retry_after = parse_retry_after(error.response.headers)
+        if status == 429:
+            return UpstreamRateLimitError(f"模型{model}被上游限流", model, status, retry_after)
+        if status >= 500:
+            return UpstreamServerError(f"模型{model}的上游返回{status}", model, status, retry_after)
+        return UpstreamBadRequestError(f"模型{model}的上游拒绝了请求（{status}）：{error.message}", model, status)
+    return None
+
+# =========================
+# 重试与熔断
+# =========================
+
+class RetryPolicy(BaseModel):
+    """每次尝试的总时限，以及对可重试错误的抖动指数退避。"""
+    max_retries: int = 2
+    base_delay: float = 0.25
+    max_delay: float = 4.0
+    # Retry-After超过该值时不再等待，直接失败
+    max_retry_after: float = 10.0
+    # 单次尝试的时限：非流式为整次调用，流式为收到第一个分片
+    call_timeout: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        env_fields = {
+            "max_retries": "DEEPSEEK_MAX_RETRIES",
+            "base_delay": "DEEPSEEK_RETRY_BASE_DELAY",
+            "max_delay": "DEEPSEEK_RETRY_MAX_DELAY",
+            "max_retry_after": "DEEPSEEK_RETRY_AFTER_MAX",
+            "call_timeout": "DEEPSEEK_CALL_TIMEOUT",
+        }
+        values = {field: os.environ[var] for field, var in env_fields.items() if os.environ.get(var)}
+        return cls(**values)
+
+    def backoff(self, attempt: int, error: UpstreamError) -> Optional[float]:
+        """第attempt次（从0开始）失败后的等待秒数；不应重试时返回None。"""
+        if not error.retryable or attempt >= self.max_retries:
+            return None
+        # 完全抖动：在[0, min(max_delay, base*2^attempt)]内均匀取值，避免重试同时涌向上游
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if error.retry_after is not None:
+            if error.retry_after > self.max_retry_after:
+                return None
+            delay = max(delay, error.retry_after)
+        return delay
+
+class CircuitBreaker:
+    """
+    连续failure_threshold次上游故障（超时、连接失败、5xx）后打开，recovery_timeout秒内直接拒绝调用；
+    之后进入半开状态，只放行一个探测调用，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.trips = 0
+        self.rejections = 0
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            remaining = self._opened_at + self.recovery_timeout - time.monotonic()
+            if remaining > 0:
+                self.rejections += 1
+                raise CircuitOpenError(f"模型{self.name}的熔断器已打开", self.name, retry_after=remaining)
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                self.rejections += 1
+                raise CircuitOpenError(f"模型{self.name}的熔断器正在探测上游", self.name, retry_after=1.0)
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.trips += 1
+                if metrics.registry.enabled:
+                    CIRCUIT_OPENED_TOTAL.inc(self.name)
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """调用被取消（既非成功也非失败）时释放半开状态的探测名额。"""
+        self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "rejections": self.rejections,
+        }
+
+UPSTREAM_ERRORS_TOTAL = metrics.registry.counter(
+    "cs_llm_upstream_errors_total", "上游调用每次尝试的失败次数", ("model", "kind")
+)
+RETRIES_TOTAL = metrics.registry.counter(
+    "cs_llm_retries_total", "上游调用的重试次数", ("model", "kind")
+)
+CIRCUIT_OPENED_TOTAL = metrics.registry.counter(
+    "cs_llm_circuit_opened_total", "熔断器打开的次数", ("model",)
+)
+
+class ResilientCaller:
+    """按模型维护熔断器，并对一次上游请求执行时限、重试和熔断。"""
+
+    def __init__(self, policy: Optional[RetryPolicy] = None, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.policy = policy or RetryPolicy()
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.retries = 0
+
+    @classmethod
+    def from_env(cls) -> "ResilientCaller":
+        return cls(
+            RetryPolicy.from_env(),
+            failure_threshold=int(os.environ.get("DEEPSEEK_BREAKER_THRESHOLD", "5")),
+            recovery_timeout=float(os.environ.get("DEEPSEEK_BREAKER_RECOVERY", "30")),
+        )
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(model, self.failure_threshold, self.recovery_timeout)
+        return breaker
+
+    def failure(self, error: BaseException, model: str) -> UpstreamError:
+        """记录一次失败的尝试（计入熔断器和指标），返回对应的UpstreamError；无法识别的异常原样抛出。"""
+        upstream_error = to_upstream_error(error, model)
+        if upstream_error is None:
+            self.breaker(model).release()
+            raise error
+        if isinstance(upstream_error, UpstreamBadRequestError):
+            self.breaker(model).record_success()
+        elif not isinstance(upstream_error, (CircuitOpenError, UpstreamRateLimitError)):
+            self.breaker(model).record_failure()
+        else:
+            self.breaker(model).release()
+        if metrics.registry.enabled:
+            UPSTREAM_ERRORS_TOTAL.inc(model, upstream_error.kind)
+        return upstream_error
+
+    async def call(self, model: str, request: Callable[[], Awaitable[R]]) -> R:
+        """执行request()，可重试的失败按策略退避后重试，用尽后抛出最后一个UpstreamError。"""
+        breaker = self.breaker(model)
+        attempt = 0
+        while True:
+            try:
+                breaker.before_call()
+                result = await asyncio.wait_for(request(), timeout=self.policy.call_timeout)
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                error = self.failure(e, model)
+                delay = self.policy.backoff(attempt, error)
+                if delay is None:
+                    raise error from (None if error is e else e)
+                self.retries += 1
+                if metrics.registry.enabled:
+                    RETRIES_TOTAL.inc(model, error.kind)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "breakers": {model: breaker.stats() for model, breaker in self.breakers.items()},
+        }
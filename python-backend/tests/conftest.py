@@ -0,0 +1,9 @@
+"""
+测试在python-backend目录下运行：python -m pytest tests
+上游一律使用进程内的LLM模拟器，Redis使用fake_redis，不需要外部服务。
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DEEPSEEK_DEV_MODE", "true")
@@ -0,0 +1,94 @@
+"""
+测试用的脚本化模型客户端：代替DeepSeekClient按顺序返回预设的回复，并记录每次调用的请求参数。
+用法：Agent(..., client=ScriptedClient(["你好", tool_call("call_1", "lookup", {"q": "x"})]))
+"""
+import asyncio
+import itertools
+import json
+from typing import Any, Callable, Dict, List, Optional, Union
+
+Reply = Union[str, Dict[str, Any], Callable[[List[Dict[str, Any]]], Any]]
+
+def tool_call(call_id: str, name: str, arguments: Optional[Dict[str, Any]] = None, *more: Dict[str, Any]):
+    """一条带工具调用的assistant回复；more中的每项为另一个{"id", "name", "arguments"}调用。"""
+    calls = [{"id": call_id, "name": name, "arguments": arguments or {}}, *more]
+    return {
+        "role": "assistant",
+        "content": "",
+        "tool_calls": [{
+            "id": call["id"],
+            "type": "function",
+            "function": {"name": call["name"], "arguments": json.dumps(call["arguments"], ensure_ascii=False)},
+        } for call in calls],
+    }
+
+class ScriptedClient:
+    """
+    依次返回replies中的回复，用完后重复最后一条。回复可以是字符串、完整的assistant消息，
+    或接收本次请求messages的函数。流式调用在delay秒后开始输出，每chunk_size个字符一个分片，
+    分片之间间隔chunk_delay秒；输出的文本分片计入chunks，被提前关闭的流计入cancelled。
+    给出usage时每次调用都报告该用量（流式调用在最后一个分片中）。
+    """
+
+    def __init__(
+        self,
+        replies: List[Reply],
+        delay: float = 0.0,
+        chunk_size: int = 4,
+        chunk_delay: float = 0.0,
+        usage: Optional[Dict[str, int]] = None,
+    ):
+        self.replies = list(replies)
+        self.usage = usage
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.calls: List[Dict[str, Any]] = []
+        self.cancelled = 0
+        self.chunks = 0
+        self._ids = itertools.count(1)
+
+    def _next_message(self, messages, model: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        self.calls.append({"messages": [dict(m) for m in messages], "model": model, **kwargs})
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if callable(reply):
+            reply = reply(messages)
+        return {"role": "assistant", "content": reply} if isinstance(reply, str) else dict(reply)
+
+    async def chat_completion(self, messages, model="deepseek-v3", **kwargs):
+        message = self._next_message(messages, model, kwargs)
+        await asyncio.sleep(self.delay)
+        finish = "tool_calls" if message.get("tool_calls") else "stop"
+        response = {"id": f"fake-{next(self._ids)}", "choices": [{"index": 0, "message": message, "finish_reason": finish}]}
+        if self.usage:
+            response["usage"] = dict(self.usage)
+        return response
+
+    async def chat_completion_stream(self, messages, model="deepseek-v3", **kwargs):
+        message = self._next_message(messages, model, kwargs)
+
+        def chunk(delta, finish=None):
+            return {"choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+        try:
+            await asyncio.sleep(self.delay)
+            content = message.get("content") or ""
+            for start in range(0, len(content), self.chunk_size):
+                self.chunks += 1
+                yield chunk({"content": content[start:start + self.chunk_size]})
+                await asyncio.sleep(self.chunk_delay)
+            for index, call in enumerate(message.get("tool_calls") or []):
+                yield chunk({"tool_calls": [dict(call, index=index)]})
+            yield chunk({}, "tool_calls" if message.get("tool_calls") else "stop")
+            if self.usage:
+                yield {"choices": [], "usage": dict(self.usage)}
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+
+    async def aclose(self):
+        pass
+
+    def tool_names(self, call: int) -> List[str]:
+        """第call次请求中提供给模型的工具名。"""
+        return [tool["function"]["name"] for tool in self.calls[call].get("tools") or []]
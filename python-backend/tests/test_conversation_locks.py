@@ -0,0 +1,113 @@
+import asyncio
+import gc
+
+import pytest
+
+from conversation_locks import ConversationLockTable, RequestCoalescer
+
+def test_same_key_requests_run_once():
+    async def main():
+        coalescer = RequestCoalescer()
+        calls = []
+
+        async def turn():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return {"reply": "好的"}
+
+        first, second = await asyncio.gather(coalescer.run(("c1", "你好"), turn), coalescer.run(("c1", "你好"), turn))
+        assert first is second
+        assert len(calls) == 1
+        assert coalescer.stats() == {"in_flight": 0, "executions": 1, "coalesced": 1}
+        # 完成后相同的请求重新执行
+        await coalescer.run(("c1", "你好"), turn)
+        assert len(calls) == 2
+
+    asyncio.run(main())
+
+def test_exception_reaches_every_waiter():
+    async def main():
+        coalescer = RequestCoalescer()
+
+        async def turn():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("上游不可用")
+
+        results = await asyncio.gather(*(coalescer.run("key", turn) for _ in range(3)), return_exceptions=True)
+        assert [type(r) for r in results] == [RuntimeError] * 3
+        assert results[0] is results[1] is results[2]
+        assert coalescer.executions == 1
+
+    asyncio.run(main())
+
+def test_cancelled_waiter_does_not_cancel_the_shared_turn():
+    async def main():
+        coalescer = RequestCoalescer()
+        finished = []
+
+        async def turn():
+            await asyncio.sleep(0.05)
+            finished.append(1)
+            return "完成"
+
+        first = asyncio.ensure_future(coalescer.run("key", turn))
+        second = asyncio.ensure_future(coalescer.run("key", turn))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "完成"
+        assert first.cancelled()
+        assert finished == [1]
+
+    asyncio.run(main())
+
+def test_failure_with_no_waiters_left_is_not_logged_as_unretrieved():
+    errors = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        coalescer = RequestCoalescer()
+
+        async def turn():
+            await asyncio.sleep(0.02)
+            raise RuntimeError("上游不可用")
+
+        waiter = asyncio.ensure_future(coalescer.run("key", turn))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0.03)
+        assert coalescer.stats()["in_flight"] == 0
+        del waiter
+        gc.collect()
+
+    asyncio.run(main())
+    gc.collect()
+    assert not [e for e in errors if "never retrieved" in e.get("message", "")]
+
+def test_lock_serializes_turns_of_one_conversation():
+    async def main():
+        locks = ConversationLockTable()
+        timeline = []
+
+        async def turn(conversation_id, message):
+            async with locks.hold(conversation_id):
+                timeline.append(("start", conversation_id, message))
+                await asyncio.sleep(0.02)
+                timeline.append(("end", conversation_id, message))
+
+        await asyncio.gather(turn("c1", "改座位"), turn("c1", "查航班"))
+        # 同一会话的两条不同消息依次执行，按到达顺序
+        assert timeline == [
+            ("start", "c1", "改座位"), ("end", "c1", "改座位"),
+            ("start", "c1", "查航班"), ("end", "c1", "查航班"),
+        ]
+        assert locks.stats() == {"active": 0, "peak": 1, "acquisitions": 2, "contended": 1}
+
+        # 不同会话互不等待
+        timeline.clear()
+        await asyncio.gather(turn("c1", "改座位"), turn("c2", "查航班"))
+        assert [event[0] for event in timeline] == ["start", "start", "end", "end"]
+        assert locks.stats()["active"] == 0
+
+    asyncio.run(main())
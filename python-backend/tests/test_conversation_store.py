@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import sqlite3
+
+import pytest
+from pydantic import BaseModel
+
+import conversation_store
+from conversation_store import BoundedInMemoryConversationStore, SQLiteConversationStore
+
+class Context(BaseModel):
+    seat_number: str | None = None
+
+def _state(message: str):
+    return {"current_agent": "分流代理", "context": Context(), "input_items": [{"role": "user", "content": message}]}
+
+def test_pending_writes_are_capped_while_flushes_fail(tmp_path, monkeypatch, caplog):
+    async def main():
+        store = SQLiteConversationStore(str(tmp_path / "conversations.db"), Context, flush_interval=3600, max_pending=4)
+        await store.start()
+
+        def failing_write(batch):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        monkeypatch.setattr(store, "_write_batch", failing_write)
+        try:
+            for i in range(4):
+                await store.save(f"conv-{i}", _state("hi"))
+            # 已落盘失败的会话再次保存不受上限影响
+            await store.save("conv-0", _state("hi again"))
+            with pytest.raises(sqlite3.OperationalError):
+                await store.save("conv-4", _state("hi"))
+            assert store.stats()["pending"] == 4
+            assert store.backpressure_waits == 1
+            # 数据库恢复后，背压时的落盘清空缓冲区
+            monkeypatch.undo()
+            await store.save("conv-4", _state("hi"))
+            assert store.stats()["pending"] == 1
+            assert (await store.get("conv-0"))["input_items"][0]["content"] == "hi again"
+        finally:
+            await store.close()
+
+    with caplog.at_level(logging.WARNING, logger="conversation_store"):
+        asyncio.run(main())
+    assert len([r for r in caplog.records if "积压" in r.getMessage()]) == 1
+
+def test_least_recently_used_conversations_are_evicted():
+    async def main():
+        store = BoundedInMemoryConversationStore(max_conversations=2)
+        for conversation_id in ("a", "b"):
+            await store.save(conversation_id, _state(conversation_id))
+        # 访问a后，b成为最久未用的会话
+        assert await store.get("a") is not None
+        await store.save("c", _state("c"))
+        assert await store.get("b") is None
+        assert [c for c in ("a", "c") if await store.get(c) is not None] == ["a", "c"]
+        assert store.stats()["evictions"] == 1
+
+        # 按字节上限淘汰：重新保存的会话按新大小计量
+        store = BoundedInMemoryConversationStore(max_bytes=1000)
+        await store.save("a", _state("短"))
+        await store.save("b", _state("短"))
+        assert store.stats()["resident_conversations"] == 2
+        resident = store.stats()["resident_bytes"]
+        await store.save("a", _state("长" * 600))
+        assert await store.get("b") is None
+        assert store.stats()["resident_bytes"] > resident
+        # 超出上限的单个会话仍然保留
+        assert (await store.get("a"))["input_items"][0]["content"] == "长" * 600
+
+    asyncio.run(main())
+
+def test_sweep_expires_only_idle_conversations(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(conversation_store.time, "monotonic", lambda: now[0])
+
+    async def main():
+        store = BoundedInMemoryConversationStore(idle_ttl=60)
+        await store.save("idle", _state("hi"))
+        await store.save("active", _state("hi"))
+        now[0] += 50
+        await store.get("active")
+        now[0] += 20
+        assert await store.sweep() == 1
+        assert await store.get("idle") is None
+        assert await store.get("active") is not None
+        assert store.stats()["expirations"] == 1
+
+    asyncio.run(main())
+
+def test_evicted_conversations_spill_to_disk_and_rehydrate(tmp_path):
+    async def main():
+        spill = SQLiteConversationStore(str(tmp_path / "spill.db"), Context, flush_interval=3600)
+        store = BoundedInMemoryConversationStore(max_conversations=1, spill_store=spill)
+        await store.start()
+        try:
+            state = _state("我想换座位")
+            state["context"].seat_number = "23A"
+            await store.save("a", state)
+            await store.save("b", _state("hi"))
+            assert store.stats()["resident_conversations"] == 1
+            assert store.spills == 1
+
+            restored = await store.get("a")
+            assert restored["context"].seat_number == "23A"
+            assert restored["input_items"] == state["input_items"]
+            assert store.rehydrations == 1
+            # 恢复后重新常驻内存，b被写入磁盘层
+            assert await store.get("a") is restored
+            assert store.spills == 2
+        finally:
+            await store.close()
+
+        # 关闭时常驻的会话也写入磁盘层，重启后可以恢复
+        spill = SQLiteConversationStore(str(tmp_path / "spill.db"), Context)
+        store = BoundedInMemoryConversationStore(spill_store=spill)
+        try:
+            assert (await store.get("a"))["context"].seat_number == "23A"
+            assert (await store.get("b"))["input_items"][0]["content"] == "hi"
+        finally:
+            await store.close()
+
+    asyncio.run(main())
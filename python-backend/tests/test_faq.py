@@ -0,0 +1,101 @@
+import contextlib
+import io
+
+from fastapi.testclient import TestClient
+
+from deepseek_agent import GuardrailFunctionOutput, input_guardrail
+from faq import FAQ_DATA_PATH, FaqAnswerCache, canonicalize_question, lookup_faq
+from faq_index import FaqIndex, load_faq_entries
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import api
+    from main import faq_agent
+
+# 改用BM25检索之前按子串匹配的关键词及其条目，每个关键词仍应得到原来的条目
+_KEYWORD_ENTRIES = {
+    "bag": "baggage", "bags": "baggage", "baggage": "baggage", "行李": "baggage",
+    "seats": "seats", "plane": "seats", "座位": "seats", "飞机": "seats",
+    "wifi": "wifi", "网络": "wifi",
+}
+
+def test_keywords_resolve_to_their_entries():
+    for keyword, entry_id in _KEYWORD_ENTRIES.items():
+        assert lookup_faq(keyword).id == entry_id, keyword
+        assert lookup_faq(f"请问{keyword}怎么样").id == entry_id, keyword
+
+def test_question_words_alone_are_not_an_answer():
+    for question in ("天气怎么样", "今天吃什么", "可以吗", "桌上有什么", "how are you"):
+        assert lookup_faq(question) is None, question
+
+def test_saved_index_is_memory_mapped_with_its_impacts(tmp_path, monkeypatch):
+    built = FaqIndex.build(load_faq_entries(FAQ_DATA_PATH))
+    path = str(tmp_path / "faq.idx")
+    built.save(path)
+    loaded = FaqIndex.load(path)
+    # BM25分量直接引用文件映射，加载时不重新计算
+    assert isinstance(loaded._impacts, memoryview)
+    assert list(loaded._impacts) == list(built._impacts)
+    for query in ("行李限额是多少", "wifi on the plane", "换座位"):
+        assert loaded.search(query) == built.search(query), query
+
+    # BM25参数变化后，文件中的分量不再适用，加载时重新计算
+    monkeypatch.setattr(FaqIndex, "b", 0.75)
+    reloaded = FaqIndex.load(path)
+    assert not isinstance(reloaded._impacts, memoryview)
+    assert list(reloaded._impacts) == list(FaqIndex.build(built.entries)._impacts)
+
+def test_canonical_key_folds_variants():
+    assert canonicalize_question("行李限额是多少？") == canonicalize_question("What is the baggage allowance")
+    assert canonicalize_question("飞机上有WiFi吗") == canonicalize_question("Is there wifi on the plane?")
+
+def test_canonical_key_keeps_word_boundaries():
+    # 字相同、词不同的问题不共用一个键
+    assert canonicalize_question("机票改签") != canonicalize_question("改机票签")
+
+def test_cache_is_keyed_by_entry_and_version():
+    entry = lookup_faq("行李限额是多少")
+    cache = FaqAnswerCache("v1")
+    assert cache.get("行李限额是多少") is None
+    cache.put("行李限额是多少", entry)
+    assert cache.get("What is the baggage allowance") == entry
+    cache.set_version("v2")
+    assert cache.get("行李限额是多少") is None
+
+def _chat(client, conversation_id, message):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return client.post("/chat", json={"conversation_id": conversation_id, "message": message}).json()
+
+def _new_conversation(client):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return client.post("/chat", json={"message": ""}).json()["conversation_id"]
+
+def test_rewritten_reply_is_not_cached():
+    entry = lookup_faq("飞机上有多少个座位")
+    cache_size = len(api.faq_answer_cache._entries)
+    messages = [api.MessageResponse(content="您的座位是12A。" + entry.answer, agent=faq_agent.name)]
+    events = [api.AgentEvent(id="1", type="tool_output", agent=faq_agent.name, content=entry.answer)]
+    api._remember_faq_answer(faq_agent, faq_agent, "我的座位是几号", messages, events)
+    assert len(api.faq_answer_cache._entries) == cache_size
+
+def test_cache_hit_serves_entry_answer_and_runs_guardrails(monkeypatch):
+    entry = lookup_faq("行李限额是多少")
+    with TestClient(api.app) as client:
+        first = _new_conversation(client)
+        _chat(client, first, "行李限额是多少")
+        hits = api.faq_answer_cache.hits
+        second = _new_conversation(client)
+        _chat(client, second, "行李费用是多少")
+        reply = _chat(client, second, "What is the baggage allowance")
+        assert api.faq_answer_cache.hits == hits + 1
+        assert [m["content"] for m in reply["messages"]] == [entry.answer]
+        assert [e["type"] for e in reply["events"]] == ["tool_call", "tool_output", "message"]
+        assert len(reply["guardrails"]) == len(faq_agent.input_guardrails)
+
+        @input_guardrail(name="拒绝一切")
+        async def reject_all(context, agent, input):
+            return GuardrailFunctionOutput(output_info=None, tripwire_triggered=True)
+
+        monkeypatch.setattr(faq_agent, "input_guardrails", [reject_all])
+        refused = _chat(client, second, "行李限额是多少")
+        assert [g["passed"] for g in refused["guardrails"]] == [False]
+        assert refused["messages"][0]["content"] != entry.answer
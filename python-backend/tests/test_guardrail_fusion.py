@@ -0,0 +1,112 @@
+import asyncio
+import contextlib
+import io
+import json
+
+import pytest
+
+import deepseek_agent
+import metrics
+from deepseek_agent import Agent, InputGuardrailTripwireTriggered, Runner
+from fake_model import ScriptedClient
+from guardrail_cache import guardrail_verdict_cache
+from guardrail_fusion import FUSION_TOTAL, guardrail_fuser
+from model_tiers import model_router
+
+with contextlib.redirect_stdout(io.StringIO()):
+    from main import jailbreak_guardrail, jailbreak_spec, relevance_guardrail, relevance_spec
+
+# 本地预分类器无法判定、需要调用LLM的消息
+MESSAGE = "帮我看看明天去上海的航班还有没有票"
+
+@pytest.fixture(autouse=True)
+def clear_verdict_cache():
+    guardrail_verdict_cache.clear()
+    yield
+    guardrail_verdict_cache.clear()
+
+def _install_model(monkeypatch, fused: str, relevance: str = '{"is_relevant": true}', jailbreak: str = '{"is_safe": true}'):
+    """守卫代理都使用默认客户端：按请求的系统指令返回合并调用或单独调用的回复。"""
+    def reply(messages):
+        system = messages[0]["content"]
+        if "### relevance" in system:
+            return fused
+        return relevance if "is_relevant" in system else jailbreak
+
+    client = ScriptedClient([reply])
+    monkeypatch.setattr(deepseek_agent, "_default_client", client)
+    return client
+
+def _guarded_agent() -> Agent:
+    return Agent(name="受守卫代理", instructions="回答航班问题", input_guardrails=[relevance_guardrail, jailbreak_guardrail])
+
+def _calls(client: ScriptedClient):
+    """每次请求是合并调用（fused）还是哪个守卫的单独调用。"""
+    kinds = []
+    for call in client.calls:
+        system = call["messages"][0]["content"]
+        kinds.append("fused" if "### relevance" in system else "relevance" if "is_relevant" in system else "jailbreak")
+    return sorted(kinds)
+
+def test_fused_verdict_is_split_per_guardrail(monkeypatch):
+    client = _install_model(monkeypatch, json.dumps({
+        "is_relevant": True, "is_safe": False, "relevance_reasoning": "询问航班", "jailbreak_reasoning": "索要系统提示词",
+    }, ensure_ascii=False))
+    fused_before = guardrail_fuser.fused_verdicts
+
+    with pytest.raises(InputGuardrailTripwireTriggered) as raised:
+        asyncio.run(Runner.check_input_guardrails(_guarded_agent(), MESSAGE))
+    assert _calls(client) == ["fused"]
+    tripped = raised.value.guardrail_result
+    assert tripped.guardrail is jailbreak_guardrail
+    assert tripped.output.output_info.is_safe is False
+    assert tripped.output.output_info.reasoning == "索要系统提示词"
+    assert guardrail_fuser.fused_verdicts - fused_before == 2
+
+    # 拆开的判定按各自的守卫缓存
+    relevance = guardrail_verdict_cache.get("相关性守卫", model_router.primary(relevance_spec.agent), MESSAGE)
+    assert (relevance.is_relevant, relevance.reasoning) == (True, "询问航班")
+
+def test_passing_fused_verdict_does_not_wait_for_reasoning(monkeypatch):
+    # 回复在理由中途截断：只有在判定字段输出后即提前结束，才不会因无法解析而退回单独调用
+    client = _install_model(monkeypatch, '{"is_relevant": true, "is_safe": true, "relevance_reasoning": "询问航班')
+    results = asyncio.run(Runner.check_input_guardrails(_guarded_agent(), MESSAGE))
+    assert _calls(client) == ["fused"]
+    assert sorted((r.guardrail.name, r.output.tripwire_triggered) for r in results) == [
+        ("相关性守卫", False), ("越狱守卫", False),
+    ]
+
+@pytest.mark.parametrize("fused", [
+    # 缺少越狱守卫的判定字段
+    '{"is_relevant": true, "relevance_reasoning": "询问航班"}',
+    # 判定字段类型不对
+    '{"is_relevant": "也许", "is_safe": true}',
+    "我无法给出判定",
+])
+def test_malformed_fused_output_falls_back_to_separate_calls(monkeypatch, fused):
+    client = _install_model(monkeypatch, fused, jailbreak='{"is_safe": false, "reasoning": "越狱"}')
+    failures_before = guardrail_fuser.parse_failures
+    fallback_before = FUSION_TOTAL.value("越狱守卫", "parse_fallback")
+
+    with pytest.raises(InputGuardrailTripwireTriggered) as raised:
+        asyncio.run(Runner.check_input_guardrails(_guarded_agent(), MESSAGE))
+    assert raised.value.guardrail_result.guardrail is jailbreak_guardrail
+    assert raised.value.guardrail_result.output.output_info.reasoning == "越狱"
+    assert "fused" in _calls(client) and "jailbreak" in _calls(client)
+    assert guardrail_fuser.parse_failures == failures_before + 1
+    if metrics.registry.enabled:
+        assert FUSION_TOTAL.value("越狱守卫", "parse_fallback") == fallback_before + 1
+
+def test_unparsable_verdict_fails_closed_and_is_not_cached(monkeypatch):
+    client = _install_model(monkeypatch, "不是JSON", jailbreak="也不是JSON")
+    unparsable_before = metrics.GUARDRAIL_UNPARSABLE_TOTAL.value("越狱守卫")
+
+    with pytest.raises(InputGuardrailTripwireTriggered) as raised:
+        asyncio.run(Runner.check_input_guardrails(_guarded_agent(), MESSAGE))
+    verdict = raised.value.guardrail_result.output.output_info
+    assert raised.value.guardrail_result.guardrail is jailbreak_guardrail
+    assert (verdict.is_safe, verdict.reasoning) == (False, "守卫判定无法解析，按未通过处理")
+    assert _calls(client) == ["fused", "jailbreak", "relevance"]
+    assert not guardrail_verdict_cache.contains("越狱守卫", model_router.primary(jailbreak_spec.agent), MESSAGE)
+    if metrics.registry.enabled:
+        assert metrics.GUARDRAIL_UNPARSABLE_TOTAL.value("越狱守卫") == unparsable_before + 1
@@ -0,0 +1,67 @@
+import asyncio
+
+from deepseek_agent import (
+    Agent, HandoffCallItem, HandoffOutputItem, MessageOutputItem, Runner, ToolCallOutputItem, default_handoff_tool_name,
+)
+from fake_model import ScriptedClient, tool_call
+
+def _agents(client: ScriptedClient):
+    """两个互相转接的代理。"""
+    first = Agent(name="甲代理", instructions="甲", client=client)
+    second = Agent(name="乙代理", instructions="乙", client=client)
+    first.handoffs = [second]
+    second.handoffs = [first]
+    return first, second
+
+def test_handoffs_beyond_the_limit_are_refused(monkeypatch):
+    monkeypatch.setattr(Runner, "max_handoffs", 2)
+
+    async def main():
+        client = ScriptedClient([])
+        first, second = _agents(client)
+        to_second, to_first = default_handoff_tool_name(second), default_handoff_tool_name(first)
+        # 模型不断要求转接，转接次数用尽后仍要求转接一次
+        client.replies = [
+            tool_call("call_1", to_second),
+            tool_call("call_2", to_first),
+            tool_call("call_3", to_second),
+            "好的，我来直接回答。",
+        ]
+        result = await Runner.run(first, "帮我转人工")
+
+        handoffs = [item for item in result.new_items if isinstance(item, HandoffOutputItem)]
+        assert [(h.source_agent.name, h.target_agent.name) for h in handoffs] == [("甲代理", "乙代理"), ("乙代理", "甲代理")]
+        # 第三次转接被拒绝：以工具错误输出告知模型，当前代理不变
+        refused = [item for item in result.new_items if isinstance(item, ToolCallOutputItem)]
+        assert [(item.call_id, item.output) for item in refused] == [
+            ("call_3", "错误：本次对话转接次数已达上限（2次），请直接回复用户"),
+        ]
+        assert [item.raw_item.id for item in result.new_items if isinstance(item, HandoffCallItem)] == [
+            "call_1", "call_2", "call_3",
+        ]
+        assert result.last_agent is first
+        assert isinstance(result.new_items[-1], MessageOutputItem)
+        assert result.new_items[-1].agent is first
+        # 转接次数用尽后，请求中不再提供转接工具
+        assert [client.tool_names(i) for i in range(4)] == [[to_second], [to_first], [], []]
+
+    asyncio.run(main())
+
+def test_only_the_first_handoff_in_a_turn_is_taken():
+    async def main():
+        client = ScriptedClient([])
+        first, second = _agents(client)
+        third = Agent(name="丙代理", instructions="丙", client=client)
+        first.handoffs = [second, third]
+        to_second, to_third = default_handoff_tool_name(second), default_handoff_tool_name(third)
+        client.replies = [
+            tool_call("call_1", to_second, {}, {"id": "call_2", "name": to_third, "arguments": {}}),
+            "乙代理为您服务。",
+        ]
+        result = await Runner.run(first, "帮我转人工")
+        assert result.last_agent is second
+        assert [(item.call_id, item.output) for item in result.new_items if isinstance(item, ToolCallOutputItem)] == [
+            ("call_2", "错误：一次只能转接到一个代理"),
+        ]
+
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+import asyncio
+
+from pydantic import BaseModel
+
+from deepseek_agent import Agent
+from fake_model import ScriptedClient
+from history import HistoryManager, message_tokens
+
+class Context(BaseModel):
+    seat_number: str | None = None
+
+AGENT = Agent(name="历史测试代理", instructions="回答航班问题", client=ScriptedClient([]))
+
+def _state(turns: int):
+    """每轮为用户消息、带工具调用的助手消息、工具结果和助手回复，各约50个token。"""
+    items = []
+    for i in range(turns):
+        items += [
+            {"role": "user", "content": f"第{i}轮问题" + "问" * 40},
+            {"role": "assistant", "content": None, "tool_calls": [
+                {"id": f"call_{i}", "type": "function", "function": {"name": "查询", "arguments": "{}"}},
+            ]},
+            {"role": "tool", "tool_call_id": f"call_{i}", "content": "结" * 40},
+            {"role": "assistant", "content": f"第{i}轮回答" + "答" * 40},
+        ]
+    return {"current_agent": AGENT.name, "context": Context(), "input_items": items}
+
+async def _wait_for_summaries(manager: HistoryManager):
+    await asyncio.gather(*list(manager._tasks.values()), return_exceptions=True)
+
+def test_window_keeps_whole_recent_turns_within_budget():
+    manager = HistoryManager(token_budget=400)
+    state = _state(10)
+    window = manager.window("c1", AGENT, state)
+    overhead = manager._agent_overhead(AGENT, state["context"])
+    assert sum(message_tokens(item) for item in window) + overhead <= 400
+    # 从用户消息开始，工具调用与结果不被拆开，并以最新的消息结束
+    assert window[0]["role"] == "user"
+    assert len(window) % 4 == 0
+    assert window == state["input_items"][-len(window):]
+    assert len(window) < len(state["input_items"])
+
+    # 最新一轮本身超出预算时仍完整保留
+    assert manager.window("c1", AGENT, _state(1)) == _state(1)["input_items"]
+    assert HistoryManager(token_budget=10).window("c2", AGENT, state) == state["input_items"][-4:]
+
+def test_summary_replaces_the_folded_prefix_exactly_once():
+    calls = []
+
+    async def summarize(previous, items):
+        calls.append((previous, [item.get("content") for item in items]))
+        return f"摘要{len(calls)}"
+
+    async def main():
+        manager = HistoryManager(token_budget=1000, summarize=summarize)
+        state = _state(6)
+        manager.schedule_summary("c1", state)
+        # 同一会话的摘要在完成前不重复调度
+        manager.schedule_summary("c1", state)
+        await _wait_for_summaries(manager)
+        assert len(calls) == 1
+        assert calls[0][0] == ""
+        upto = len(calls[0][1])
+        assert upto % 4 == 0 and 0 < upto < len(state["input_items"])
+
+        # 摘要在下一轮构建窗口时生效：以摘要代替被折叠的前缀
+        window = manager.window("c1", AGENT, state)
+        assert window[0] == {"role": "system", "content": "此前对话的摘要：摘要1"}
+        assert window[1:] == state["input_items"][upto:]
+        assert state["summary"]["upto"] == upto
+        # 再次构建窗口不会重复插入摘要
+        assert manager.window("c1", AGENT, state) == window
+
+        # 对话继续增长：下一次折叠只摘要上次之后的部分，并在已有摘要的基础上更新
+        state["input_items"] += _state(6)["input_items"]
+        manager.schedule_summary("c1", state)
+        await _wait_for_summaries(manager)
+        assert len(calls) == 2
+        assert calls[1][0] == "摘要1"
+        assert calls[1][1][0] == state["input_items"][upto]["content"]
+        window = manager.window("c1", AGENT, state)
+        assert [item["content"] for item in window if item["role"] == "system"] == ["此前对话的摘要：摘要2"]
+        assert state["summary"]["upto"] == upto + len(calls[1][1])
+        assert manager.stats()["summaries"] == 2
+
+    asyncio.run(main())
+
+def test_failed_summary_leaves_history_intact():
+    async def summarize(previous, items):
+        raise RuntimeError("上游不可用")
+
+    async def main():
+        manager = HistoryManager(token_budget=1000, summarize=summarize)
+        state = _state(6)
+        items = list(state["input_items"])
+        before = manager.window("c1", AGENT, state)
+        manager.schedule_summary("c1", state)
+        await _wait_for_summaries(manager)
+        assert manager.stats()["summary_failures"] == 1
+        assert "summary" not in state
+        assert state["input_items"] == items
+        assert manager.window("c1", AGENT, state) == before
+        # 失败后下一轮会重新尝试折叠
+        manager.schedule_summary("c1", state)
+        assert manager.stats()["summaries_in_flight"] == 1
+        await _wait_for_summaries(manager)
+        assert manager.stats()["summary_failures"] == 2
+
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+import contextlib
+import io
+
+from fastapi.testclient import TestClient
+
+from deepseek_agent import GuardrailFunctionOutput, input_guardrail
+from intent_router import INTENT_HELDOUT_PATH, OTHER_INTENT, intent_router, load_examples
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import api
+    from main import cancellation_agent
+
+def test_heldout_routing_is_reliable():
+    report = intent_router.evaluate(load_examples(INTENT_HELDOUT_PATH))
+    assert report["routed"] > 0
+    assert report["precision"] >= 0.9, report["misrouted"]
+    # 不属于任何专门代理的消息不能被直接转给取消代理
+    assert not [m for m in report["misrouted"] if m[1] == OTHER_INTENT and m[2] == "cancellation"]
+
+def test_out_of_domain_questions_fall_back_to_triage():
+    for message in ("我的行李丢了怎么办", "行李箱丢失了怎么处理", "怎么办理值机", "I lost my luggage"):
+        prediction = intent_router.predict(message)
+        assert prediction.intent == OTHER_INTENT or prediction.confidence < intent_router.threshold, message
+
+def test_routed_handoff_is_undone_when_guardrail_trips(monkeypatch):
+    @input_guardrail(name="拒绝一切")
+    async def reject_all(context, agent, input):
+        return GuardrailFunctionOutput(output_info=None, tripwire_triggered=True)
+
+    monkeypatch.setattr(cancellation_agent, "input_guardrails", [reject_all])
+    message = "我想取消我的航班"
+    assert intent_router.predict(message).intent == "cancellation"
+    with TestClient(api.app) as client, contextlib.redirect_stdout(io.StringIO()):
+        created = client.post("/chat", json={"message": ""}).json()
+        reply = client.post("/chat", json={"conversation_id": created["conversation_id"], "message": message}).json()
+    assert reply["current_agent"] == created["current_agent"]
+    assert reply["context"] == created["context"]
+    assert reply["messages"][0]["content"] == "抱歉，我只能回答与航空旅行相关的问题。"
+    assert not [e for e in reply["events"] if e["type"] in ("handoff", "context_update")]
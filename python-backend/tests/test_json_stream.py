@@ -0,0 +1,119 @@
+import asyncio
+import json
+import time
+
+import pytest
+from pydantic import BaseModel
+
+import metrics
+from deepseek_agent import Agent, DeepSeekClient, ModelBehaviorError, Runner
+from json_stream import IncrementalJSONParser, parse_partial
+from llm_simulator import LatencyProfile, LLMSimulator, ScriptedResponder
+
+def _feed_in_pieces(parser: IncrementalJSONParser, text: str, size: int) -> None:
+    for start in range(0, len(text), size):
+        parser.feed(text[start:start + size])
+
+def test_escapes_split_across_feeds():
+    value = {"reasoning": 'he said "hi" \\ 行李\n', "note": "é😀", "ok": True}
+    text = json.dumps(value)
+    assert "\\u" in text
+    for size in range(1, 8):
+        parser = IncrementalJSONParser()
+        _feed_in_pieces(parser, text, size)
+        assert parser.done
+        assert parser.root == value
+
+def test_escaped_quote_does_not_end_string_early():
+    parser = IncrementalJSONParser()
+    assert not parser.feed('{"reasoning": "a \\"quoted')
+    assert parser.root == {}
+    assert parser.feed(' word\\"", "is_safe": ')
+    assert parser.root == {"reasoning": 'a "quoted word"'}
+
+def test_fields_are_visible_before_the_object_closes():
+    parser = IncrementalJSONParser()
+    parser.feed('{"verdict": {"is_safe": false, "score": 0.')
+    # 嵌套对象立即可见，其中只出现已完整的标量
+    assert parser.root == {"verdict": {"is_safe": False}}
+    parser.feed('25, "tags": ["a", "b"')
+    assert parser.root == {"verdict": {"is_safe": False, "score": 0.25}}
+    parser.feed('], "meta": {}}, "reasoning": "long')
+    assert parser.root == {"verdict": {"is_safe": False, "score": 0.25, "tags": ["a", "b"], "meta": {}}}
+    assert not parser.done
+
+def test_fenced_reply_stops_at_closing_brace():
+    parser = IncrementalJSONParser()
+    _feed_in_pieces(parser, '```json\n{"is_relevant": true, "reasoning": "}"}\n```\n这段之后的文字不应被解析', 3)
+    assert parser.done
+    assert parser.root == {"is_relevant": True, "reasoning": "}"}
+    # 结束后的输入被忽略
+    assert not parser.feed('{"is_relevant": false}')
+    assert parser.root == {"is_relevant": True, "reasoning": "}"}
+
+def test_parse_partial():
+    assert parse_partial("") is None
+    assert parse_partial('{"a": [1, 2') == {}
+    assert parse_partial('{"a": tru') == {}
+    assert parse_partial('{"a": true, "b": nul') == {"a": True}
+    with pytest.raises(ValueError):
+        parse_partial('{"a" 1}')
+
+@pytest.mark.parametrize("text", ['{"is_safe": true,}', '{"is_safe": true, }', '{"v": {"is_safe": true,}}', '[true,]'])
+def test_trailing_comma_is_rejected(text):
+    parser = IncrementalJSONParser()
+    with pytest.raises(ValueError):
+        parser.feed(text)
+    assert not parser.done
+
+class Verdict(BaseModel):
+    is_safe: bool
+    reasoning: str = ""
+
+REPLY = json.dumps({"is_safe": True, "reasoning": "这是一条正常的航班查询。" * 40}, ensure_ascii=False)
+
+def _agent(reply: str, tokens_per_sec: float) -> Agent:
+    simulator = LLMSimulator(LatencyProfile(tokens_per_sec=tokens_per_sec), responder=ScriptedResponder([reply]))
+    client = DeepSeekClient(dev_mode=True, simulator=simulator)
+    return Agent(name="测试守卫", instructions="判定消息是否安全", output_type=Verdict, client=client)
+
+def test_run_structured_returns_once_accepted():
+    async def main():
+        agent = _agent(REPLY, tokens_per_sec=200)
+        before = metrics.STRUCTURED_EARLY_EXIT_TOTAL.value(agent.name)
+        started = time.perf_counter()
+        try:
+            output = await Runner.run_structured(agent, "我的航班状态？", accept=lambda o: o.is_safe)
+        finally:
+            await agent.client.aclose()
+        elapsed = time.perf_counter() - started
+        assert output.is_safe
+        # 判定字段之后的理由还要生成数秒，提前结束时不等待
+        assert elapsed < 1.0
+        if metrics.registry.enabled:
+            assert metrics.STRUCTURED_EARLY_EXIT_TOTAL.value(agent.name) == before + 1
+
+    asyncio.run(main())
+
+def test_run_structured_reads_whole_reply_when_not_accepted():
+    async def main():
+        agent = _agent(REPLY, tokens_per_sec=0)
+        try:
+            output = await Runner.run_structured(agent, "我的航班状态？", accept=lambda o: not o.is_safe)
+        finally:
+            await agent.client.aclose()
+        assert output.is_safe
+        assert output.reasoning == json.loads(REPLY)["reasoning"]
+
+    asyncio.run(main())
+
+def test_run_structured_rejects_malformed_reply():
+    async def main():
+        agent = _agent("```json\n{\"is_safe\": maybe}\n```", tokens_per_sec=0)
+        try:
+            with pytest.raises(ModelBehaviorError):
+                await Runner.run_structured(agent, "我的航班状态？", accept=lambda o: o.is_safe)
+        finally:
+            await agent.client.aclose()
+
+    asyncio.run(main())
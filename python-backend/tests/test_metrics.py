@@ -0,0 +1,117 @@
+import asyncio
+import contextlib
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+
+import metrics
+from deepseek_agent import Agent, Runner, function_tool
+from fake_model import ScriptedClient, tool_call
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import api
+
+@pytest.fixture
+def registry(monkeypatch):
+    """独立的注册表，避免受其他测试已记录的观测影响。"""
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, "registry", registry)
+    return registry
+
+def test_prometheus_rendering(registry):
+    requests = registry.counter("test_requests_total", "请求数", ("path",))
+    latency = registry.histogram("test_latency_seconds", "耗时", ("path",), buckets=(0.1, 1.0))
+    requests.inc('/a"b')
+    requests.inc('/a"b', amount=2)
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, "/a")
+    # 同名指标重复注册时返回已有的指标，类型或标签不同时报错
+    assert registry.counter("test_requests_total", "请求数", ("path",)) is requests
+    with pytest.raises(ValueError):
+        registry.histogram("test_requests_total", "请求数", ("path",))
+
+    assert registry.render().splitlines() == [
+        "# HELP test_requests_total 请求数",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{path="/a\\"b"} 3',
+        "# HELP test_latency_seconds 耗时",
+        "# TYPE test_latency_seconds histogram",
+        'test_latency_seconds_bucket{path="/a",le="0.1"} 2',
+        'test_latency_seconds_bucket{path="/a",le="1"} 3',
+        'test_latency_seconds_bucket{path="/a",le="+Inf"} 4',
+        'test_latency_seconds_sum{path="/a"} 3.65',
+        'test_latency_seconds_count{path="/a"} 4',
+    ]
+    assert latency.count("/a") == 4
+
+def test_stage_timings_skip_stages_inside_an_enclosing_stage(registry):
+    histogram = registry.histogram("test_stage_seconds", "阶段耗时", ("stage",))
+
+    async def main():
+        timings = metrics.collect_stage_timings()
+        metrics.observe_stage("llm", histogram, 0.0, "llm")
+        metrics.observe_stage("llm", histogram, 0.0, "llm")
+        with metrics.enclosing_stage("guardrail"):
+            metrics.observe_stage("llm", histogram, 0.0, "inner_llm")
+        return timings
+
+    timings = asyncio.run(main())
+    assert list(timings) == ["llm"]
+    # 内层阶段仍写入直方图
+    assert histogram.count("llm") == 2 and histogram.count("inner_llm") == 1
+    assert metrics.server_timing_header({"llm": 0.0123, "total": 0.5}) == "llm;dur=12.3, total;dur=500.0"
+
+def test_disabled_registry_records_nothing(monkeypatch):
+    registry = metrics.MetricsRegistry(enabled=False)
+    monkeypatch.setattr(metrics, "registry", registry)
+    histogram = registry.histogram("test_disabled_seconds", "耗时")
+
+    async def main():
+        timings = metrics.collect_stage_timings()
+        metrics.observe_stage("llm", histogram, 0.0)
+        return timings
+
+    assert asyncio.run(main()) == {}
+    assert histogram.count() == 0
+
+def test_run_records_run_llm_and_tool_stages():
+    @function_tool
+    def lookup(flight: str) -> str:
+        """查询航班"""
+        return f"{flight}准点"
+
+    async def main():
+        client = ScriptedClient([tool_call("call_1", "lookup", {"flight": "FLT-123"}), "航班准点。"])
+        agent = Agent(name="指标测试代理", instructions="回答", tools=[lookup], client=client)
+        runs = metrics.AGENT_RUN_SECONDS.count(agent.name, "ok")
+        calls = metrics.LLM_REQUEST_SECONDS.count(agent.name, "deepseek-v3", "ok")
+        tools = metrics.TOOL_SECONDS.count(agent.name, "lookup", "ok")
+        timings = metrics.collect_stage_timings()
+        await Runner.run(agent, "FLT-123准点吗")
+        if metrics.registry.enabled:
+            assert metrics.AGENT_RUN_SECONDS.count(agent.name, "ok") == runs + 1
+            assert metrics.LLM_REQUEST_SECONDS.count(agent.name, "deepseek-v3", "ok") == calls + 2
+            assert metrics.TOOL_SECONDS.count(agent.name, "lookup", "ok") == tools + 1
+            assert set(timings) == {"llm", "tool", "run"}
+            assert timings["run"] >= timings["llm"]
+
+    asyncio.run(main())
+
+def test_chat_response_carries_server_timing_and_metrics_endpoint():
+    if not metrics.registry.enabled:
+        pytest.skip("METRICS_ENABLED=false")
+    with TestClient(api.app) as client, contextlib.redirect_stdout(io.StringIO()):
+        turns = metrics.CHAT_TURN_SECONDS.count("chat", "ok")
+        conversation_id = client.post("/chat", json={"message": ""}).json()["conversation_id"]
+        response = client.post("/chat", json={"conversation_id": conversation_id, "message": "我能换座位吗？"})
+        stages = dict(part.split(";dur=") for part in response.headers["server-timing"].split(", "))
+        assert {"store", "guardrail", "llm", "run", "build", "turn", "total"} <= set(stages)
+        assert float(stages["total"]) >= float(stages["turn"]) >= float(stages["build"])
+        assert metrics.CHAT_TURN_SECONDS.count("chat", "ok") == turns + 1
+
+        exported = client.get("/metrics")
+    assert exported.headers["content-type"] == metrics.PROMETHEUS_CONTENT_TYPE
+    lines = exported.text.splitlines()
+    assert "# TYPE cs_chat_turn_seconds histogram" in lines
+    assert f'cs_chat_turn_seconds_count{{endpoint="chat",outcome="ok"}} {turns + 1}' in lines
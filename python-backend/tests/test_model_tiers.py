@@ -0,0 +1,143 @@
+import asyncio
+import contextlib
+import io
+import json
+
+import pytest
+
+import deepseek_agent
+from deepseek_agent import Agent, DeepSeekClient, InputGuardrailTripwireTriggered, Runner
+from guardrail_cache import guardrail_verdict_cache
+from guardrail_fusion import guardrail_fuser
+from history import summarizer_agent
+from llm_simulator import LLMSimulator, ScriptedResponder
+from model_tiers import (
+    MODEL_CONFIG_PATH, MODEL_SELECTIONS_TOTAL, AgentModelConfig, ModelRouter, load_model_config, model_router,
+)
+from resilience import ResilientCaller, RetryPolicy, UpstreamServerError
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main
+
+def _simulator_client(replies, unavailable=()) -> DeepSeekClient:
+    simulator = LLMSimulator(responder=ScriptedResponder(list(replies)), unavailable_models=list(unavailable))
+    # 不在同一模型上重试，503直接转到链中的下一个模型
+    return DeepSeekClient(dev_mode=True, simulator=simulator, resilience=ResilientCaller(RetryPolicy(max_retries=0)))
+
+def test_shipped_chains_start_with_declared_models():
+    agents = [
+        main.triage_agent, main.faq_agent, main.seat_booking_agent, main.flight_status_agent,
+        main.cancellation_agent, main.guardrail_agent, main.jailbreak_guardrail_agent, summarizer_agent,
+        guardrail_fuser._fused_agent([main.relevance_spec, main.jailbreak_spec]),
+    ]
+    config = load_model_config(MODEL_CONFIG_PATH)
+    assert sorted(config) == sorted(agent.name for agent in agents)
+    for agent in agents:
+        assert config[agent.name].models[0] == agent.model, agent.name
+    assert main.guardrail_agent.model == main.jailbreak_guardrail_agent.model == "qwen-turbo"
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_unavailable_model_falls_back_to_next_in_chain(monkeypatch, stream):
+    monkeypatch.setitem(model_router.agents, "分级测试代理", AgentModelConfig(models=["qwen-turbo", "deepseek-v3"]))
+    fallback_before = MODEL_SELECTIONS_TOTAL.value("分级测试代理", "deepseek-v3", "fallback")
+
+    async def main_():
+        client = _simulator_client(["您好"], unavailable=["qwen-turbo"])
+        agent = Agent(name="分级测试代理", model="qwen-turbo", instructions="回答", client=client)
+        try:
+            if stream:
+                result = Runner.run_streamed(agent, "你好")
+                events = [event async for event in result.stream_events()]
+                assert {e.model for e in events if e.type == "message_delta"} == {"deepseek-v3"}
+            else:
+                result = await Runner.run(agent, "你好")
+            assert result.new_items[-1].content == "您好"
+            assert client.simulator.server_errors == 1
+        finally:
+            await client.aclose()
+
+    asyncio.run(main_())
+    assert MODEL_SELECTIONS_TOTAL.value("分级测试代理", "deepseek-v3", "fallback") == fallback_before + 1
+
+def test_last_model_failure_is_raised(monkeypatch):
+    monkeypatch.setitem(model_router.agents, "分级测试代理", AgentModelConfig(models=["qwen-turbo", "deepseek-v3"]))
+
+    async def main_():
+        client = _simulator_client(["您好"], unavailable=["qwen-turbo", "deepseek-v3"])
+        try:
+            with pytest.raises(UpstreamServerError):
+                await Runner.run(Agent(name="分级测试代理", instructions="回答", client=client), "你好")
+        finally:
+            await client.aclose()
+
+    asyncio.run(main_())
+
+class _Agent:
+    def __init__(self, name: str, model: str = "deepseek-v3"):
+        self.name = name
+        self.model = model
+
+def test_adaptive_policy_downgrades_over_budget_and_probes():
+    router = ModelRouter(
+        {"守卫": AgentModelConfig(models=["deepseek-v3", "qwen-turbo"], latency_budget_ms=500)},
+        adaptive=True, min_samples=2, probe_every=4,
+    )
+    agent = _Agent("守卫")
+    # 样本不足时仍用首选模型
+    router.observe("守卫", "deepseek-v3", 2.0, 0.0)
+    assert router.plan(agent)[0] == ("deepseek-v3", "primary")
+    router.observe("守卫", "deepseek-v3", 2.0, 0.0)
+    plans = [router.plan(agent) for _ in range(3)]
+    assert [plan[0] for plan in plans] == [
+        ("qwen-turbo", "adaptive_latency"), ("qwen-turbo", "adaptive_latency"), ("deepseek-v3", "probe"),
+    ]
+    # 降级后首选模型仍作为后备
+    assert plans[0][1] == ("deepseek-v3", "fallback")
+    # 首选模型恢复后切回
+    for _ in range(10):
+        router.observe("守卫", "deepseek-v3", 0.1, 0.0)
+    assert router.plan(agent)[0] == ("deepseek-v3", "primary")
+
+def test_adaptive_policy_downgrades_on_cost_only_to_cheaper_models():
+    router = ModelRouter(
+        {
+            "代理": AgentModelConfig(models=["qwen-plus", "deepseek-v3", "qwen-turbo"]),
+            "便宜代理": AgentModelConfig(models=["qwen-turbo", "deepseek-v3"]),
+        },
+        adaptive=True, cost_budget=0.01, min_samples=1,
+    )
+    router.observe("代理", "qwen-plus", 0.1, 0.05)
+    router.observe("便宜代理", "qwen-turbo", 0.1, 0.05)
+    # 跳过比首选模型更贵的deepseek-v3
+    assert router.plan(_Agent("代理"))[0] == ("qwen-turbo", "adaptive_cost")
+    # 链中没有更便宜的模型时不降级
+    assert router.plan(_Agent("便宜代理"))[0] == ("qwen-turbo", "primary")
+
+def test_fallback_verdict_is_not_cached_as_the_primary_verdict(monkeypatch):
+    message = "帮我看看明天去上海的航班还有没有票"
+    fused = json.dumps({"is_relevant": True, "is_safe": True}, ensure_ascii=False)
+    client = _simulator_client([fused], unavailable=["qwen-turbo"])
+    monkeypatch.setattr(deepseek_agent, "_default_client", client)
+    guardrail_verdict_cache.clear()
+    guarded = Agent(
+        name="受守卫代理", instructions="回答", input_guardrails=[main.relevance_guardrail, main.jailbreak_guardrail]
+    )
+
+    async def check():
+        try:
+            return await Runner.check_input_guardrails(guarded, message)
+        except InputGuardrailTripwireTriggered as e:
+            pytest.fail(f"守卫不应触发：{e}")
+
+    try:
+        asyncio.run(check())
+        # 首选模型qwen-turbo不可用，判定由deepseek-v3给出，只缓存在deepseek-v3下
+        for spec in (main.relevance_spec, main.jailbreak_spec):
+            assert not guardrail_verdict_cache.contains(spec.name, "qwen-turbo", message)
+            assert guardrail_verdict_cache.contains(spec.name, "deepseek-v3", message)
+        requests = client.simulator.requests
+        asyncio.run(check())
+        assert client.simulator.requests > requests
+    finally:
+        guardrail_verdict_cache.clear()
+        asyncio.run(client.aclose())
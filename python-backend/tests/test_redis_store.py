@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+from pydantic import BaseModel
+
+from conversation_store import BoundedInMemoryConversationStore
+from fake_redis import FakeRedisServer
+from redis_store import HashRing, RedisClient, RedisConversationStore, TieredConversationStore
+
+class Context(BaseModel):
+    seat_number: str | None = None
+
+def _state(*messages: str):
+    return {
+        "current_agent": "分流代理",
+        "context": Context(seat_number="12A"),
+        "input_items": [{"role": "user", "content": m} for m in messages],
+    }
+
+def _tiered(server: FakeRedisServer, node: str, nodes=("a", "b")) -> TieredConversationStore:
+    shared = RedisConversationStore(RedisClient(server.url), Context)
+    return TieredConversationStore(BoundedInMemoryConversationStore(), shared, HashRing(nodes), node)
+
+def _owned_by(ring: HashRing, node: str) -> str:
+    return next(f"conv-{i}" for i in range(1000) if ring.node_for(f"conv-{i}") == node)
+
+def _run(test):
+    async def main():
+        server = await FakeRedisServer().start()
+        try:
+            await test(server)
+        finally:
+            await server.close()
+    asyncio.run(main())
+
+def test_owner_serves_local_copy_while_fresh():
+    async def test(server):
+        owner = _tiered(server, "a")
+        conversation_id = _owned_by(owner.ring, "a")
+        await owner.save(conversation_id, _state("msg1"))
+        state = await owner.get(conversation_id)
+        assert [m["content"] for m in state["input_items"]] == ["msg1"]
+        assert "_shared_version" not in state
+        assert owner.stats()["local_hits"] == 1
+        assert owner.shared.gets == 0
+    _run(test)
+
+def test_owner_rereads_after_write_by_other_node():
+    async def test(server):
+        owner, other = _tiered(server, "a"), _tiered(server, "b")
+        conversation_id = _owned_by(owner.ring, "a")
+        await owner.save(conversation_id, _state("msg1"))
+        assert await owner.get(conversation_id) is not None
+        # 其他节点（如转发失败时的直接写入）改写了会话
+        await other.save(conversation_id, _state("msg1", "msg2"))
+        state = await owner.get(conversation_id)
+        assert [m["content"] for m in state["input_items"]] == ["msg1", "msg2"]
+        assert owner.stale_hits == 1
+        # 重新读取后本地副本恢复为最新，再次命中本地
+        await owner.get(conversation_id)
+        assert owner.local_hits == 2
+    _run(test)
+
+def test_local_copy_is_unchanged_when_shared_save_fails(monkeypatch):
+    async def test(server):
+        owner = _tiered(server, "a")
+        conversation_id = _owned_by(owner.ring, "a")
+        await owner.save(conversation_id, _state("msg1"))
+        # API层就地修改取到的状态，随后保存到共享层失败
+        state = await owner.get(conversation_id)
+        state["input_items"].append({"role": "user", "content": "msg2"})
+        state["context"].seat_number = "23A"
+
+        async def failing_save(conversation_id, state):
+            raise ConnectionError("redis不可用")
+
+        monkeypatch.setattr(owner.shared, "save", failing_save)
+        with pytest.raises(ConnectionError):
+            await owner.save(conversation_id, state)
+        monkeypatch.undo()
+        state = await owner.get(conversation_id)
+        assert [m["content"] for m in state["input_items"]] == ["msg1"]
+        assert state["context"].seat_number == "12A"
+        assert owner.local_hits == 2
+    _run(test)
+
+def test_workers_sharing_a_node_name_validate_their_own_copies():
+    async def test(server):
+        worker1, worker2 = _tiered(server, "a"), _tiered(server, "a")
+        conversation_id = _owned_by(worker1.ring, "a")
+        await worker1.save(conversation_id, _state("msg1"))
+        assert await worker2.get(conversation_id) is not None
+        await worker1.save(conversation_id, _state("msg1", "msg2"))
+        state = await worker2.get(conversation_id)
+        assert len(state["input_items"]) == 2
+    _run(test)
+
+def test_foreign_conversations_are_not_cached_locally():
+    async def test(server):
+        store = _tiered(server, "a")
+        conversation_id = _owned_by(store.ring, "b")
+        await store.save(conversation_id, _state("msg1"))
+        assert await store.local.get(conversation_id) is None
+        assert (await store.get(conversation_id))["context"].seat_number == "12A"
+        assert store.foreign_requests == 1
+        assert store.forward_url(conversation_id) is None
+    _run(test)
+
+def test_missing_conversation():
+    async def test(server):
+        store = _tiered(server, "a")
+        assert await store.get(_owned_by(store.ring, "a")) is None
+    _run(test)
+
+def test_transaction_is_atomic_and_reports_errors():
+    async def test(server):
+        client = RedisClient(server.url)
+        assert await client.transaction(("SET", "k", b"v"), ("GET", "k")) == ["OK", b"v"]
+        assert await client.mget("k", "missing") == [b"v", None]
+        await client.close()
+    _run(test)
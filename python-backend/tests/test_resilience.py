@@ -0,0 +1,156 @@
+import asyncio
+import email.utils
+import json
+import time
+
+import pytest
+
+from deepseek_agent import DeepSeekClient
+from llm_simulator import LatencyProfile, LLMSimulator, SimulatedResponse
+from resilience import (
+    CircuitOpenError, ResilientCaller, RetryPolicy, UpstreamRateLimitError, UpstreamServerError, UpstreamTimeoutError,
+    parse_retry_after,
+)
+
+MESSAGES = [{"role": "user", "content": "我的航班状态怎么样？"}]
+
+class FlakySimulator(LLMSimulator):
+    """先依次返回排队的错误响应（状态码, 响应头），之后正常作答。"""
+
+    def __init__(self, failures=(), **kwargs):
+        super().__init__(**kwargs)
+        self.failures = list(failures)
+
+    async def handle(self, body):
+        if self.failures:
+            self.requests += 1
+            status_code, headers = self.failures.pop(0)
+            body = json.dumps({"error": {"message": "注入的错误", "type": "test", "code": "test"}}).encode()
+            return SimulatedResponse(status_code, {"content-type": "application/json", **headers}, body)
+        return await super().handle(body)
+
+def _client(simulator, **policy) -> DeepSeekClient:
+    breaker = {key: policy.pop(key) for key in ("failure_threshold", "recovery_timeout") if key in policy}
+    resilience = ResilientCaller(RetryPolicy(**{"base_delay": 0.0, **policy}), **breaker)
+    return DeepSeekClient(dev_mode=True, simulator=simulator, resilience=resilience)
+
+def _run(test):
+    async def main():
+        client = await test()
+        await client.aclose()
+    asyncio.run(main())
+
+def test_server_errors_are_retried():
+    async def test():
+        simulator = FlakySimulator([(503, {}), (502, {})])
+        client = _client(simulator, max_retries=2)
+        completion = await client.chat_completion(MESSAGES)
+        assert completion["choices"][0]["message"]["content"]
+        assert client.resilience.retries == 2
+        assert simulator.requests == 3
+        return client
+    _run(test)
+
+def test_gives_up_after_max_retries():
+    async def test():
+        simulator = FlakySimulator([(500, {})] * 3)
+        client = _client(simulator, max_retries=1)
+        with pytest.raises(UpstreamServerError):
+            await client.chat_completion(MESSAGES)
+        assert simulator.requests == 2
+        return client
+    _run(test)
+
+def test_retry_after_is_honored():
+    async def test():
+        simulator = FlakySimulator([(429, {"retry-after-ms": "200"})])
+        client = _client(simulator, max_retries=1)
+        started = time.perf_counter()
+        await client.chat_completion(MESSAGES)
+        assert time.perf_counter() - started >= 0.2
+        return client
+    _run(test)
+
+def test_long_retry_after_fails_without_waiting():
+    async def test():
+        simulator = FlakySimulator([(429, {"retry-after": "60"})])
+        client = _client(simulator, max_retries=2, max_retry_after=10.0)
+        started = time.perf_counter()
+        with pytest.raises(UpstreamRateLimitError) as raised:
+            await client.chat_completion(MESSAGES)
+        assert raised.value.retry_after == 60
+        assert time.perf_counter() - started < 1.0
+        assert simulator.requests == 1
+        return client
+    _run(test)
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after-ms": "1500", "retry-after": "9"}) == 1.5
+    assert parse_retry_after({"retry-after": "3"}) == 3.0
+    assert parse_retry_after({}) is None
+    # HTTP日期形式按距今的秒数计算，已过去的日期视为立即重试
+    later = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= parse_retry_after({"retry-after": later}) <= 30
+    earlier = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert parse_retry_after({"retry-after": earlier}) == 0.0
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_call_deadline(stream):
+    async def test():
+        simulator = LLMSimulator(LatencyProfile(ttft_ms=2000))
+        client = _client(simulator, max_retries=1, call_timeout=0.05)
+        started = time.perf_counter()
+        with pytest.raises(UpstreamTimeoutError):
+            if stream:
+                async for _ in client.chat_completion_stream(MESSAGES):
+                    pass
+            else:
+                await client.chat_completion(MESSAGES)
+        # 两次尝试各自在时限处被取消
+        assert time.perf_counter() - started < 0.5
+        assert simulator.requests == 2
+        return client
+    _run(test)
+
+def test_breaker_opens_and_recovers_through_half_open_probe():
+    async def test():
+        simulator = FlakySimulator([(500, {})] * 2, profile=LatencyProfile(ttft_ms=100))
+        client = _client(simulator, max_retries=0, failure_threshold=2, recovery_timeout=0.1)
+        breaker = client.resilience.breaker("deepseek-v3")
+        for _ in range(2):
+            with pytest.raises(UpstreamServerError):
+                await client.chat_completion(MESSAGES)
+        assert breaker.state == "open"
+        # 打开期间不发起调用
+        with pytest.raises(CircuitOpenError):
+            await client.chat_completion(MESSAGES)
+        assert simulator.requests == 2
+
+        await asyncio.sleep(0.1)
+        # 半开状态只放行一个探测调用，其余快速失败
+        probe = asyncio.ensure_future(client.chat_completion(MESSAGES))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        with pytest.raises(CircuitOpenError):
+            await client.chat_completion(MESSAGES)
+        await probe
+        assert breaker.state == "closed"
+        assert breaker.trips == 1
+        return client
+    _run(test)
+
+def test_failed_probe_reopens_breaker():
+    async def test():
+        simulator = FlakySimulator([(500, {})] * 3)
+        client = _client(simulator, max_retries=0, failure_threshold=2, recovery_timeout=0.05)
+        breaker = client.resilience.breaker("deepseek-v3")
+        for _ in range(2):
+            with pytest.raises(UpstreamServerError):
+                await client.chat_completion(MESSAGES)
+        await asyncio.sleep(0.05)
+        with pytest.raises(UpstreamServerError):
+            await client.chat_completion(MESSAGES)
+        assert breaker.state == "open"
+        assert breaker.trips == 2
+        return client
+    _run(test)
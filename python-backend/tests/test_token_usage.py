@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+
+import metrics
+from deepseek_agent import Agent, Runner, function_tool
+from fake_model import ScriptedClient, tool_call
+from token_usage import (
+    COST_TOTAL, TOKENS_TOTAL, ModelPrice, TokenBudgetExceeded, TokenUsage, UsageLedger, bind_conversation,
+    parse_prices, parse_usage, usage_ledger,
+)
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import api
+
+def test_parse_usage_reads_cache_hits_from_either_field():
+    openai_style = {"prompt_tokens": 100, "completion_tokens": 20, "prompt_tokens_details": {"cached_tokens": 60}}
+    deepseek_style = {"prompt_tokens": 100, "completion_tokens": 20, "prompt_cache_hit_tokens": 60}
+    for usage in (openai_style, deepseek_style):
+        assert parse_usage(usage) == TokenUsage(prompt_tokens=100, completion_tokens=20, cached_tokens=60, calls=1)
+    assert parse_usage({"prompt_tokens": 5}) == TokenUsage(prompt_tokens=5, calls=1)
+    assert parse_usage(None) is None
+
+def test_ledger_rolls_up_cost_by_agent_model_and_conversation():
+    prices = parse_prices('{"测试模型": {"prompt": 1.0, "completion": 2.0, "cached": 0.5}}')
+    assert prices["测试模型"] == ModelPrice(1.0, 2.0, 0.5)
+    ledger = UsageLedger(prices=prices, max_conversations=2)
+    tokens_before = TOKENS_TOTAL.value("代理甲", "测试模型", "cached")
+    cost_before = COST_TOTAL.value("代理甲", "测试模型")
+
+    ledger.record("代理甲", "测试模型", TokenUsage(1000, 500, 400, 1), conversation_id="c1")
+    ledger.record("代理乙", "测试模型", TokenUsage(1000, 0, 0, 1), conversation_id="c2")
+    ledger.record("代理乙", "未定价模型", TokenUsage(1000, 0, 0, 1), conversation_id="c1")
+    # 未缓存的600个输入token、缓存命中的400个和500个输出token分别计价
+    assert ledger.conversation("c1").cost == pytest.approx(0.6 + 0.2 + 1.0)
+    assert ledger.conversation("c1").total_tokens == 2500
+    assert ledger.total.calls == 3
+
+    summary = ledger.summary()
+    assert summary["by_agent"]["代理乙"]["未定价模型"]["cost"] == 0
+    assert summary["by_model"]["测试模型"]["total_tokens"] == 2500
+    assert [c["conversation_id"] for c in summary["top_conversations"]] == ["c1", "c2"]
+    assert summary["per_minute"][-1]["calls"] == 3
+    if metrics.registry.enabled:
+        assert TOKENS_TOTAL.value("代理甲", "测试模型", "cached") == tokens_before + 400
+        assert COST_TOTAL.value("代理甲", "测试模型") == pytest.approx(cost_before + 1.8)
+
+    # 按会话的汇总有界：淘汰最久未记录的会话
+    ledger.record("代理甲", "测试模型", TokenUsage(1, 0, 0, 1), conversation_id="c3")
+    assert ledger.conversation("c2") is None
+    assert ledger.conversation("c1") is not None
+
+def test_usage_is_charged_to_the_bound_conversation():
+    ledger = UsageLedger()
+
+    async def guardrail():
+        await asyncio.sleep(0)
+        ledger.record("守卫", "qwen-turbo", TokenUsage(10, 1, 0, 1))
+
+    async def turn(conversation_id):
+        bind_conversation(conversation_id)
+        # 本轮中创建的任务（如并发守卫）继承绑定的会话
+        await asyncio.gather(asyncio.create_task(guardrail()), asyncio.create_task(guardrail()))
+
+    async def main():
+        await asyncio.gather(asyncio.create_task(turn("c1")), asyncio.create_task(turn("c2")))
+
+    asyncio.run(main())
+    assert ledger.conversation("c1").total_tokens == ledger.conversation("c2").total_tokens == 22
+
+def test_budget_is_checked_against_the_conversation_total():
+    ledger = UsageLedger(conversation_budget=100)
+    ledger.check_budget("c1")
+    assert ledger.remaining_budget("c1") == 100
+    ledger.record("代理", "deepseek-v3", TokenUsage(60, 40, 0, 1), conversation_id="c1")
+    assert ledger.remaining_budget("c1") == 0
+    with pytest.raises(TokenBudgetExceeded) as raised:
+        ledger.check_budget("c1")
+    assert (raised.value.used, raised.value.budget) == (100, 100)
+    assert ledger.stats()["budget_rejections"] == 1
+    # 未设置预算时不检查
+    assert UsageLedger().remaining_budget("c1") is None
+
+def test_run_crossing_the_budget_stops_before_the_next_call(monkeypatch):
+    monkeypatch.setattr(usage_ledger, "conversation_budget", 100)
+
+    @function_tool
+    def lookup(flight: str) -> str:
+        """查询航班"""
+        return f"{flight}准点"
+
+    async def main():
+        bind_conversation("预算测试会话")
+        client = ScriptedClient(
+            [tool_call("call_1", "lookup", {"flight": "FLT-123"}), "航班准点。"],
+            usage={"prompt_tokens": 80, "completion_tokens": 30},
+        )
+        agent = Agent(name="预算测试代理", instructions="回答", tools=[lookup], client=client)
+        runs = metrics.AGENT_RUN_SECONDS.count(agent.name, "budget_exceeded")
+        with pytest.raises(TokenBudgetExceeded):
+            await Runner.run(agent, "FLT-123准点吗")
+        # 第一次调用用掉110个token，工具照常执行，下一次模型调用前停止
+        assert len(client.calls) == 1
+        assert usage_ledger.conversation("预算测试会话").total_tokens == 110
+        if metrics.registry.enabled:
+            assert metrics.AGENT_RUN_SECONDS.count(agent.name, "budget_exceeded") == runs + 1
+
+    asyncio.run(main())
+
+def test_usage_endpoints_and_budget_refusal(monkeypatch):
+    monkeypatch.setattr(usage_ledger, "conversation_budget", 500)
+    with TestClient(api.app) as client, contextlib.redirect_stdout(io.StringIO()):
+        created = client.post("/chat", json={"message": ""}).json()
+        conversation_id = created["conversation_id"]
+        assert client.get(f"/usage/{conversation_id}").status_code == 404
+
+        client.post("/chat", json={"conversation_id": conversation_id, "message": "我能换座位吗？"})
+        usage = client.get(f"/usage/{conversation_id}").json()
+        assert usage["calls"] >= 1 and usage["total_tokens"] >= 500
+        assert usage["remaining_budget"] == 0
+        summary = client.get("/usage").json()
+        assert summary["conversation_budget"] == 500
+        assert conversation_id in [c["conversation_id"] for c in summary["top_conversations"]]
+
+        # 达到预算后不再调用模型，返回固定回复和budget_exceeded事件，上下文不变
+        refused = client.post("/chat", json={"conversation_id": conversation_id, "message": "23A"}).json()
+        assert [e["type"] for e in refused["events"]] == ["budget_exceeded"]
+        assert refused["events"][0]["metadata"] == {"used_tokens": usage["total_tokens"], "budget": 500}
+        assert refused["messages"][0]["content"] == "抱歉，本次对话的用量已达上限，请开始新的对话。"
+        assert refused["context"]["seat_number"] is None
+        assert client.get(f"/usage/{conversation_id}").json()["total_tokens"] == usage["total_tokens"]
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from deepseek_agent import (
+    Agent, MaxTurnsExceeded, MessageOutputItem, Runner, ToolCallItem, ToolCallOutputItem, function_tool,
+)
+from fake_model import ScriptedClient, tool_call
+
+@function_tool
+async def slow_lookup(flight: str) -> str:
+    """慢速查询航班状态。"""
+    await asyncio.sleep(0.1)
+    return f"{flight}准点"
+
+@function_tool
+async def fast_lookup(seat: str) -> str:
+    """快速查询座位。"""
+    await asyncio.sleep(0.1)
+    return f"{seat}空闲"
+
+@function_tool
+async def hanging_lookup() -> str:
+    """永远不返回的查询。"""
+    await asyncio.sleep(60)
+    return "不会返回"
+
+@function_tool
+def broken_lookup() -> str:
+    """总是出错的查询。"""
+    raise RuntimeError("数据库不可用")
+
+def _agent(client: ScriptedClient) -> Agent:
+    return Agent(
+        name="工具测试代理", instructions="使用工具回答",
+        tools=[slow_lookup, fast_lookup, hanging_lookup, broken_lookup], client=client,
+    )
+
+def _outputs(result):
+    return [(item.call_id, item.output) for item in result.new_items if isinstance(item, ToolCallOutputItem)]
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_tool_calls_in_one_turn_run_concurrently(stream):
+    async def main():
+        client = ScriptedClient([
+            tool_call(
+                "call_a", "slow_lookup", {"flight": "CA1234"},
+                {"id": "call_b", "name": "fast_lookup", "arguments": {"seat": "23A"}},
+            ),
+            "CA1234准点，23A空闲。",
+        ])
+        agent = _agent(client)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        if stream:
+            result = Runner.run_streamed(agent, "查一下航班和座位")
+            async for _ in result.stream_events():
+                pass
+        else:
+            result = await Runner.run(agent, "查一下航班和座位")
+        # 两个各0.1秒的工具并发执行
+        assert loop.time() - started < 0.18
+        assert _outputs(result) == [("call_a", "CA1234准点"), ("call_b", "23A空闲")]
+        assert [item.raw_item.id for item in result.new_items if isinstance(item, ToolCallItem)] == ["call_a", "call_b"]
+        assert isinstance(result.new_items[-1], MessageOutputItem)
+        # 第二次请求中，每条工具输出对应到各自的tool_call_id
+        followup = client.calls[1]["messages"]
+        assert [m["id"] for m in followup[-3]["tool_calls"]] == ["call_a", "call_b"]
+        assert [(m["tool_call_id"], m["content"]) for m in followup[-2:]] == _outputs(result)
+
+    asyncio.run(main())
+
+def test_slow_tool_times_out_as_tool_error():
+    async def main():
+        client = ScriptedClient([
+            tool_call(
+                "call_h", "hanging_lookup", {},
+                {"id": "call_a", "name": "slow_lookup", "arguments": {"flight": "CA1234"}},
+            ),
+            "查询超时了，请稍后再试。",
+        ])
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await Runner.run(_agent(client), "查一下", tool_timeout=0.2)
+        assert loop.time() - started < 1
+        assert _outputs(result) == [
+            ("call_h", "错误：工具hanging_lookup执行超时（0.2秒）"),
+            ("call_a", "CA1234准点"),
+        ]
+        assert result.new_items[-1].content == "查询超时了，请稍后再试。"
+
+    asyncio.run(main())
+
+def test_tool_errors_are_reported_to_the_model():
+    async def main():
+        client = ScriptedClient([
+            tool_call(
+                "call_e", "broken_lookup", {},
+                {"id": "call_u", "name": "no_such_tool", "arguments": {}},
+                {"id": "call_x", "name": "slow_lookup", "arguments": {"seat": "23A"}},
+            ),
+            "抱歉，暂时查不到。",
+        ])
+        result = await Runner.run(_agent(client), "查一下")
+        assert _outputs(result) == [
+            ("call_e", "错误：工具broken_lookup执行失败：数据库不可用"),
+            ("call_u", "错误：未知工具no_such_tool"),
+            ("call_x", "错误：工具slow_lookup的参数无效：未知参数: seat"),
+        ]
+
+    asyncio.run(main())
+
+def test_endless_tool_loop_stops_at_max_turns():
+    async def main():
+        client = ScriptedClient([tool_call("call_1", "slow_lookup", {"flight": "CA1234"})])
+        with pytest.raises(MaxTurnsExceeded) as raised:
+            await Runner.run(_agent(client), "一直查", max_turns=3)
+        assert raised.value.max_turns == 3
+        assert len(client.calls) == 3
+
+    asyncio.run(main())
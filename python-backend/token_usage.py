@@ -0,0 +1,240 @@
+"""
+上游调用的token用量与费用核算：每次调用的prompt、completion和缓存命中token数按代理（含守卫代理）、
+模型和会话汇总，保留最近一段时间的分钟级汇总，并可按会话设置token预算。
+"""
+from __future__ import annotations as _annotations
+
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Any, Deque, Dict, NamedTuple, Optional, Tuple
+
+import metrics
+
+# =========================
+# 用量与价格
+# =========================
+
+@dataclass
+class TokenUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # prompt中命中上游前缀缓存的部分（已包含在prompt_tokens中）
+    cached_tokens: int = 0
+    calls: int = 0
+    cost: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "TokenUsage") -> None:
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cached_tokens += other.cached_tokens
+        self.calls += other.calls
+        self.cost += other.cost
+
+    def as_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["total_tokens"] = self.total_tokens
+        data["cost"] = round(self.cost, 6)
+        return data
+
+def parse_usage(usage: Any) -> Optional[TokenUsage]:
+    """从OpenAI兼容接口的usage（字典或SDK对象）读取一次调用的用量。"""
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    details = usage.get("prompt_tokens_details") or {}
+    # DeepSeek官方接口用prompt_cache_hit_tokens报告缓存命中
+    cached = details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0
+    return TokenUsage(
+        prompt_tokens=usage.get("prompt_tokens") or 0,
+        completion_tokens=usage.get("completion_tokens") or 0,
+        cached_tokens=cached,
+        calls=1,
+    )
+
+def _estimate_tokens(text: str) -> int:
+    # 汉字约每字一个token，其余字符约每4个一个token
+    wide = sum(1 for char in text if ord(char) > 0x2E7F)
+    return wide + (len(text) - wide + 3) // 4
+
+def estimate_usage(messages: Any, completion: str) -> TokenUsage:
+    """估算没有上游用量报告的调用（如提前关闭的流）的用量。"""
+    prompt = sum(_estimate_tokens(message.get("content") or "") + 4 for message in messages)
+    return TokenUsage(prompt_tokens=prompt, completion_tokens=_estimate_tokens(completion), calls=1)
+
+class ModelPrice(NamedTuple):
+    """每千token的价格（元）；cached为命中缓存的输入token价格。"""
+    prompt: float
+    completion: float
+    cached: float
+
+# 阿里云百炼的公开价格，隐式缓存命中的输入按输入价格的40%计费；可用TOKEN_PRICES覆盖
+DEFAULT_PRICES: Dict[str, ModelPrice] = {
+    "deepseek-v3": ModelPrice(prompt=0.002, completion=0.008, cached=0.0008),
+    "deepseek-r1": ModelPrice(prompt=0.004, completion=0.016, cached=0.0016),
+    "qwen-plus": ModelPrice(prompt=0.0008, completion=0.002, cached=0.00032),
+    "qwen-turbo": ModelPrice(prompt=0.0003, completion=0.0006, cached=0.00012),
+}
+
+def parse_prices(spec: str) -> Dict[str, ModelPrice]:
+    """解析TOKEN_PRICES：{"模型": {"prompt": 0.002, "completion": 0.008, "cached": 0.0008}, ...}"""
+    prices = dict(DEFAULT_PRICES)
+    for model, price in (json.loads(spec) if spec else {}).items():
+        prompt = float(price["prompt"])
+        prices[model] = ModelPrice(prompt, float(price["completion"]), float(price.get("cached", prompt)))
+    return prices
+
+class TokenBudgetExceeded(Exception):
+    def __init__(self, conversation_id: str, used: int, budget: int):
+        self.conversation_id = conversation_id
+        self.used = used
+        self.budget = budget
+        super().__init__(f"会话{conversation_id}已使用{used}个token，超过预算{budget}")
+
+# =========================
+# 用量账本
+# =========================
+
+# 当前请求所属的会话；之后在此上下文中创建的任务（守卫、后台摘要等）的用量也记在该会话上
+_current_conversation: ContextVar[Optional[str]] = ContextVar("current_conversation", default=None)
+
+def bind_conversation(conversation_id: Optional[str]) -> None:
+    _current_conversation.set(conversation_id)
+
+TOKENS_TOTAL = metrics.registry.counter(
+    "cs_llm_tokens_total", "上游调用消耗的token数；type为prompt、completion或cached", ("agent", "model", "type")
+)
+COST_TOTAL = metrics.registry.counter(
+    "cs_llm_cost_yuan_total", "按TOKEN_PRICES估算的上游调用费用（元）", ("agent", "model")
+)
+
+class UsageLedger:
+    """
+    进程内的用量账本：总计、按(代理, 模型)、按会话（有界LRU）和按分钟（最近window_minutes分钟）汇总。
+    conversation_budget大于0时，会话累计token数达到预算后check_budget抛出TokenBudgetExceeded。
+    """
+
+    def __init__(
+        self,
+        prices: Optional[Dict[str, ModelPrice]] = None,
+        conversation_budget: int = 0,
+        max_conversations: int = 10_000,
+        window_minutes: int = 60,
+    ):
+        self.prices = prices if prices is not None else dict(DEFAULT_PRICES)
+        self.conversation_budget = conversation_budget
+        self.max_conversations = max_conversations
+        self.window_minutes = window_minutes
+        self.total = TokenUsage()
+        self.by_agent: Dict[Tuple[str, str], TokenUsage] = {}
+        self._conversations: "OrderedDict[str, TokenUsage]" = OrderedDict()
+        self._minutes: Deque[Tuple[int, TokenUsage]] = deque()
+        self.budget_rejections = 0
+
+    @classmethod
+    def from_env(cls) -> "UsageLedger":
+        return cls(
+            prices=parse_prices(os.environ.get("TOKEN_PRICES", "")),
+            conversation_budget=int(os.environ.get("CONVERSATION_TOKEN_BUDGET", "0")),
+            max_conversations=int(os.environ.get("USAGE_MAX_CONVERSATIONS", "10000")),
+        )
+
+    def cost(self, model: str, usage: TokenUsage) -> float:
+        price = self.prices.get(model)
+        if price is None:
+            return 0.0
+        uncached = usage.prompt_tokens - usage.cached_tokens
+        return (
+            uncached * price.prompt + usage.cached_tokens * price.cached + usage.completion_tokens * price.completion
+        ) / 1000
+
+    def record(self, agent: str, model: str, usage: TokenUsage, conversation_id: Optional[str] = None) -> None:
+        """记录一次上游调用的用量；conversation_id默认取当前请求绑定的会话。"""
+        usage.cost = self.cost(model, usage)
+        self.total.add(usage)
+        self.by_agent.setdefault((agent, model), TokenUsage()).add(usage)
+
+        conversation_id = conversation_id or _current_conversation.get()
+        if conversation_id:
+            totals = self._conversations.get(conversation_id)
+            if totals is None:
+                totals = self._conversations[conversation_id] = TokenUsage()
+                if len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(conversation_id)
+            totals.add(usage)
+
+        minute = int(time.time() // 60)
+        if not self._minutes or self._minutes[-1][0] != minute:
+            self._minutes.append((minute, TokenUsage()))
+        self._minutes[-1][1].add(usage)
+        while self._minutes[0][0] <= minute - self.window_minutes:
+            self._minutes.popleft()
+
+        if metrics.registry.enabled:
+            TOKENS_TOTAL.inc(agent, model, "prompt", amount=usage.prompt_tokens)
+            TOKENS_TOTAL.inc(agent, model, "completion", amount=usage.completion_tokens)
+            TOKENS_TOTAL.inc(agent, model, "cached", amount=usage.cached_tokens)
+            COST_TOTAL.inc(agent, model, amount=usage.cost)
+
+    def conversation(self, conversation_id: str) -> Optional[TokenUsage]:
+        return self._conversations.get(conversation_id)
+
+    def remaining_budget(self, conversation_id: str) -> Optional[int]:
+        """会话剩余的token预算；未设置预算时返回None。"""
+        if self.conversation_budget <= 0:
+            return None
+        usage = self._conversations.get(conversation_id)
+        return max(0, self.conversation_budget - (usage.total_tokens if usage else 0))
+
+    def check_budget(self, conversation_id: Optional[str] = None) -> None:
+        """会话（默认为当前请求绑定的会话）的用量已达预算时抛出TokenBudgetExceeded。"""
+        conversation_id = conversation_id or _current_conversation.get()
+        if self.conversation_budget <= 0 or not conversation_id:
+            return
+        usage = self._conversations.get(conversation_id)
+        if usage is not None and usage.total_tokens >= self.conversation_budget:
+            self.budget_rejections += 1
+            raise TokenBudgetExceeded(conversation_id, usage.total_tokens, self.conversation_budget)
+
+    def summary(self, top: int = 10) -> Dict[str, Any]:
+        """GET /usage的内容：总计、按代理和模型、按分钟以及用量最多的会话。"""
+        by_agent: Dict[str, Dict[str, Any]] = {}
+        by_model: Dict[str, TokenUsage] = {}
+        for (agent, model), usage in sorted(self.by_agent.items()):
+            by_agent.setdefault(agent, {})[model] = usage.as_dict()
+            by_model.setdefault(model, TokenUsage()).add(usage)
+        heaviest = sorted(self._conversations.items(), key=lambda item: item[1].total_tokens, reverse=True)[:top]
+        return {
+            "total": self.total.as_dict(),
+            "by_agent": by_agent,
+            "by_model": {model: usage.as_dict() for model, usage in by_model.items()},
+            "per_minute": [
+                {"minute": time.strftime("%Y-%m-%dT%H:%M", time.localtime(minute * 60)), **usage.as_dict()}
+                for minute, usage in self._minutes
+            ],
+            "top_conversations": [
+                {"conversation_id": conversation_id, **usage.as_dict()} for conversation_id, usage in heaviest
+            ],
+            "conversation_budget": self.conversation_budget or None,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.total.as_dict(),
+            "conversations": len(self._conversations),
+            "conversation_budget": self.conversation_budget or None,
+            "budget_rejections": self.budget_rejections,
+        }
+
+# 进程级共享的用量账本
+usage_ledger = UsageLedger.from_env()